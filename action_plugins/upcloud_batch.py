@@ -0,0 +1,252 @@
+"""
+Batching of per-host UpCloud module tasks, shared by the upcloud_tag and
+upcloud_firewall action plugins.
+
+With C(batch: true), the first fork to reach a task templates the task's arguments for
+every host of ansible_play_batch, runs the module once per group of equal arguments in bulk
+mode, and writes every host's result to a file keyed by the task. The other forks wait on
+the file's lock and return their host's result, so the play makes one API session, one
+server listing and one round of requests instead of one per host. Hosts that the task's
+C(when:) skips are left out of the batch.
+
+The files are kept in a directory of their own in Ansible's local tmp directory, which is
+private to the user and removed when the play ends.
+
+Hosts whose arguments can not be batched, and tasks with a loop, async or until: run the
+module as usual, like Ansible's normal action.
+"""
+
+import os
+import stat
+import json
+import fcntl
+import hashlib
+import tempfile
+
+from ansible import constants as C
+from ansible.errors import AnsibleError
+from ansible.parsing.mod_args import ModuleArgsParser
+from ansible.plugins.action import ActionBase
+from ansible.utils.vars import merge_hash
+
+# parameters that select the one server of a per-host task
+TARGET_KEYS = ["uuid", "hostname", "ip_address"]
+
+
+def batch_target(args):
+    """The uuid, hostname or IP-address the per-host args target, or None if there is not exactly one"""
+    targets = [str(args[key]) for key in TARGET_KEYS if args.get(key)]
+    return targets[0] if len(targets) == 1 else None
+
+
+def group_hosts(host_args, batchable, host_keys=()):
+    """
+    Groups the hosts whose args are batchable by their args apart from the target and
+    host_keys. Returns a list of (shared args, dict of host to args) in the order of the hosts.
+    """
+    groups = {}
+    for host, args in host_args.items():
+        if batch_target(args) is None or not batchable(args):
+            continue
+
+        shared = dict(
+            (key, value)
+            for key, value in args.items()
+            if key not in TARGET_KEYS and key not in host_keys
+        )
+        key = json.dumps(shared, sort_keys=True, default=str)
+        groups.setdefault(key, (shared, {}))[1][host] = args
+    return list(groups.values())
+
+
+def batch_directory():
+    """The private directory of the batch files, created if missing"""
+    directory = os.path.join(os.path.expanduser(C.DEFAULT_LOCAL_TMP), "upcloud-batch")
+    try:
+        os.makedirs(directory, 0o700)
+    except OSError:
+        if not os.path.isdir(directory):
+            raise
+
+    info = os.lstat(directory)
+    if (
+        not stat.S_ISDIR(info.st_mode)
+        or info.st_uid != os.getuid()
+        or info.st_mode & (stat.S_IRWXG | stat.S_IRWXO)
+    ):
+        raise AnsibleError(
+            "Batch directory {} must be a directory private to the user".format(
+                directory
+            )
+        )
+    return directory
+
+
+def host_runs_task(task, templar, variables):
+    """False if the task's when: skips the host whose variables templar has"""
+    if not task.when:
+        return True
+    if hasattr(templar, "evaluate_conditional"):
+        return all(templar.evaluate_conditional(condition) for condition in task.when)
+    # before ansible-core 2.19
+    return task.evaluate_conditional(templar, variables)
+
+
+def split_results(module_result, host_targets, result_keys):
+    """
+    Splits the result of a bulk module run into a result per host, matched by target.
+    A module failure without per-target results fails every host of the group.
+    """
+    by_target = dict(
+        (result.get("target"), result) for result in module_result.get("servers") or []
+    )
+    shared = dict(
+        (key, module_result[key]) for key in result_keys if key in module_result
+    )
+
+    host_results = {}
+    for host, target in host_targets.items():
+        result = by_target.get(target)
+        if result is None:
+            host_results[host] = dict(
+                changed=False,
+                failed=True,
+                msg=module_result.get("msg") or "No result for " + target,
+            )
+            continue
+
+        host_results[host] = dict(shared, **result)
+        if result.get("failed"):
+            host_results[host].setdefault("msg", "Failed: " + target)
+    return host_results
+
+
+class BatchActionModule(ActionBase):
+    """
+    Action plugin of a module that has a bulk mode taking many targets. Subclasses define
+    bulk_args(shared, hosts_args), the args of one bulk module run for hosts_args, a dict of
+    host to args, and may define batchable(args).
+    """
+
+    # args that may differ between the hosts of one bulk module run, besides the target
+    HOST_KEYS = []
+
+    # keys of the bulk module result that every host's result gets, besides profile
+    RESULT_KEYS = []
+
+    def batchable(self, args):
+        return True
+
+    def run(self, tmp=None, task_vars=None):
+        # as in Ansible's normal action, the module decides on check mode and async
+        self._supports_check_mode = True
+        self._supports_async = True
+
+        result = super(BatchActionModule, self).run(tmp, task_vars)
+        del tmp  # tmp no longer has any effect
+        task_vars = task_vars or {}
+
+        args = dict(self._task.args)
+        batch = args.pop("batch", False)
+        host = task_vars.get("inventory_hostname")
+        hosts = task_vars.get("ansible_play_batch") or [host]
+        wrap_async = self._task.async_val
+
+        # the result of a batch is read once, a task that is retried runs by itself
+        host_result = None
+        if (
+            batch
+            and len(hosts) > 1
+            and not (self._task.loop or wrap_async or self._task.until)
+        ):
+            host_result = self.batch_result(host, hosts, task_vars)
+
+        if host_result is None:
+            host_result = self._execute_module(
+                module_name=self._task.action,
+                module_args=args,
+                task_vars=task_vars,
+                wrap_async=wrap_async,
+            )
+        result = merge_hash(result, host_result)
+
+        if not wrap_async:
+            # remove a temporary path we created
+            self._remove_tmp_path(self._connection._shell.tmpdir)
+
+        return result
+
+    def batch_path(self, hosts):
+        """The result file of this task for this batch of hosts"""
+        key = hashlib.sha256(
+            json.dumps([self._task._uuid, sorted(hosts)]).encode("utf-8")
+        ).hexdigest()
+        return os.path.join(batch_directory(), key + ".json")
+
+    def batch_result(self, host, hosts, task_vars):
+        """
+        The host's result from the batch of this task, running the batch if no other fork
+        has run it yet. None if the host's args were not batched.
+        """
+        path = self.batch_path(hosts)
+        directory = os.path.dirname(path)
+
+        lock_fd = os.open(
+            path + ".lock", os.O_WRONLY | os.O_CREAT | os.O_NOFOLLOW, 0o600
+        )
+        with os.fdopen(lock_fd, "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                with open(path, "r") as batch_file:
+                    host_results = json.load(batch_file)
+            except (IOError, OSError, ValueError):
+                host_results = self.run_batch(hosts, task_vars)
+                fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+                with os.fdopen(fd, "w") as tmp_file:
+                    json.dump(host_results, tmp_file)
+                os.replace(tmp_path, path)
+
+        return host_results.get(host)
+
+    def host_args(self, hosts, task_vars):
+        """The task's args templated with the variables of every host that runs the task"""
+        raw_args = ModuleArgsParser(task_ds=self._task.get_ds()).parse()[1]
+        raw_args.pop("batch", None)
+        hostvars = task_vars.get("hostvars") or {}
+
+        host_args = {}
+        for host in hosts:
+            variables = dict(task_vars)
+            if host in hostvars:
+                variables.update(hostvars[host])
+            templar = self._templar.copy_with_new_env(available_variables=variables)
+            try:
+                if not host_runs_task(self._task, templar, variables):
+                    continue
+            except Exception:
+                # the host evaluates its when: itself, and runs the module as usual
+                continue
+            host_args[host] = templar.template(raw_args)
+        return host_args
+
+    def run_batch(self, hosts, task_vars):
+        """Runs the module once per group of batchable hosts and returns the result of every host"""
+        host_results = {}
+        groups = group_hosts(
+            self.host_args(hosts, task_vars), self.batchable, self.HOST_KEYS
+        )
+        for shared, hosts_args in groups:
+            module_result = self._execute_module(
+                module_name=self._task.action,
+                module_args=self.bulk_args(shared, hosts_args),
+                task_vars=task_vars,
+            )
+            host_targets = dict(
+                (host, batch_target(args)) for host, args in hosts_args.items()
+            )
+            host_results.update(
+                split_results(
+                    module_result, host_targets, self.RESULT_KEYS + ["profile"]
+                )
+            )
+        return host_results
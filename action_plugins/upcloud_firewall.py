@@ -0,0 +1,53 @@
+"""
+Action plugin of the upcloud_firewall module.
+
+With C(batch: true), the tasks of every host in the play batch that apply the same rules
+are run as one upcloud_firewall task with targets, see action_plugins/upcloud_batch.py:
+
+- name: open https on every web server
+  upcloud_firewall:
+    hostname: "{{ inventory_hostname }}"
+    firewall_rules: "{{ web_firewall_rules }}"
+    batch: true
+  delegate_to: localhost
+"""
+
+import os
+import sys
+import importlib.util
+
+BATCH_MODULE = os.path.join(
+    os.path.dirname(os.path.realpath(__file__)), "upcloud_batch.py"
+)
+
+
+def load_batch_module():
+    """
+    Imports upcloud_batch.py, which is shared with the upcloud_tag action plugin, by its path
+    under a name of its own, so that another action_plugins package can not shadow it.
+    """
+    name = "upcloud_ansible_batch"
+    if name not in sys.modules:
+        spec = importlib.util.spec_from_file_location(name, BATCH_MODULE)
+        batch = importlib.util.module_from_spec(spec)
+        sys.modules[name] = batch
+        spec.loader.exec_module(batch)
+    return sys.modules[name]
+
+
+upcloud_batch = load_batch_module()
+
+
+class ActionModule(upcloud_batch.BatchActionModule):
+    RESULT_KEYS = ["compacted_rules"]
+
+    def batchable(self, args):
+        return not any(args.get(key) for key in ("uuids", "tags", "zone", "targets"))
+
+    def bulk_args(self, shared, hosts_args):
+        targets = []
+        for args in hosts_args.values():
+            target = upcloud_batch.batch_target(args)
+            if target not in targets:
+                targets.append(target)
+        return dict(shared, targets=targets)
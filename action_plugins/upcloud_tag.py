@@ -0,0 +1,59 @@
+"""
+Action plugin of the upcloud_tag module.
+
+With C(batch: true), the tasks of every host in the play batch are run as one upcloud_tag
+task with server_tags, see action_plugins/upcloud_batch.py:
+
+- name: tag every web server
+  upcloud_tag:
+    hostname: "{{ inventory_hostname }}"
+    tags: [web, "{{ upcloud_zone }}"]
+    batch: true
+  delegate_to: localhost
+"""
+
+import os
+import sys
+import importlib.util
+
+BATCH_MODULE = os.path.join(
+    os.path.dirname(os.path.realpath(__file__)), "upcloud_batch.py"
+)
+
+
+def load_batch_module():
+    """
+    Imports upcloud_batch.py, which is shared with the upcloud_firewall action plugin, by its path
+    under a name of its own, so that another action_plugins package can not shadow it.
+    """
+    name = "upcloud_ansible_batch"
+    if name not in sys.modules:
+        spec = importlib.util.spec_from_file_location(name, BATCH_MODULE)
+        batch = importlib.util.module_from_spec(spec)
+        sys.modules[name] = batch
+        spec.loader.exec_module(batch)
+    return sys.modules[name]
+
+
+upcloud_batch = load_batch_module()
+
+
+class ActionModule(upcloud_batch.BatchActionModule):
+    HOST_KEYS = ["tags"]
+
+    def batchable(self, args):
+        return (
+            args.get("state", "present") in ("present", "absent")
+            and args.get("tags") is not None
+            and not any(
+                args.get(key) for key in ("targets", "server_tags", "tag_servers")
+            )
+        )
+
+    def bulk_args(self, shared, hosts_args):
+        server_tags = {}
+        for args in hosts_args.values():
+            target = args.get("uuid") or args.get("hostname") or args.get("ip_address")
+            tags = server_tags.setdefault(str(target), [])
+            tags.extend(str(tag) for tag in args["tags"] if str(tag) not in tags)
+        return dict(shared, server_tags=server_tags)
@@ -0,0 +1,69 @@
+"""
+Cold versus warm timing of `inventory/upcloud.py --list` with the on-disk cache.
+
+Run from the project root:
+
+    python -m benchmarks.bench_inventory_cache --servers 4000 --latency 0.5
+"""
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+from contextlib import contextmanager
+
+from benchmarks.fleet import generate_fleet, FleetManager
+from inventory.upcloud import InventoryCache, get_cache_key, list_servers
+
+
+@contextmanager
+def silenced_stdout():
+    """list_servers prints the inventory; keep it out of the benchmark output."""
+    stdout = sys.stdout
+    with open(os.devnull, "w") as devnull:
+        sys.stdout = devnull
+        try:
+            yield
+        finally:
+            sys.stdout = stdout
+
+
+def timed_list(manager, cache, refresh_cache=False):
+    start = time.perf_counter()
+    with silenced_stdout():
+        list_servers(
+            manager, True, False, "IPv4", cache=cache, refresh_cache=refresh_cache
+        )
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--servers", type=int, default=4000)
+    parser.add_argument(
+        "--latency", type=float, default=0.5, help="simulated seconds per API call"
+    )
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+
+    manager = FleetManager(generate_fleet(args.servers), latency=args.latency)
+    cache_path = os.path.join(tempfile.mkdtemp(), "upcloud-inventory.json")
+    cache = InventoryCache(cache_path, 300, get_cache_key("bench", True, False, "IPv4"))
+
+    cold = [timed_list(manager, cache, refresh_cache=True) for _ in range(args.rounds)]
+    api_calls = sum(manager.calls.values())
+    warm = [timed_list(manager, cache) for _ in range(args.rounds)]
+
+    print("servers: {}, simulated latency: {}s".format(args.servers, args.latency))
+    print("cold: best {:.3f}s ({} API calls)".format(min(cold), api_calls))
+    print(
+        "warm: best {:.3f}s ({} API calls)".format(
+            min(warm), sum(manager.calls.values()) - api_calls
+        )
+    )
+    print("speedup: {:.1f}x".format(min(cold) / min(warm)))
+
+
+if __name__ == "__main__":
+    main()
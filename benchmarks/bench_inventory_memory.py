@@ -0,0 +1,73 @@
+"""
+Peak memory of `inventory/upcloud.py --list` with and without --stream.
+
+Run from the project root:
+
+    python -m benchmarks.bench_inventory_memory --servers 50000
+"""
+
+import os
+import time
+import shutil
+import argparse
+import tempfile
+import tracemalloc
+
+from benchmarks.fleet import generate_fleet, write_fleet, FileFleetManager
+from benchmarks.bench_inventory_cache import silenced_stdout
+from inventory.upcloud import list_servers, stream_servers
+
+
+def measure(function):
+    """Returns the wall time and the peak traced memory of calling function."""
+    tracemalloc.start()
+    start = time.perf_counter()
+    with silenced_stdout():
+        function()
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--servers", type=int, default=50000)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        write_fleet(generate_fleet(args.servers), directory)
+        manager = FileFleetManager(directory)
+
+        def in_memory():
+            list_servers(manager, True, False, "IPv4")
+
+        def streaming():
+            with open(os.devnull, "w") as devnull:
+                stream_servers(
+                    manager,
+                    devnull,
+                    True,
+                    False,
+                    "IPv4",
+                    fetch_chunks=manager.iter_chunks,
+                )
+
+        print("servers: {}".format(args.servers))
+        for name, function in [
+            ("list_servers", in_memory),
+            ("stream_servers", streaming),
+        ]:
+            elapsed, peak = measure(function)
+            print(
+                "{:>15}: {:7.2f}s, peak {:8.1f} MiB".format(
+                    name, elapsed, peak / 2.0 ** 20
+                )
+            )
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
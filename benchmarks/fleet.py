@@ -0,0 +1,319 @@
+"""
+Deterministic synthetic UpCloud fleets for benchmarks.
+
+generate_fleet() returns API-shaped JSON data for any number of servers and
+generate_firewall_rules() a firewall rule set of any size. FleetManager serves that data through the same methods as test/conftest.py's MockedManager.
+FleetManager counts API calls and can simulate per-call latency. FileFleetManager serves a
+fleet from JSON files, which keeps the parsed data out of memory between calls.
+"""
+
+import os
+import json
+import time
+import random
+from collections import Counter
+from upcloud_api import Server, IPAddress, Tag, FirewallRule
+
+ZONES = ["fi-hel1", "fi-hel2", "de-fra1", "uk-lon1", "nl-ams1", "us-chi1", "sg-sin1"]
+TAGS = ["web", "db", "cache", "worker", "lb", "monitoring", "staging", "production"]
+
+
+def generate_fleet(server_count, seed=0):
+    """
+    Returns a dict with "server" and "ip_address" listings shaped like the API's responses.
+    The same server_count and seed always produce the same fleet.
+    """
+    rng = random.Random(seed)
+    servers = []
+    ip_addresses = []
+
+    for index in range(server_count):
+        uuid = "00{:06x}-{:04x}-4000-8000-{:012x}".format(
+            index, rng.randrange(0x10000), rng.randrange(16 ** 12)
+        )
+        hostname = "server{}.example.com".format(index)
+        servers.append(
+            {
+                "zone": rng.choice(ZONES),
+                "plan": "1xCPU-1GB",
+                "core_number": "1",
+                "title": hostname,
+                "hostname": hostname,
+                "memory_amount": "1024",
+                "uuid": uuid,
+                "state": "started" if rng.random() < 0.9 else "stopped",
+                "tags": {"tag": sorted(rng.sample(TAGS, rng.randrange(4)))},
+            }
+        )
+
+        ip_addresses.append(
+            {
+                "access": "public",
+                "address": "10.{}.{}.{}".format(
+                    index >> 16, (index >> 8) & 255, index & 255
+                ),
+                "family": "IPv4",
+                "ptr_record": "",
+                "server": uuid,
+            }
+        )
+        ip_addresses.append(
+            {
+                "access": "public",
+                "address": "2a04:3540:1000:310::{:x}".format(index),
+                "family": "IPv6",
+                "ptr_record": "",
+                "server": uuid,
+            }
+        )
+        ip_addresses.append(
+            {
+                "access": "private",
+                "address": "172.{}.{}.{}".format(
+                    16 + (index >> 16), (index >> 8) & 255, index & 255
+                ),
+                "family": "IPv4",
+                "ptr_record": "",
+                "server": uuid,
+            }
+        )
+
+    tags = dict((tag, []) for tag in TAGS)
+    for server in servers:
+        for tag in server["tags"]["tag"]:
+            tags[tag].append(server["uuid"])
+
+    return {
+        "servers": {"servers": {"server": servers}},
+        "ip_addresses": {"ip_addresses": {"ip_address": ip_addresses}},
+        "tags": {
+            "tags": {
+                "tag": [
+                    {"name": tag, "description": "", "servers": {"server": uuids}}
+                    for tag, uuids in sorted(tags.items())
+                ]
+            }
+        },
+    }
+
+
+def generate_firewall_rules(rule_count, seed=0):
+    """
+    Returns rule_count firewall rules shaped like the API's firewall rule listing, ending
+    with a default drop rule. The same rule_count and seed always produce the same rules.
+    """
+    rng = random.Random(seed)
+    rules = []
+
+    for position in range(1, rule_count):
+        port = rng.randrange(1, 65536)
+        network = rng.randrange(256)
+        rules.append(
+            {
+                "action": rng.choice(["accept", "reject"]),
+                "comment": "",
+                "destination_address_end": "",
+                "destination_address_start": "",
+                "destination_port_end": str(port),
+                "destination_port_start": str(port),
+                "direction": "in",
+                "family": "IPv4",
+                "icmp_type": "",
+                "position": str(position),
+                "protocol": rng.choice(["tcp", "udp"]),
+                "source_address_end": "10.{}.255.255".format(network),
+                "source_address_start": "10.{}.0.0".format(network),
+                "source_port_end": "",
+                "source_port_start": "",
+            }
+        )
+
+    rules.append(
+        {
+            "action": "drop",
+            "comment": "",
+            "direction": "in",
+            "family": "IPv4",
+            "position": str(rule_count),
+        }
+    )
+    return rules
+
+
+class FleetAPI:
+    """Stand-in for upcloud_api.API that serves the fleet's listings and server details."""
+
+    def __init__(self, manager):
+        self.manager = manager
+
+    def get_request(self, endpoint, params=None, timeout=-1):
+        self.manager._api_call(endpoint)
+        fleet = self.manager.fleet
+
+        if endpoint == "/server":
+            return {
+                "servers": {
+                    "server": [
+                        dict(server) for server in fleet["servers"]["servers"]["server"]
+                    ]
+                }
+            }
+
+        if endpoint == "/ip_address":
+            return {
+                "ip_addresses": {
+                    "ip_address": [
+                        dict(ip)
+                        for ip in fleet["ip_addresses"]["ip_addresses"]["ip_address"]
+                    ]
+                }
+            }
+
+        if endpoint.startswith("/server/"):
+            return {"server": self.manager.server_details(endpoint.split("/")[2])}
+
+        raise Exception("No fleet data for endpoint: {}".format(endpoint))
+
+
+class FleetManager:
+    """MockedManager-style stand-in for upcloud_api.CloudManager that serves a synthetic fleet."""
+
+    def __init__(self, fleet, latency=0.0, firewall_rule_count=10):
+        self.fleet = fleet
+        self.latency = latency
+        self.firewall_rule_count = firewall_rule_count
+        self.calls = Counter()
+        self.api = FleetAPI(self)
+        self._servers_by_uuid = None
+
+    def _api_call(self, name):
+        self.calls[name] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def server_details(self, uuid):
+        """Returns the /server/uuid response body of a server"""
+        if self._servers_by_uuid is None:
+            self._servers_by_uuid = dict(
+                (server["uuid"], server)
+                for server in self.fleet["servers"]["servers"]["server"]
+            )
+            self._ips_by_server = dict()
+            for ip in self.fleet["ip_addresses"]["ip_addresses"]["ip_address"]:
+                self._ips_by_server.setdefault(ip["server"], []).append(ip)
+
+        server = dict(self._servers_by_uuid[uuid])
+        server["ip_addresses"] = {
+            "ip_address": [
+                {
+                    "access": ip["access"],
+                    "address": ip["address"],
+                    "family": ip["family"],
+                }
+                for ip in self._ips_by_server.get(uuid, [])
+            ]
+        }
+        server["storage_devices"] = {
+            "storage_device": [
+                {
+                    "address": "virtio:0",
+                    "storage": "01" + uuid[2:],
+                    "storage_size": 25,
+                    "storage_title": server["hostname"] + " OS disk",
+                    "type": "disk",
+                }
+            ]
+        }
+        return server
+
+    def get_servers(self, populate=False):
+        self._api_call("get_servers")
+        return [
+            Server(dict(server), cloud_manager=self)
+            for server in self.fleet["servers"]["servers"]["server"]
+        ]
+
+    def get_server(self, uuid):
+        self._api_call("get_server")
+        return Server(self.server_details(uuid), cloud_manager=self, populated=True)
+
+    def get_server_by_ip(self, ip_address):
+        self._api_call("get_server_by_ip")
+        for ip in self.fleet["ip_addresses"]["ip_addresses"]["ip_address"]:
+            if ip["address"] == ip_address:
+                return self.get_server(ip["server"])
+
+    def get_ips(self, ignore_ips_without_server=False):
+        self._api_call("get_ips")
+        return IPAddress._create_ip_address_objs(
+            [
+                dict(ip)
+                for ip in self.fleet["ip_addresses"]["ip_addresses"]["ip_address"]
+            ],
+            self,
+            ignore_ips_without_server,
+        )
+
+    def get_tags(self):
+        self._api_call("get_tags")
+        return [
+            Tag(cloud_manager=self, **tag) for tag in self.fleet["tags"]["tags"]["tag"]
+        ]
+
+    def get_firewall_rules(self, server):
+        self._api_call("get_firewall_rules")
+        seed = int(str(server).replace("-", ""), 16)
+        return [
+            FirewallRule(**rule)
+            for rule in generate_firewall_rules(self.firewall_rule_count, seed)
+        ]
+
+
+def write_fleet(fleet, directory):
+    """Writes the fleet's listings to server.json and ip_address.json in directory."""
+    for name, key in [("server", "servers"), ("ip_address", "ip_addresses")]:
+        with open(os.path.join(directory, name + ".json"), "w") as json_file:
+            json.dump(fleet[key], json_file)
+
+
+class FileFleetAPI:
+    """Stand-in for upcloud_api.API that parses the listings written by write_fleet()"""
+
+    def __init__(self, manager):
+        self.manager = manager
+
+    def get_request(self, endpoint, params=None, timeout=-1):
+        return self.manager.read_json_data(self.manager.endpoints[endpoint])
+
+
+class FileFleetManager:
+    """
+    Stand-in for upcloud_api.CloudManager that parses a fleet written by write_fleet()
+    on every call, like test/conftest.py's MockedManager does with its JSON fixtures.
+    """
+
+    endpoints = {"/server": "server", "/ip_address": "ip_address"}
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.api = FileFleetAPI(self)
+
+    def read_json_data(self, filename):
+        with open(os.path.join(self.directory, filename + ".json"), "r") as json_file:
+            return json.load(json_file)
+
+    def get_servers(self, populate=False):
+        servers = self.read_json_data("server")["servers"]["server"]
+        return [Server(server, cloud_manager=self) for server in servers]
+
+    def get_ips(self, ignore_ips_without_server=False):
+        return IPAddress._create_ip_address_objs(
+            self.read_json_data("ip_address"), self, ignore_ips_without_server
+        )
+
+    def iter_chunks(self, manager, endpoint, chunk_size=64 * 1024):
+        """fetch_chunks for inventory.upcloud.stream_servers"""
+        filename = os.path.join(self.directory, self.endpoints[endpoint] + ".json")
+        with open(filename, "r") as json_file:
+            for chunk in iter(lambda: json_file.read(chunk_size), ""):
+                yield chunk
@@ -0,0 +1,226 @@
+"""
+Benchmark suite for the inventory and module hot paths on synthetic fleets.
+
+Every benchmark reports its wall time, the API calls it made and its peak memory.
+Results can be saved as a baseline and later runs compared against it:
+
+    python -m benchmarks.suite --save benchmarks/baseline.json
+    python -m benchmarks.suite --compare benchmarks/baseline.json
+
+The comparison exits with status 1 if a benchmark got slower or used more memory than
+the given threshold allows, or if it made more API calls than in the baseline.
+Wall time is the best of --repeat runs, and time differences below 1ms are ignored as noise.
+"""
+
+import sys
+import json
+import time
+import argparse
+import platform
+import tracemalloc
+
+from benchmarks.fleet import generate_fleet, generate_firewall_rules, FleetManager
+from benchmarks.bench_inventory_cache import silenced_stdout
+from inventory.upcloud import (
+    ServerIndex,
+    build_inventory,
+    fetch_server_records,
+    assign_ips_to_servers,
+    get_server,
+)
+from modules.upcloud import ServerManager
+from modules.upcloud_firewall import FirewallRuleIndex
+from module_utils.upcloud_resolver import ServerResolver
+from module_utils.upcloud_wait import StateWatcher
+
+DEFAULT_SIZES = [100, 10000, 100000]
+
+# UpCloud allows at most 1000 firewall rules per server
+MAX_FIREWALL_RULES = 1000
+
+# time differences below this are noise
+MIN_SECONDS = 0.001
+
+
+class BenchmarkModule:
+    """Stand-in for AnsibleModule"""
+
+    def fail_json(self, **kwargs):
+        raise Exception(kwargs.get("msg"))
+
+
+class FleetServerManager(ServerManager):
+    def __init__(self, manager):
+        self.manager = manager
+        self.module = BenchmarkModule()
+        self.resolver = ServerResolver(manager)
+        self.watcher = StateWatcher(manager)
+
+
+def bench_list_servers(manager, fleet):
+    with silenced_stdout():
+        build_inventory(manager, True, False, "IPv4")
+
+
+def bench_assign_ips_to_servers(manager, fleet):
+    assign_ips_to_servers(manager, fetch_server_records(manager))
+
+
+def bench_get_server(manager, fleet):
+    # the last server is the worst case for any scan
+    address = fleet["ip_addresses"]["ip_addresses"]["ip_address"][-3]["address"]
+    with silenced_stdout():
+        get_server(manager, address, True, index=ServerIndex.build(manager, True))
+
+
+def bench_find_server(manager, fleet):
+    hostname = fleet["servers"]["servers"]["server"][-1]["hostname"]
+    FleetServerManager(manager).find_server(None, hostname)
+
+
+def bench_match_firewall_rules(manager, fleet):
+    uuid = fleet["servers"]["servers"]["server"][0]["uuid"]
+    index = FirewallRuleIndex(manager.get_firewall_rules(uuid))
+
+    # check a desired rule set of the same size, such as a policy re-applied on each run
+    for rule in generate_firewall_rules(manager.firewall_rule_count, seed=1):
+        rule.pop("position")
+        index.matches(rule)
+
+
+BENCHMARKS = [
+    ("inventory.list_servers", bench_list_servers),
+    ("inventory.assign_ips_to_servers", bench_assign_ips_to_servers),
+    ("inventory.get_server", bench_get_server),
+    ("upcloud.find_server", bench_find_server),
+    ("upcloud_firewall.match_firewall_rules", bench_match_firewall_rules),
+]
+
+
+def run_benchmark(function, fleet, size, repeat):
+    """
+    Runs function repeat times for the best wall time and API calls, and once more
+    under tracemalloc for peak memory.
+    """
+    firewall_rule_count = min(max(10, size // 100), MAX_FIREWALL_RULES)
+
+    timings = []
+    for _ in range(repeat):
+        manager = FleetManager(fleet, firewall_rule_count=firewall_rule_count)
+        start = time.perf_counter()
+        function(manager, fleet)
+        timings.append(time.perf_counter() - start)
+    elapsed = min(timings)
+    api_calls = sum(manager.calls.values())
+
+    manager = FleetManager(fleet, firewall_rule_count=firewall_rule_count)
+    tracemalloc.start()
+    function(manager, fleet)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {"seconds": elapsed, "api_calls": api_calls, "peak_bytes": peak}
+
+
+def run_suite(sizes, repeat, selected=None):
+    results = {}
+    for size in sizes:
+        fleet = generate_fleet(size)
+        for name, function in BENCHMARKS:
+            if selected and not any(pattern in name for pattern in selected):
+                continue
+            key = "{}[{}]".format(name, size)
+            results[key] = run_benchmark(function, fleet, size, repeat)
+            print_result(key, results[key])
+    return results
+
+
+def print_result(key, result, note=""):
+    print(
+        "{:<48} {:>9.3f}s {:>7} calls {:>9.1f} MiB {}".format(
+            key,
+            result["seconds"],
+            result["api_calls"],
+            result["peak_bytes"] / 2.0 ** 20,
+            note,
+        ).rstrip()
+    )
+
+
+def compare(results, baseline, threshold):
+    """Returns a list of regression messages of results compared to baseline."""
+    regressions = []
+    for key, result in sorted(results.items()):
+        previous = baseline.get(key)
+        if not previous:
+            continue
+
+        if result["api_calls"] > previous["api_calls"]:
+            regressions.append(
+                "{}: {} API calls, baseline {}".format(
+                    key, result["api_calls"], previous["api_calls"]
+                )
+            )
+
+        for field, unit, floor in [
+            ("seconds", "s", MIN_SECONDS),
+            ("peak_bytes", " bytes", 0),
+        ]:
+            if result[field] > max(
+                previous[field] * (1 + threshold), previous[field] + floor
+            ):
+                regressions.append(
+                    "{}: {:.6g}{} is more than {:.0%} above baseline {:.6g}{}".format(
+                        key, result[field], unit, threshold, previous[field], unit
+                    )
+                )
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="fleet sizes to run"
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=3, help="timing runs per benchmark (default: 3)"
+    )
+    parser.add_argument(
+        "--only", nargs="+", help="run only benchmarks whose name contains one of these"
+    )
+    parser.add_argument("--save", help="save the results as a baseline to this file")
+    parser.add_argument("--compare", help="compare the results to this baseline file")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.25,
+        help="allowed relative increase of time and memory (default: 0.25)",
+    )
+    args = parser.parse_args()
+
+    results = run_suite(args.sizes, args.repeat, args.only)
+
+    if args.save:
+        with open(args.save, "w") as baseline_file:
+            json.dump(
+                {"python": platform.python_version(), "results": results},
+                baseline_file,
+                indent=2,
+                sort_keys=True,
+            )
+
+    if args.compare:
+        with open(args.compare, "r") as baseline_file:
+            baseline = json.load(baseline_file)["results"]
+
+        regressions = compare(results, baseline, args.threshold)
+        for regression in regressions:
+            print("REGRESSION " + regression)
+        if regressions:
+            sys.exit(1)
+        print("no regressions compared to " + args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -16,6 +16,9 @@ The --list argument may also be called: --list --return-ip-addresses to return I
 UpCloud does not enforce that hostnames are actually reachable over SSH or unique, so this option might be useful.
 
 The groups created by --list match UpCloud's Tags and zones. 'uc_all' group contains all hosts from UpCloud.
+--list also returns the variables of every host in '_meta.hostvars', so Ansible does not need to call --host
+separately for each host. These contain the fields returned by UpCloud's server listing, namespaced like
+the response of --host.
 
 ---
 
@@ -25,6 +28,8 @@ The response's keys are described at https://www.upcloud.com/api/7-servers/#get-
 Note: --host does not work with IP-addresses without --return-ip-addresses. If this flag is set in .ini,
 both --list and --host work with IP-addresses.
 
+Several hosts may be given at once as --host a,b,c. The response then maps each given host to its variables.
+
 An example response for reference:
 
 ```
@@ -63,12 +68,45 @@ An example response for reference:
     'uc_nic_model': 'virtio'
 }
 ```
+
+---
+
+The result of --list may be cached on disk by setting cache_path and cache_max_age in upcloud.ini.
+While the cache is fresh, --list is served from disk without contacting the API.
+The lookup index of --host is cached next to it, so --host only fetches the details of the requested servers.
+Use --refresh-cache to rebuild the cache regardless of its age.
+
+---
+
+By default '_meta.hostvars' only contain what UpCloud's server listing returns. Set populate_hostvars
+in upcloud.ini (or pass --populate-hostvars) to fetch every server's details, such as storage_devices,
+for the hostvars. The details are fetched concurrently by detail_workers threads.
+
+---
+
+For very large accounts, set stream_output in upcloud.ini (or pass --stream) to parse the API responses
+incrementally and write each host's variables as soon as they are ready. This keeps memory use low,
+but does not use the cache and can not be combined with populate_hostvars.
+
+---
+
+To see where the time of a slow run goes, pass --profile to write a summary of the API requests
+(call counts, bytes, retries and latency percentiles per endpoint and per phase) to stderr.
+Set UPCLOUD_TRACE to a file path to also append every request to that file as NDJSON.
 """
 
 import os
 import sys
+import time
+import hashlib
 import argparse
+import importlib.util
+import tempfile
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from six.moves import configparser
+import requests
 
 
 try:
@@ -85,17 +123,158 @@ try:
 except ImportError:
     import simplejson as json
 
+# module_utils next to the inventory directory, imported under a name of its own
+MODULE_UTILS_PACKAGE = "upcloud_ansible_module_utils"
+
+
+def import_module_utils(name):
+    """
+    Imports module_utils/<name>.py from next to the inventory directory. The package is
+    imported by its path, so that another module_utils package on sys.path can not shadow it.
+    """
+    if MODULE_UTILS_PACKAGE not in sys.modules:
+        directory = os.path.join(
+            os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "module_utils"
+        )
+        init_path = os.path.join(directory, "__init__.py")
+        if not os.path.exists(init_path):
+            raise ImportError("No module_utils in " + os.path.dirname(directory))
+
+        spec = importlib.util.spec_from_file_location(
+            MODULE_UTILS_PACKAGE, init_path, submodule_search_locations=[directory]
+        )
+        package = importlib.util.module_from_spec(spec)
+        sys.modules[MODULE_UTILS_PACKAGE] = package
+        spec.loader.exec_module(package)
+
+    return importlib.import_module(MODULE_UTILS_PACKAGE + "." + name)
+
+
+# the pooled HTTP client is shared with the modules; without module_utils next to the
+# inventory directory, the script makes its requests with upcloud_api's client
+try:
+    create_cloud_manager = import_module_utils("upcloud_client").create_cloud_manager
+    Tracer = import_module_utils("upcloud_trace").Tracer
+    trace_phase = import_module_utils("upcloud_trace").trace_phase
+except ImportError:
+    create_cloud_manager = None
+    Tracer = None
+
+    @contextmanager
+    def trace_phase(manager, name):
+        yield
+
+
+class ServerRecord:
+    """
+    Compact representation of a server for inventory generation.
+
+    Records are built directly from the API's JSON, without upcloud_api.Server and
+    IPAddress objects. addresses holds (address, access, family) tuples, or None if the
+    server's IP-addresses are not known. fields holds the rest of the API's fields
+    for the hostvars.
+    """
+
+    __slots__ = ("uuid", "hostname", "zone", "state", "tags", "addresses", "fields")
+
+    def __init__(
+        self, uuid, hostname, zone, state, tags=(), addresses=None, fields=None
+    ):
+        self.uuid = uuid
+        self.hostname = hostname
+        self.zone = zone
+        self.state = state
+        self.tags = tags
+        self.addresses = addresses
+        self.fields = fields if fields is not None else {}
+
+    @classmethod
+    def from_api(cls, server):
+        """Creates a record from a server dict of the API's server listing or server details"""
+        tags = server.pop("tags", None) or {}
+        ip_addresses = server.pop("ip_addresses", None)
+        storage_devices = server.pop("storage_devices", None)
+
+        addresses = None
+        if ip_addresses is not None:
+            addresses = [
+                (ip.get("address"), ip.get("access"), ip.get("family"))
+                for ip in ip_addresses.get("ip_address", [])
+            ]
+
+        if storage_devices is not None:
+            server["storage_devices"] = [
+                {
+                    "address": storage.get("address"),
+                    "storage": storage.get("storage"),
+                    "storage_size": storage.get("storage_size"),
+                    "storage_title": storage.get("storage_title"),
+                    "type": storage.get("type"),
+                }
+                for storage in storage_devices.get("storage_device", [])
+            ]
+
+        return cls(
+            server["uuid"],
+            server["hostname"],
+            server["zone"],
+            server["state"],
+            tuple(tags.get("tag", [])),
+            addresses,
+            server,
+        )
+
+    def public_ip(self, addr_family):
+        """Returns the public IP-address of addr_family, any public IP-address, or None"""
+        return select_public_ip(self.addresses or (), addr_family)
+
+    def to_dict(self):
+        """Returns a JSON serializable dict of the server's fields"""
+        fields = dict(self.fields)
+        fields["tags"] = list(self.tags)
+        fields.setdefault("title", self.hostname)
+
+        if self.addresses is not None:
+            fields["ip_addresses"] = [
+                {"address": address, "access": access, "family": family}
+                for address, access, family in self.addresses
+            ]
+
+        return fields
+
+
+def select_public_ip(addresses, addr_family):
+    """
+    Returns the public address of addr_family from (address, access, family) tuples,
+    or any public address if there is none of addr_family.
+    """
+    public_addresses = [address for address in addresses if address[1] == "public"]
+    for address, access, family in public_addresses:
+        if family == addr_family:
+            return address
+    return public_addresses[0][0] if public_addresses else None
+
+
+def fetch_server_records(manager):
+    """Returns the API's server listing as ServerRecords"""
+    servers = manager.api.get_request("/server")["servers"]["server"]
+    return [ServerRecord.from_api(server) for server in servers]
+
+
+def fetch_server_record(manager, uuid):
+    """Returns the details of a server as a ServerRecord"""
+    server = manager.api.get_request("/server/" + uuid)["server"]
+    return ServerRecord.from_api(server)
+
 
 def get_hostname_or_ip(server, get_ip_address, get_non_fqdn_name, addr_family):
-    """Returns a server's hostname. If get_ip_address==True, returns its public IP-address."""
+    """
+    Returns a server's hostname. If get_ip_address==True, returns its public IP-address
+    (of addr_family if available). Returns an empty list if the server has no public IP-address.
+    """
     if get_ip_address:
-        # prevent API request during get_public_ip, as IPs were matched manually
-        # bypass server.__setattr__ as setting populated is not normallow allowed by the class
-        object.__setattr__(server, "populated", True)
-        public_ip_addresses = [server.get_public_ip(addr_family=addr_family)]
-        if len(public_ip_addresses) == 0:
-            public_ip_addresses = [server.get_public_ip()]
-        return public_ip_addresses
+        public_ip_address = server.public_ip(addr_family)
+        return [public_ip_address] if public_ip_address else []
 
     hostname = server.hostname.split(".")[0]
     if get_non_fqdn_name and hostname != server.hostname:
@@ -103,43 +282,259 @@ def get_hostname_or_ip(server, get_ip_address, get_non_fqdn_name, addr_family):
     return [server.hostname]
 
 
+def namespace_fields(server):
+    """Generate the uc_ namespaced inventory variables of a server"""
+    namespaced_server_dict = {}
+    for key, value in server.to_dict().items():
+        namespaced_server_dict["uc_" + key] = value
+    return namespaced_server_dict
+
+
 def assign_ips_to_servers(manager, servers):
     """
     Queries all IP-addresses from UpCloud and matches them with servers.
-    This is an optimisation; we manually populate IP-addresses to the server objects
-    so server.get_public_ip() does not have to perform an API GET request
-    (this would otherwise lead to a request per every server).
+    This is an optimisation; one listing of all IP-addresses replaces fetching
+    the details of every server.
     """
 
     # build a dict for fast search
     servermap = dict()
     for server in servers:
         servermap[server.uuid] = server
-
-        # bypass server.__setattr__ as it does not normally allow assigning ip_addresses manually
-        object.__setattr__(server, "ip_addresses", [])
+        server.addresses = []
 
     # assign IPs to their corresponding server
-    ips = manager.get_ips(ignore_ips_without_server=True)
+    ips = manager.api.get_request("/ip_address")["ip_addresses"]["ip_address"]
     for ip in ips:
-        servermap[ip.server].ip_addresses.append(ip)
+        server = servermap.get(ip.get("server"))
+        if server:
+            server.addresses.append(
+                (ip.get("address"), ip.get("access"), ip.get("family"))
+            )
 
 
-def list_servers(manager, get_ip_address, return_non_fqdn_names, default_ipv_version):
-    """Lists all servers' hostnames. If get_ip_address==True, lists IP-addresses."""
-    servers = manager.get_servers()
+class InventoryCache:
+    """
+    On-disk cache for the output of --list and the lookup index of --host.
 
-    if get_ip_address:
-        assign_ips_to_servers(manager, servers)
+    The cache is invalidated when it is older than max_age seconds or when it was built
+    with different settings (see get_cache_key).
+    """
+
+    def __init__(self, path, max_age, key):
+        self.path = path
+        self.max_age = max_age
+        self.key = key
+
+    def read(self):
+        """Returns the cached data, or None if the cache is missing, stale or built with other settings."""
+        try:
+            with open(self.path, "r") as cache_file:
+                cache = json.load(cache_file)
+        except (IOError, OSError, ValueError):
+            return None
+
+        if not isinstance(cache, dict) or cache.get("key") != self.key:
+            return None
+
+        if time.time() - cache.get("timestamp", 0) > self.max_age:
+            return None
+
+        return cache.get("data")
+
+    def write(self, data):
+        """
+        Writes the cache atomically.
+
+        The data is written to a temporary file in the cache directory which is then renamed over
+        the old cache. Readers never see a partially written file and controllers refreshing the
+        cache at the same time simply replace each other's complete results.
+        """
+        cache_dir = os.path.dirname(os.path.abspath(self.path))
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            if not os.path.isdir(cache_dir):
+                raise
+
+        fd, tmp_path = tempfile.mkstemp(
+            dir=cache_dir, prefix=".upcloud-inventory-", suffix=".tmp"
+        )
+        try:
+            with os.fdopen(fd, "w") as tmp_file:
+                json.dump(
+                    {"key": self.key, "timestamp": time.time(), "data": data},
+                    tmp_file,
+                )
+            os.replace(tmp_path, self.path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+
+
+def get_cache_key(username, *settings):
+    """Returns a key that identifies the API account and the settings the inventory was built with."""
+    key_source = json.dumps([username] + list(settings))
+    return hashlib.sha256(key_source.encode("utf-8")).hexdigest()
+
+
+def map_concurrently(function, items, workers):
+    """
+    Calls function for every item using a pool of workers threads.
+    The results are returned in the order of the items.
+    """
+    if workers <= 1 or len(items) <= 1:
+        return [function(item) for item in items]
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(function, items))
+
+
+def populate_servers(manager, servers, detail_workers):
+    """
+    Fetches the details of the given servers using a pool of detail_workers threads.
+    Returns new ServerRecords in the order the servers were given.
+    """
+    return map_concurrently(
+        lambda server: fetch_server_record(manager, server.uuid),
+        servers,
+        detail_workers,
+    )
+
+
+class ServerIndex:
+    """
+    Lookup index for --host.
+
+    Maps servers' UUIDs, hostnames, short hostnames and IP-addresses to their UUIDs, so that
+    finding a server does not require scanning every server and IP-address.
+    """
+
+    def __init__(self, uuids=(), hostnames=None, short_names=None, addresses=None):
+        self.uuids = set(uuids)
+        self.hostnames = hostnames or {}
+        self.short_names = short_names or {}
+        self.addresses = addresses or {}
+
+    @classmethod
+    def build(cls, manager, with_ip_addresses):
+        """Builds the index from the server list (and the IP-address list if with_ip_addresses==True)"""
+        index = cls()
+        for server in fetch_server_records(manager):
+            index.uuids.add(server.uuid)
+
+            # the first server wins if hostnames are not unique
+            index.hostnames.setdefault(server.hostname, server.uuid)
+            index.short_names.setdefault(server.hostname.split(".")[0], server.uuid)
+
+        if with_ip_addresses:
+            ips = manager.api.get_request("/ip_address")["ip_addresses"]["ip_address"]
+            for ip in ips:
+                if ip.get("server"):
+                    index.addresses.setdefault(ip["address"], ip["server"])
+
+        return index
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(
+            data["uuids"], data["hostnames"], data["short_names"], data["addresses"]
+        )
+
+    def to_dict(self):
+        return {
+            "uuids": sorted(self.uuids),
+            "hostnames": self.hostnames,
+            "short_names": self.short_names,
+            "addresses": self.addresses,
+        }
+
+    def lookup(self, search_item, with_ip_addresses, return_non_fqdn_names):
+        """
+        Returns the UUID of the server matching search_item, or None.
+
+        IP-addresses are only matched if with_ip_addresses==True and short hostnames
+        only if return_non_fqdn_names==True.
+        """
+        if with_ip_addresses and search_item in self.addresses:
+            return self.addresses[search_item]
+
+        if search_item in self.hostnames:
+            return self.hostnames[search_item]
+
+        if search_item in self.uuids:
+            return search_item
+
+        if return_non_fqdn_names:
+            return self.short_names.get(search_item)
+
+        return None
+
+
+def load_server_index(manager, with_ip_addresses, cache=None, refresh_cache=False):
+    """
+    Returns a ServerIndex. If an InventoryCache is given, a fresh cached index is used
+    (unless refresh_cache==True) and a newly built index is written to the cache.
+    """
+    if cache and not refresh_cache:
+        data = cache.read()
+        if data is not None:
+            return ServerIndex.from_dict(data)
+
+    with trace_phase(manager, "get_servers"):
+        index = ServerIndex.build(manager, with_ip_addresses)
+
+    if cache:
+        cache.write(index.to_dict())
+
+    return index
+
+
+def build_inventory(
+    manager,
+    get_ip_address,
+    return_non_fqdn_names,
+    default_ipv_version,
+    populate=False,
+    detail_workers=1,
+):
+    """
+    Builds the inventory groups and their '_meta.hostvars' from UpCloud's API.
+
+    Shared by list_servers() and the upcloud inventory plugin in inventory_plugins/.
+    If populate==True, the details of every started server are fetched for the hostvars
+    using detail_workers concurrent requests.
+    """
+    with trace_phase(manager, "get_servers"):
+        servers = fetch_server_records(manager)
+
+    if populate:
+        # populated servers have their IP-addresses already
+        with trace_phase(manager, "populate"):
+            servers = populate_servers(
+                manager,
+                [server for server in servers if server.state == "started"],
+                detail_workers,
+            )
+    elif get_ip_address:
+        with trace_phase(manager, "get_ips"):
+            assign_ips_to_servers(manager, servers)
 
     groups = dict()
     groups["uc_all"] = []
+    hostvars = dict()
     for server in servers:
         if server.state == "started":
-            for hostname_or_ip in get_hostname_or_ip(
+            hostnames_or_ips = get_hostname_or_ip(
                 server, get_ip_address, return_non_fqdn_names, default_ipv_version
-            ):
+            )
+            if not hostnames_or_ips:
+                continue
+
+            server_vars = namespace_fields(server)
+            for hostname_or_ip in hostnames_or_ips:
                 groups["uc_all"].append(hostname_or_ip)
+                hostvars[hostname_or_ip] = server_vars
 
             # group by tags
             for tag in server.tags:
@@ -153,49 +548,298 @@ def list_servers(manager, get_ip_address, return_non_fqdn_names, default_ipv_ver
                 groups[formatted_zone] = []
             groups[formatted_zone].append(hostname_or_ip)
 
+    groups["_meta"] = {"hostvars": hostvars}
+    return groups
+
+
+def list_servers(
+    manager,
+    get_ip_address,
+    return_non_fqdn_names,
+    default_ipv_version,
+    cache=None,
+    refresh_cache=False,
+    populate=False,
+    detail_workers=1,
+):
+    """
+    Lists all servers' hostnames. If get_ip_address==True, lists IP-addresses.
+
+    If an InventoryCache is given, fresh cached groups are returned without API requests
+    (unless refresh_cache==True) and newly built groups are written to the cache.
+    """
+    if cache and not refresh_cache:
+        groups = cache.read()
+        if groups is not None:
+            print(json.dumps(groups))
+            return groups
+
+    groups = build_inventory(
+        manager,
+        get_ip_address,
+        return_non_fqdn_names,
+        default_ipv_version,
+        populate,
+        detail_workers,
+    )
+
+    if cache:
+        cache.write(groups)
+
     print(json.dumps(groups))
     return groups
 
 
-def get_server(manager, search_item, with_ip_addresses, return_non_fqdn_names=False):
+class JSONArrayStream:
+    """
+    Incremental parser that yields the items of a JSON array from an iterable of text chunks.
+
+    path lists the object keys that lead to the array, e.g. ("servers", "server") for
+    {"servers": {"server": [...]}}. Only the item being parsed and the unconsumed part of
+    the current chunk are held in memory.
+    """
+
+    whitespace = " \t\n\r"
+    number_characters = "0123456789.eE+-"
+
+    def __init__(self, chunks, path):
+        self.chunks = iter(chunks)
+        self.path = path
+        self.buffer = ""
+        self.pos = 0
+        self.decoder = json.JSONDecoder()
+
+    def _fill(self):
+        """Appends the next chunk to the buffer. Returns False at the end of the input."""
+        for chunk in self.chunks:
+            if chunk:
+                # drop the consumed part of the buffer
+                self.buffer = self.buffer[self.pos :] + chunk
+                self.pos = 0
+                return True
+        return False
+
+    def _peek(self):
+        """Returns the next non-whitespace character without consuming it, or "" at the end."""
+        while True:
+            while (
+                self.pos < len(self.buffer) and self.buffer[self.pos] in self.whitespace
+            ):
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill():
+                return ""
+
+    def _expect(self, characters):
+        """Consumes and returns the next non-whitespace character, which must be one of characters."""
+        character = self._peek()
+        if not character or character not in characters:
+            raise ValueError(
+                "Expected one of {!r} but found {!r}".format(characters, character)
+            )
+        self.pos += 1
+        return character
+
+    def _value(self):
+        """Consumes and returns the next complete JSON value."""
+        self._peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except ValueError:
+                if not self._fill():
+                    raise
+                continue
+
+            # a number cut by the end of a chunk, e.g. "1." of "1.5", may continue in the next one
+            if (
+                end == len(self.buffer) or self.buffer[end] in self.number_characters
+            ) and self._fill():
+                continue
+
+            self.pos = end
+            return value
+
+    def __iter__(self):
+        for key in self.path:
+            self._expect("{")
+            while True:
+                if self._peek() == "}":
+                    raise ValueError("Key {!r} was not found".format(key))
+                name = self._value()
+                self._expect(":")
+                if name == key:
+                    break
+
+                # skip the values of other keys
+                self._value()
+                self._expect(",}")
+
+        self._expect("[")
+        if self._peek() == "]":
+            return
+
+        while True:
+            yield self._value()
+            if self._expect(",]") == "]":
+                return
+
+
+def iter_api_chunks(manager, endpoint):
+    """Streams the response of a GET request to UpCloud's API as text chunks."""
+    api = manager.api
+    if hasattr(api, "scheduler"):
+        # a SessionAPI's pooled session, with rate limiting and retries
+        response = api.request("GET", endpoint, stream=True)
+    else:
+        response = requests.get(
+            api.api_root + endpoint,
+            headers={"Authorization": api.token, "User-Agent": api.user_agent},
+            timeout=api.timeout,
+            stream=True,
+        )
+
+    if response.status_code >= 400:
+        error = response.json().get("error", {})
+        raise upcloud_api.UpCloudAPIError(
+            error_code=error.get("error_code"), error_message=error.get("error_message")
+        )
+
+    response.encoding = "utf-8"
+    return response.iter_content(chunk_size=64 * 1024, decode_unicode=True)
+
+
+def stream_servers(
+    manager,
+    out,
+    get_ip_address,
+    return_non_fqdn_names,
+    default_ipv_version,
+    fetch_chunks=iter_api_chunks,
+):
+    """
+    Streaming variant of list_servers() for very large accounts.
+
+    The IP-address and server listings are parsed incrementally and each host's variables
+    are written to out as soon as its server has been parsed. Only the group memberships
+    are kept in memory until the groups are written at the end. The output is the same
+    JSON document as with list_servers(), without server details. Returns the groups.
+    """
+    # (address, access, family) tuples by server uuid
+    ip_addresses = dict()
+    if get_ip_address:
+        for ip in JSONArrayStream(
+            fetch_chunks(manager, "/ip_address"), ("ip_addresses", "ip_address")
+        ):
+            if ip.get("server"):
+                ip_addresses.setdefault(ip["server"], []).append(
+                    (ip.get("address"), ip.get("access"), ip.get("family"))
+                )
+
+    groups = dict()
+    groups["uc_all"] = []
+    separator = ""
+    out.write('{"_meta": {"hostvars": {')
+
+    for item in JSONArrayStream(
+        fetch_chunks(manager, "/server"), ("servers", "server")
+    ):
+        server = ServerRecord.from_api(item)
+        addresses = ip_addresses.pop(server.uuid, [])
+        if server.state != "started":
+            continue
+
+        if get_ip_address:
+            server.addresses = addresses
+
+        hostnames_or_ips = get_hostname_or_ip(
+            server, get_ip_address, return_non_fqdn_names, default_ipv_version
+        )
+        if not hostnames_or_ips:
+            continue
+
+        server_vars = json.dumps(namespace_fields(server))
+        for hostname_or_ip in hostnames_or_ips:
+            out.write(separator + json.dumps(hostname_or_ip) + ": " + server_vars)
+            separator = ", "
+            groups["uc_all"].append(hostname_or_ip)
+
+        # group by tags
+        for tag in server.tags:
+            if tag not in groups:
+                groups[tag] = []
+            groups[tag].append(hostname_or_ip)
+
+        # group by zones
+        formatted_zone = server.zone.replace("-", "_")
+        if formatted_zone not in groups:
+            groups[formatted_zone] = []
+        groups[formatted_zone].append(hostname_or_ip)
+
+    out.write("}}")
+    for group, hosts in groups.items():
+        out.write(", " + json.dumps(group) + ": " + json.dumps(hosts))
+    out.write("}\n")
+
+    return groups
+
+
+def get_server(
+    manager,
+    search_item,
+    with_ip_addresses,
+    return_non_fqdn_names=False,
+    index=None,
+    detail_workers=1,
+):
     """
     Handles --host.
 
     Search_item can be a) hostname b) uuid c) ip_addresses.
     c) is only checked if with_ip_addresses==True.
+
+    Search_item may also list several comma separated items. Their variables are returned
+    in a dict keyed by the items and their details are fetched with detail_workers
+    concurrent requests.
     """
+    if index is None:
+        with trace_phase(manager, "get_servers"):
+            index = ServerIndex.build(manager, with_ip_addresses)
 
-    def namespace_fields(server):
-        """Generate a JSON response to a --host call"""
-        namespaced_server_dict = {}
-        for key, value in server.to_dict().items():
-            namespaced_server_dict["uc_" + key] = value
-        return namespaced_server_dict
+    search_items = search_item.split(",")
+    uuids = [
+        index.lookup(item, with_ip_addresses, return_non_fqdn_names)
+        for item in search_items
+    ]
 
-    if with_ip_addresses:
-        ips = manager.get_ips()
-        for ip in ips:
-            if ip.address == search_item:
-                server = manager.get_server(ip.server)
-                server_dict = namespace_fields(server)
-                print(json.dumps(server_dict))
-                return server_dict
+    # fetch each matched server only once
+    def fetch(uuid):
+        try:
+            return fetch_server_record(manager, uuid)
+        except upcloud_api.UpCloudAPIError as e:
+            # destroyed after the index was cached
+            if e.error_code != "SERVER_NOT_FOUND":
+                raise
+            return None
 
-    servers = manager.get_servers()
-    for server in servers:
-        server_name = server.hostname.split(".")[0]
-        if (
-            (return_non_fqdn_names and search_item == server_name)
-            or server.hostname == search_item
-            or server.uuid == search_item
-        ):
-            server.populate()
-            server_dict = namespace_fields(server)
-            print(json.dumps(server_dict))
-            return server_dict
+    found_uuids = list(OrderedDict.fromkeys(uuid for uuid in uuids if uuid))
+    with trace_phase(manager, "populate"):
+        servers = map_concurrently(fetch, found_uuids, detail_workers)
+    server_dicts = dict(
+        (server.uuid, namespace_fields(server)) for server in servers if server
+    )
+
+    if len(search_items) == 1:
+        response = server_dicts.get(uuids[0], {})
+    else:
+        response = dict(
+            (item, server_dicts.get(uuid, {}))
+            for item, uuid in zip(search_items, uuids)
+        )
 
-    print(json.dumps({}))
-    return {}
+    print(json.dumps(response))
+    return response
 
 
 def read_cli_args():
@@ -212,13 +856,33 @@ def read_cli_args():
     parser.add_argument(
         "--host",
         action="store",
-        help="Get all Ansible inventory variables about a specific server",
+        help="Get all Ansible inventory variables about a specific server, or about several comma separated servers",
     )
     parser.add_argument(
         "--return-ip-addresses",
         action="store_true",
         help="Return IP-addresses instead of hostnames with --list. Also configurable in upcloud.ini",
     )
+    parser.add_argument(
+        "--refresh-cache",
+        action="store_true",
+        help="Rebuild the --list cache from the API even if it is still fresh",
+    )
+    parser.add_argument(
+        "--populate-hostvars",
+        action="store_true",
+        help="Fetch every server's details for the hostvars of --list. Also configurable in upcloud.ini",
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Parse API responses and write --list output incrementally. Also configurable in upcloud.ini",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Write a summary of the API requests and their timing to stderr",
+    )
 
     args = parser.parse_args()
 
@@ -251,6 +915,23 @@ def read_api_credentials(config):
     return username, password
 
 
+def create_api_manager(username, password, timeout, config, tracer=None):
+    """
+    Returns a CloudManager that sends its requests through one pooled keep-alive session,
+    with as many connections as detail_workers in upcloud.ini (at least 10).
+    With a tracer, every request is recorded.
+    """
+    if create_cloud_manager is None:
+        return upcloud_api.CloudManager(username, password, timeout)
+
+    pool_size = 10
+    if config.has_option("upcloud", "detail_workers"):
+        pool_size = max(pool_size, int(config.get("upcloud", "detail_workers")))
+    return create_cloud_manager(
+        username, password, timeout, pool_size=pool_size, tracer=tracer
+    )
+
+
 def return_error_msg_due_to_faulty_ini_file(missing_variable):
     err_msg = "Could not find {} variable in the ini file. Please check if the ini is configured correctly.".format(
         missing_variable
@@ -259,6 +940,26 @@ def return_error_msg_due_to_faulty_ini_file(missing_variable):
     sys.exit(-1)
 
 
+def read_cache_settings(config):
+    """
+    Reads cache_path and cache_max_age from upcloud.ini.
+    Returns (None, 0) if caching is not configured.
+    """
+    cache_path = None
+    cache_max_age = 0
+
+    if config.has_option("upcloud", "cache_path"):
+        cache_path = config.get("upcloud", "cache_path")
+
+    if config.has_option("upcloud", "cache_max_age"):
+        cache_max_age = float(config.get("upcloud", "cache_max_age") or 0)
+
+    if not cache_path or cache_max_age <= 0:
+        return None, 0
+
+    return os.path.expanduser(cache_path), cache_max_age
+
+
 if __name__ == "__main__":
 
     # read settings
@@ -276,7 +977,14 @@ if __name__ == "__main__":
         default_timeout = None
     else:
         default_timeout = float(default_timeout)
-    manager = upcloud_api.CloudManager(username, password, default_timeout)
+    tracer = None
+    if Tracer is not None:
+        tracer = Tracer.from_env(args.profile)
+    elif args.profile:
+        sys.stderr.write(
+            "--profile requires module_utils/ next to the inventory directory\n"
+        )
+    manager = create_api_manager(username, password, default_timeout, config, tracer)
 
     # decide whether to return hostnames or ip_addresses
     if config.has_option("upcloud", "return_ip_addresses"):
@@ -298,14 +1006,87 @@ if __name__ == "__main__":
     else:
         return_error_msg_due_to_faulty_ini_file("default_ipv_version")
 
+    populate_hostvars = args.populate_hostvars
+    if config.has_option("upcloud", "populate_hostvars"):
+        populate_hostvars = populate_hostvars or (
+            str(config.get("upcloud", "populate_hostvars")).lower() == "true"
+        )
+
+    stream_output = args.stream
+    if config.has_option("upcloud", "stream_output"):
+        stream_output = stream_output or (
+            str(config.get("upcloud", "stream_output")).lower() == "true"
+        )
+
+    if stream_output and populate_hostvars:
+        sys.stderr.write(
+            "stream_output can not be used together with populate_hostvars, please disable one of them."
+        )
+        sys.exit(-1)
+
+    detail_workers = 1
+    if config.has_option("upcloud", "detail_workers"):
+        detail_workers = int(config.get("upcloud", "detail_workers"))
+
     if args.return_ip_addresses:
         with_ip_addresses = True
 
+    cache = None
+    index_cache = None
+    cache_path, cache_max_age = read_cache_settings(config)
+    if cache_path:
+        cache_key = get_cache_key(
+            username,
+            with_ip_addresses,
+            return_non_fqdn_names,
+            default_ipv_version,
+            populate_hostvars,
+        )
+        cache = InventoryCache(cache_path, cache_max_age, cache_key)
+
+        cache_root, cache_ext = os.path.splitext(cache_path)
+        index_cache = InventoryCache(
+            cache_root + "-index" + cache_ext, cache_max_age, cache_key
+        )
+
     # choose correct action
-    if args.list:
+    if args.list and stream_output:
+        stream_servers(
+            manager,
+            sys.stdout,
+            with_ip_addresses,
+            return_non_fqdn_names,
+            default_ipv_version,
+        )
+
+    elif args.list:
         list_servers(
-            manager, with_ip_addresses, return_non_fqdn_names, default_ipv_version
+            manager,
+            with_ip_addresses,
+            return_non_fqdn_names,
+            default_ipv_version,
+            cache=cache,
+            refresh_cache=args.refresh_cache,
+            populate=populate_hostvars,
+            detail_workers=detail_workers,
         )
 
     elif args.host:
-        get_server(manager, args.host, with_ip_addresses, return_non_fqdn_names)
+        index = load_server_index(
+            manager, with_ip_addresses, index_cache, args.refresh_cache
+        )
+        get_server(
+            manager,
+            args.host,
+            with_ip_addresses,
+            return_non_fqdn_names,
+            index=index,
+            detail_workers=detail_workers,
+        )
+
+    if tracer:
+        tracer.close()
+        if args.profile:
+            sys.stderr.write(
+                json.dumps(tracer.summary(), indent=2, sort_keys=True) + "\n"
+            )
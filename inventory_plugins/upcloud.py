@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import importlib.util
+from ansible.errors import AnsibleError
+from ansible.plugins.inventory import BaseInventoryPlugin, Constructable, Cacheable
+
+DOCUMENTATION = """
+---
+
+name: upcloud
+plugin_type: inventory
+short_description: UpCloud inventory source
+description:
+    - Builds Ansible inventory of UpCloud servers inside the controller process.
+    - Groups match UpCloud's Tags and zones, and 'uc_all' contains all started servers,
+      exactly like the upcloud.py inventory script.
+    - Host variables are namespaced with uc_ like the response of the inventory script's --host.
+    - Supports Ansible's inventory cache plugins, so the inventory can be shared between controllers.
+    - The configuration file name must end with upcloud.yml or upcloud.yaml.
+author: "UpCloud (@UpCloudLtd)"
+extends_documentation_fragment:
+    - constructed
+    - inventory_cache
+options:
+    plugin:
+        description: Token that ensures this is a source file for the 'upcloud' plugin.
+        required: true
+        choices: ['upcloud']
+    api_user:
+        description: UpCloud API username.
+        env:
+            - name: UPCLOUD_API_USER
+    api_passwd:
+        description: UpCloud API password.
+        env:
+            - name: UPCLOUD_API_PASSWD
+    default_timeout:
+        description: Timeout of API requests in seconds.
+        type: float
+        default: 300
+        env:
+            - name: UPCLOUD_API_TIMEOUT
+    return_ip_addresses:
+        description: Return public IP-addresses instead of hostnames.
+        type: bool
+        default: true
+    return_non_fqdn_names:
+        description: Also return the short names of servers whose hostname is a FQDN.
+        type: bool
+        default: false
+    default_ipv_version:
+        description: IP-address family preferred when return_ip_addresses is set.
+        default: IPv4
+        choices: ['IPv4', 'IPv6']
+    populate_hostvars:
+        description: Fetch every server's details (storage devices etc.) for the host variables.
+        type: bool
+        default: false
+    detail_workers:
+        description: Number of concurrent requests used for fetching server details.
+        type: int
+        default: 8
+requirements:
+  - "upcloud-api >= 2.0.0"
+"""
+
+EXAMPLES = """
+
+# upcloud.yml
+plugin: upcloud
+return_ip_addresses: true
+
+# Cache the inventory in a shared Redis for an hour
+plugin: upcloud
+cache: true
+cache_plugin: redis
+cache_connection: redis-host:6379:0
+cache_timeout: 3600
+
+# Add groups and variables with constructed features
+plugin: upcloud
+keyed_groups:
+  - key: uc_plan
+    prefix: plan
+compose:
+  ansible_user: "'root'"
+"""
+
+
+# the inventory script, whose grouping logic and API client the plugin shares
+INVENTORY_SCRIPT = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.realpath(__file__))),
+    "inventory",
+    "upcloud.py",
+)
+
+
+def load_inventory_script():
+    """
+    Imports inventory/upcloud.py by its path under a name of its own, so that a project's
+    own inventory package on sys.path can not shadow it.
+    """
+    name = "upcloud_ansible_inventory"
+    if name not in sys.modules:
+        spec = importlib.util.spec_from_file_location(name, INVENTORY_SCRIPT)
+        script = importlib.util.module_from_spec(spec)
+        sys.modules[name] = script
+        spec.loader.exec_module(script)
+    return sys.modules[name]
+
+
+# make sure that upcloud-api is installed
+HAS_UPCLOUD = importlib.util.find_spec("upcloud_api") is not None
+
+if HAS_UPCLOUD:
+    upcloud_inventory = load_inventory_script()
+
+
+class InventoryModule(BaseInventoryPlugin, Constructable, Cacheable):
+    """Builds UpCloud inventory with the same groups and variables as inventory/upcloud.py"""
+
+    NAME = "upcloud"
+
+    def verify_file(self, path):
+        if super(InventoryModule, self).verify_file(path):
+            return path.endswith(("upcloud.yml", "upcloud.yaml"))
+        return False
+
+    def create_manager(self):
+        api_user = self.get_option("api_user")
+        api_passwd = self.get_option("api_passwd")
+
+        if not api_user or not api_passwd:
+            raise AnsibleError(
+                "Please set UPCLOUD_API_USER and UPCLOUD_API_PASSWD environment variables or provide api_user and api_passwd options."
+            )
+
+        if upcloud_inventory.create_cloud_manager is None:
+            raise AnsibleError(
+                "The module_utils directory must be next to the inventory_plugins directory."
+            )
+
+        # one pooled session for the listings and the concurrent detail requests, traced
+        # to the file in UPCLOUD_TRACE if it is set
+        return upcloud_inventory.create_cloud_manager(
+            api_user,
+            api_passwd,
+            self.get_option("default_timeout"),
+            pool_size=max(10, self.get_option("detail_workers")),
+            tracer=upcloud_inventory.Tracer.from_env(),
+        )
+
+    def fetch_inventory(self):
+        manager = self.create_manager()
+        try:
+            return upcloud_inventory.build_inventory(
+                manager,
+                self.get_option("return_ip_addresses"),
+                self.get_option("return_non_fqdn_names"),
+                self.get_option("default_ipv_version"),
+                populate=self.get_option("populate_hostvars"),
+                detail_workers=self.get_option("detail_workers"),
+            )
+        finally:
+            tracer = getattr(getattr(manager, "api", None), "tracer", None)
+            if tracer:
+                tracer.close()
+
+    def populate(self, groups):
+        """Adds the groups and hosts returned by build_inventory() to the inventory"""
+        hostvars = groups.get("_meta", {}).get("hostvars", {})
+        strict = self.get_option("strict")
+
+        for group, hosts in groups.items():
+            if group == "_meta":
+                continue
+
+            group = self.inventory.add_group(group)
+            for host in hosts:
+                self.inventory.add_host(host, group=group)
+
+        for host, variables in hostvars.items():
+            for key, value in variables.items():
+                self.inventory.set_variable(host, key, value)
+
+            self._set_composite_vars(
+                self.get_option("compose"), variables, host, strict
+            )
+            self._add_host_to_composed_groups(
+                self.get_option("groups"), variables, host, strict
+            )
+            self._add_host_to_keyed_groups(
+                self.get_option("keyed_groups"), variables, host, strict
+            )
+
+    def parse(self, inventory, loader, path, cache=True):
+        super(InventoryModule, self).parse(inventory, loader, path)
+
+        if not HAS_UPCLOUD:
+            raise AnsibleError(
+                "upcloud-api required for this inventory plugin (`pip install upcloud-api`)"
+            )
+
+        self._read_config_data(path)
+        cache_key = self.get_cache_key(path)
+
+        # cache=False is passed by Ansible on --flush-cache and when refreshing inventory
+        use_cache = self.get_option("cache") and cache
+        update_cache = self.get_option("cache") and not cache
+
+        groups = None
+        if use_cache:
+            try:
+                groups = self._cache[cache_key]
+            except KeyError:
+                update_cache = True
+
+        if groups is None:
+            groups = self.fetch_inventory()
+
+        if update_cache:
+            self._cache[cache_key] = groups
+
+        self.populate(groups)
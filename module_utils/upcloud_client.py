@@ -0,0 +1,185 @@
+"""
+HTTP client shared by the UpCloud inventory and modules.
+
+SessionAPI sends every request of an upcloud_api.CloudManager through one requests.Session,
+so that requests reuse pooled keep-alive connections instead of making a TLS handshake each.
+Requests are scheduled by a RequestScheduler (see upcloud_scheduler.py), which keeps them
+under the API's rate limit and retries throttled requests, and recorded by a Tracer
+(see upcloud_trace.py) if one is given.
+"""
+
+import os
+import json
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import upcloud_api
+from upcloud_api.api import API
+from upcloud_api.errors import UpCloudAPIError
+
+try:
+    from ansible.module_utils.upcloud_scheduler import RequestScheduler
+    from ansible.module_utils.upcloud_trace import response_size
+except ImportError:
+    from .upcloud_scheduler import RequestScheduler
+    from .upcloud_trace import response_size
+
+# connections kept open per host; raise it to at least the number of concurrent workers
+DEFAULT_POOL_SIZE = 10
+
+# seconds to wait for a connection to the API, separately from the response timeout
+DEFAULT_CONNECT_TIMEOUT = 10
+
+# the HTTP statuses upcloud_api's API raises an UpCloudAPIError for, and 429 once
+# the scheduler has run out of retries
+ERROR_STATUSES = (400, 401, 402, 403, 404, 405, 406, 409, 429)
+
+
+def create_session(pool_size=DEFAULT_POOL_SIZE):
+    """A requests.Session with a connection pool of pool_size"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+class SessionAPI(API):
+    """
+    upcloud_api API that makes its requests through a pooled requests.Session.
+
+    timeout is the response timeout of every request, as in upcloud_api.API, and
+    connect_timeout the time to wait for a connection. Without a scheduler, the requests
+    are scheduled by a RequestScheduler that allows up to pool_size concurrent requests.
+    With a tracer, every request is recorded as a span.
+    """
+
+    def __init__(
+        self,
+        token,
+        timeout=None,
+        pool_size=DEFAULT_POOL_SIZE,
+        connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+        session=None,
+        scheduler=None,
+        tracer=None,
+    ):
+        super(SessionAPI, self).__init__(token, timeout)
+        self.connect_timeout = connect_timeout
+        self.session = session or create_session(pool_size)
+        self.scheduler = scheduler or RequestScheduler(max_concurrency=pool_size)
+        self.tracer = tracer
+
+    def request_timeout(self, timeout=-1):
+        """The (connect, read) timeout of a request given timeout, where -1 is the default"""
+        read_timeout = timeout if timeout != -1 else self.timeout
+        if self.connect_timeout is None:
+            return read_timeout
+        return (self.connect_timeout, read_timeout)
+
+    def headers(self):
+        return {"Authorization": self.token, "User-Agent": self.user_agent}
+
+    def request(self, method, endpoint, timeout=-1, **kwargs):
+        """
+        Sends a request through the scheduler and returns the requests.Response.
+        kwargs are passed to requests.Session.request, e.g. stream=True.
+        """
+        headers = self.headers()
+        headers.update(kwargs.pop("headers", {}))
+
+        def send():
+            return self.session.request(
+                method=method,
+                url=self.api_root + endpoint,
+                headers=headers,
+                timeout=self.request_timeout(timeout),
+                **kwargs
+            )
+
+        if self.tracer is None:
+            return self.scheduler.request(method, send)
+
+        started = time.time()
+        clock = time.monotonic()
+        response = error = None
+        try:
+            response = self.scheduler.request(method, send)
+            return response
+        except Exception as e:
+            error = type(e).__name__ + ": " + str(e)
+            raise
+        finally:
+            self.tracer.record_request(
+                method,
+                endpoint,
+                started,
+                time.monotonic() - clock,
+                status=response.status_code if response is not None else None,
+                bytes_sent=len(kwargs.get("data") or ""),
+                bytes_received=(
+                    response_size(response, kwargs.get("stream"))
+                    if response is not None
+                    else None
+                ),
+                retries=self.scheduler.last_retries(),
+                error=error,
+            )
+
+    def api_request(self, method, endpoint, body=None, params=None, timeout=-1):
+        """Performs a request like API.api_request, through the session."""
+        if method not in {"GET", "POST", "PUT", "PATCH", "DELETE"}:
+            raise Exception("Invalid/Forbidden HTTP method")
+
+        headers = {}
+        if body:
+            data = json.dumps(body)
+            headers["Content-Type"] = "application/json"
+        else:
+            data = None
+
+        response = self.request(
+            method, endpoint, timeout, data=data, params=params, headers=headers
+        )
+
+        response_json = response.json() if response.text else {}
+        if response.status_code in ERROR_STATUSES:
+            error = response_json.get("error", {})
+            raise UpCloudAPIError(
+                error_code=error.get("error_code"),
+                error_message=error.get("error_message"),
+            )
+
+        return response_json
+
+    def close(self):
+        self.session.close()
+
+
+def create_cloud_manager(
+    username,
+    password,
+    timeout=60,
+    pool_size=DEFAULT_POOL_SIZE,
+    connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+    rate_limit=None,
+    tracer=None,
+):
+    """
+    An upcloud_api.CloudManager whose requests go through a SessionAPI.
+    rate_limit (requests per second) defaults to the UPCLOUD_API_RATE_LIMIT environment variable.
+    With a tracer (see upcloud_trace.Tracer), every request is recorded.
+    """
+    rate_limit = rate_limit or float(os.getenv("UPCLOUD_API_RATE_LIMIT") or 0) or None
+    manager = upcloud_api.CloudManager(username, password, timeout)
+    manager.api = SessionAPI(
+        manager.api.token,
+        manager.api.timeout,
+        pool_size,
+        connect_timeout,
+        scheduler=RequestScheduler(rate=rate_limit, max_concurrency=pool_size),
+        tracer=tracer,
+    )
+    return manager
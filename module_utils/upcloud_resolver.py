@@ -0,0 +1,335 @@
+"""
+Server lookup shared by the UpCloud modules.
+
+ServerResolver finds servers by uuid, hostname or IP-address with one server listing.
+An IP-address is looked up by itself with GET /ip_address/{ip}, unless the index is cached
+or several are looked up at once: then every IP-address is listed once, into the index.
+
+Given a cache file, the lookup index is shared between the processes of a play: forks that
+find the file missing or stale queue on a lock, the first one lists the servers and the
+others read its result. Modules that create or destroy servers invalidate the cache, and a
+lookup that misses in a cached index lists the servers again before giving up.
+"""
+
+import os
+import json
+import time
+import fcntl
+import hashlib
+import tempfile
+import ipaddress
+from collections import namedtuple
+
+from upcloud_api.errors import UpCloudAPIError
+
+DEFAULT_MAX_AGE = 60
+
+DUPLICATE_HOSTNAME = (
+    "More than one server matched the given hostname. Please use unique hostnames."
+)
+
+ServerRecord = namedtuple("ServerRecord", ["uuid", "hostname", "zone"])
+
+
+class ResolveError(Exception):
+    """A hostname, IP-address or uuid that matches no server, or more than one"""
+
+
+class ServerLookupIndex:
+    """
+    Servers by uuid and hostname, and server uuids by IP-address once the
+    IP-addresses are loaded (addresses is None until then).
+    """
+
+    def __init__(self, servers, addresses=None):
+        self.servers = {}
+        self.hostnames = {}
+        for uuid, hostname, zone in servers:
+            record = ServerRecord(uuid, hostname, zone)
+            self.servers[uuid] = record
+            self.hostnames.setdefault(hostname, []).append(record)
+        self.addresses = addresses
+
+    @classmethod
+    def fetch(cls, manager, with_addresses=False):
+        """Builds the index from the server list (and the IP-address list if with_addresses==True)"""
+        servers = manager.api.get_request("/server")["servers"]["server"]
+        index = cls(
+            (server["uuid"], server["hostname"], server.get("zone"))
+            for server in servers
+        )
+        if with_addresses:
+            index.load_addresses(manager)
+        return index
+
+    def load_addresses(self, manager):
+        ips = manager.api.get_request("/ip_address")["ip_addresses"]["ip_address"]
+        self.addresses = dict(
+            (ip["address"], ip["server"]) for ip in ips if ip.get("server")
+        )
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["servers"], data.get("addresses"))
+
+    def to_dict(self):
+        return {
+            "servers": [list(record) for record in self.servers.values()],
+            "addresses": self.addresses,
+        }
+
+    def by_uuid(self, uuid):
+        return self.servers.get(uuid)
+
+    def by_hostname(self, hostname):
+        """The server with hostname, or None. Raises ResolveError if the hostname has duplicates."""
+        records = self.hostnames.get(hostname, [])
+        if len(records) > 1:
+            raise ResolveError(DUPLICATE_HOSTNAME)
+        return records[0] if records else None
+
+    def by_ip(self, address):
+        return self.servers.get((self.addresses or {}).get(address))
+
+
+class ServerResolver:
+    """
+    Finds servers through a ServerLookupIndex that is listed once per resolver, or once
+    per max_age seconds for every process sharing cache_path.
+    """
+
+    def __init__(self, manager, cache_path=None, max_age=DEFAULT_MAX_AGE, account=""):
+        self.manager = manager
+        self.cache_path = (
+            os.path.abspath(os.path.expanduser(cache_path)) if cache_path else None
+        )
+        self.max_age = max_age
+        # processes of different API accounts must not share an index
+        self.key = hashlib.sha256(account.encode("utf-8")).hexdigest()
+        self.index = None
+        self.timestamp = 0
+        self.fresh = False
+
+    @classmethod
+    def from_params(cls, manager, params, account):
+        """The resolver of a module with the server_cache and server_cache_max_age options"""
+        return cls(
+            manager,
+            params.get("server_cache"),
+            params.get("server_cache_max_age") or DEFAULT_MAX_AGE,
+            account,
+        )
+
+    def get_index(self, with_addresses=False):
+        if self.index is None or (with_addresses and self.index.addresses is None):
+            self.load(with_addresses)
+        return self.index
+
+    def load(self, with_addresses=False, refresh=False):
+        """
+        Loads the index from the cache file, or lists the servers and writes the cache.
+
+        With refresh==True the cached index is only used if another process wrote it
+        after this resolver loaded its index.
+        """
+        if not self.cache_path:
+            if self.index is not None and not refresh:
+                self.index.load_addresses(self.manager)
+            else:
+                self.use(
+                    ServerLookupIndex.fetch(self.manager, with_addresses),
+                    time.time(),
+                    True,
+                )
+            return
+
+        if not refresh and self.use_cache(self.read_cache(), with_addresses):
+            return
+
+        with self.locked():
+            data = self.read_cache()
+            newer = data is not None and data["timestamp"] > self.timestamp
+            if (newer or not refresh) and self.use_cache(data, with_addresses):
+                self.fresh = refresh
+                return
+
+            if data is not None and not refresh and data.get("addresses") is None:
+                # the servers are cached, only the IP-addresses are missing
+                index = ServerLookupIndex.from_dict(data)
+                index.load_addresses(self.manager)
+                timestamp = data["timestamp"]
+            else:
+                index = ServerLookupIndex.fetch(self.manager, with_addresses)
+                timestamp = time.time()
+
+            self.write_cache(index, timestamp)
+            self.use(index, timestamp, True)
+
+    def use(self, index, timestamp, fresh):
+        self.index = index
+        self.timestamp = timestamp
+        self.fresh = fresh
+
+    def use_cache(self, data, with_addresses):
+        if data is None or (with_addresses and data.get("addresses") is None):
+            return False
+        self.use(ServerLookupIndex.from_dict(data), data["timestamp"], False)
+        return True
+
+    def read_cache(self):
+        """Returns the cached data, or None if the cache is missing, stale or of another account."""
+        try:
+            with open(self.cache_path, "r") as cache_file:
+                data = json.load(cache_file)
+        except (IOError, OSError, ValueError):
+            return None
+
+        if not isinstance(data, dict) or data.get("key") != self.key:
+            return None
+
+        if time.time() - data.get("timestamp", 0) > self.max_age:
+            return None
+
+        return data
+
+    def write_cache(self, index, timestamp):
+        """Writes the cache atomically; call with the lock held."""
+        data = dict(index.to_dict(), key=self.key, timestamp=timestamp)
+        fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(self.cache_path),
+            prefix=".upcloud-servers-",
+            suffix=".tmp",
+        )
+        try:
+            with os.fdopen(fd, "w") as tmp_file:
+                json.dump(data, tmp_file)
+            os.replace(tmp_path, self.cache_path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+
+    def locked(self):
+        """The cache's lock file, exclusively locked until it is closed"""
+        directory = os.path.dirname(self.cache_path)
+        try:
+            os.makedirs(directory)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+
+        lock_file = open(self.cache_path + ".lock", "w")
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        return lock_file
+
+    def invalidate(self):
+        """Forgets the index and removes the cache, after a server was created or destroyed."""
+        self.index = None
+        if not self.cache_path:
+            return
+
+        with self.locked():
+            try:
+                os.unlink(self.cache_path)
+            except OSError:
+                pass
+
+    def lookup(self, find, with_addresses=False):
+        """
+        Returns find(index). A miss in a cached index is retried once in a freshly
+        listed one, since the server may have been created after the cache was written.
+        """
+        record = find(self.get_index(with_addresses))
+        if record is None and not self.fresh:
+            self.load(with_addresses, refresh=True)
+            record = find(self.index)
+        return record
+
+    def server_by_hostname(self, hostname):
+        """The server with hostname, or None. Raises ResolveError if the hostname has duplicates."""
+        return self.lookup(lambda index: index.by_hostname(hostname))
+
+    def uuid_by_hostname(self, hostname):
+        server = self.server_by_hostname(hostname)
+        if server is None:
+            raise ResolveError("No server was found with hostname: " + hostname)
+        return server.uuid
+
+    def targeted_ip_lookup(self):
+        """True if IP-addresses are better looked up one by one than listed into the index"""
+        return not self.cache_path and (
+            self.index is None or self.index.addresses is None
+        )
+
+    def lookup_ip(self, ip_address):
+        """The uuid of the server with ip_address from GET /ip_address/{ip}, or None"""
+        try:
+            ipaddress.ip_address(ip_address)
+        except ValueError:
+            return None
+        try:
+            ip = self.manager.api.get_request("/ip_address/" + ip_address)["ip_address"]
+        except UpCloudAPIError as e:
+            if e.error_code == "IP_ADDRESS_NOT_FOUND":
+                return None
+            raise
+        return ip.get("server")
+
+    def uuid_by_ip(self, ip_address):
+        if self.targeted_ip_lookup():
+            uuid = self.lookup_ip(ip_address)
+        else:
+            server = self.lookup(
+                lambda index: index.by_ip(ip_address), with_addresses=True
+            )
+            uuid = server.uuid if server else None
+        if uuid is None:
+            raise ResolveError("No server was found with IP-address: " + ip_address)
+        return uuid
+
+    def resolve(self, targets):
+        """
+        Resolves hostnames, IP-addresses and uuids to ServerRecords.
+        Returns a dict of target to server, or to an error message.
+        """
+
+        def find(target, with_addresses):
+            def find_in(index):
+                server = index.by_uuid(target) or index.by_hostname(target)
+                if server is None and with_addresses:
+                    server = index.by_ip(target)
+                return server
+
+            return self.lookup(find_in, with_addresses)
+
+        resolved = {}
+        unknown = []
+        for target in targets:
+            try:
+                server = find(target, False)
+            except ResolveError as e:
+                resolved[target] = str(e)
+                continue
+            if server is None:
+                unknown.append(target)
+            else:
+                resolved[target] = server
+
+        # the IP-addresses are only looked up for targets that are not uuids or hostnames,
+        # one by itself and more with one listing
+        targeted = len(unknown) == 1 and self.targeted_ip_lookup()
+        for target in unknown:
+            try:
+                if targeted:
+                    server = self.index.by_uuid(self.lookup_ip(target))
+                else:
+                    server = find(target, True)
+            except ResolveError as e:
+                resolved[target] = str(e)
+                continue
+            if server is None:
+                server = (
+                    "No server was found with hostname, IP-address or uuid: " + target
+                )
+            resolved[target] = server
+
+        return dict((target, resolved[target]) for target in targets)
@@ -0,0 +1,210 @@
+"""
+Rate-limit-aware scheduling of UpCloud API requests.
+
+RequestScheduler sends requests of any number of threads so that they stay under the
+account's rate limit instead of failing on it:
+
+- a TokenBucket spaces requests to a configured rate, if any
+- an AIMDLimiter bounds the number of requests in flight; it grows by one request per
+  round of successful requests and halves when the API answers 429 Too Many Requests
+- a 429 response pauses every request for its Retry-After and the request is sent again;
+  the API has not processed a throttled request, so this is safe for every method
+- GET requests are also retried on connection errors and 502, 503 and 504 responses,
+  after an exponential backoff with full jitter
+"""
+
+import time
+import random
+import threading
+from email.utils import parsedate_to_datetime
+
+import requests
+
+# statuses of GET requests that are retried besides 429
+RETRY_STATUSES = (502, 503, 504)
+
+DEFAULT_MAX_RETRIES = 5
+DEFAULT_BACKOFF = 0.5
+DEFAULT_MAX_BACKOFF = 30.0
+
+
+def parse_retry_after(value, now=None):
+    """Seconds to wait from a Retry-After header of seconds or an HTTP date, or None"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, retry_at - (time.time() if now is None else now))
+
+
+class TokenBucket:
+    """
+    Allows rate requests per second on average and bursts of up to burst requests,
+    or any number of requests if rate is None.
+    pause() stops handing out tokens for a while, such as for a Retry-After.
+    """
+
+    def __init__(self, rate=None, burst=None, clock=time.monotonic, sleep=time.sleep):
+        self.rate = float(rate) if rate else None
+        self.burst = float(burst or max(1.0, self.rate or 1.0))
+        self.clock = clock
+        self.sleep = sleep
+        self.lock = threading.Lock()
+        self.tokens = self.burst
+        self.updated = clock()
+        self.paused_until = 0.0
+
+    def wait_time(self):
+        """Takes a token if one is available and returns 0, else returns the seconds to wait"""
+        with self.lock:
+            now = self.clock()
+            if now < self.paused_until:
+                return self.paused_until - now
+            if self.rate is None:
+                return 0.0
+
+            self.tokens = min(
+                self.burst, self.tokens + max(0.0, now - self.updated) * self.rate
+            )
+            self.updated = max(self.updated, now)
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0.0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self):
+        while True:
+            delay = self.wait_time()
+            if not delay:
+                return
+            self.sleep(delay)
+
+    def pause(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until, self.clock() + seconds)
+            # tokens accrue again from the end of the pause, no burst follows it
+            self.tokens = 0.0
+            self.updated = self.paused_until
+
+
+class AIMDLimiter:
+    """
+    Concurrency limit with additive increase and multiplicative decrease: every success
+    adds 1/limit, so the limit grows by one per round of successful requests, and a
+    throttled request halves it. Other failures leave the limit as it is.
+    """
+
+    def __init__(self, initial=4, minimum=1, maximum=64):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = float(min(max(initial, minimum), maximum))
+        self.in_flight = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+
+    def release(self, throttled=False, succeeded=True):
+        with self.condition:
+            self.in_flight -= 1
+            if throttled:
+                self.limit = max(float(self.minimum), self.limit / 2)
+            elif succeeded:
+                self.limit = min(float(self.maximum), self.limit + 1 / self.limit)
+            self.condition.notify_all()
+
+
+class RequestScheduler:
+    """
+    Sends requests through a TokenBucket and an AIMDLimiter, and retries
+    throttled requests and failed GET requests (see the module docstring).
+    """
+
+    def __init__(
+        self,
+        rate=None,
+        burst=None,
+        initial_concurrency=4,
+        max_concurrency=64,
+        max_retries=DEFAULT_MAX_RETRIES,
+        backoff=DEFAULT_BACKOFF,
+        max_backoff=DEFAULT_MAX_BACKOFF,
+        sleep=time.sleep,
+        jitter=random.random,
+    ):
+        self.bucket = TokenBucket(rate, burst, sleep=sleep)
+        self.limiter = AIMDLimiter(initial_concurrency, 1, max_concurrency)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.sleep = sleep
+        self.jitter = jitter
+
+        # retries of the requests sent by the current thread, see last_retries()
+        self.local = threading.local()
+
+    def backoff_delay(self, attempt):
+        """Full jitter: a random delay up to backoff * 2^attempt, capped at max_backoff"""
+        return self.jitter() * min(self.max_backoff, self.backoff * 2 ** attempt)
+
+    def last_retries(self):
+        """The number of retries of the last request sent by this thread"""
+        return getattr(self.local, "retries", 0)
+
+    def request(self, method, send):
+        """
+        Calls send() to send a request and returns its response, after waiting for
+        a token and a concurrency slot and retrying as needed.
+        """
+        self.local.retries = 0
+        for attempt in range(self.max_retries + 1):
+            self.bucket.acquire()
+
+            self.limiter.acquire()
+            response = None
+            try:
+                response = send()
+            except (requests.ConnectionError, requests.Timeout):
+                if method != "GET" or attempt == self.max_retries:
+                    raise
+            finally:
+                throttled = response is not None and response.status_code == 429
+                self.limiter.release(
+                    throttled, response is not None and response.status_code < 500
+                )
+
+            if attempt == self.max_retries:
+                return response
+
+            if method != "GET" and not throttled:
+                return response
+
+            if response is not None and (
+                throttled or response.status_code in RETRY_STATUSES
+            ):
+                # release the connection of a response that is not returned
+                response.close()
+
+            if throttled:
+                delay = parse_retry_after(response.headers.get("Retry-After"))
+                if delay is None:
+                    delay = self.backoff_delay(attempt)
+                # every thread waits, not just this one
+                self.bucket.pause(delay)
+            elif method == "GET" and (
+                response is None or response.status_code in RETRY_STATUSES
+            ):
+                self.sleep(self.backoff_delay(attempt))
+            else:
+                return response
+
+            self.local.retries = attempt + 1
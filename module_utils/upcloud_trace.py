@@ -0,0 +1,249 @@
+"""
+Opt-in tracing of UpCloud API requests.
+
+A Tracer records a span for every request of a SessionAPI: the method, the endpoint,
+the HTTP status, the latency, the bytes sent and received and the number of retries.
+Phases of the work, such as populating the inventory or waiting for a server to start,
+are recorded as spans of their own with trace_phase(), so a slow run shows where its time goes.
+
+With the UPCLOUD_TRACE environment variable set to a path, the spans are appended to that
+file as NDJSON, one JSON object per line, followed by a summary of the run when the tracer
+is closed: call counts, totals and latency percentiles, overall and per endpoint and phase.
+The processes of a play may share the file, every line is written with a single append.
+"""
+
+import os
+import re
+import json
+import math
+import time
+import threading
+from contextlib import contextmanager
+
+TRACE_ENV = "UPCLOUD_TRACE"
+
+UUID_PATTERN = re.compile(
+    r"[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}", re.IGNORECASE
+)
+
+
+def endpoint_name(endpoint):
+    """The endpoint with uuids replaced by {uuid}, so that requests of one kind are summarised together"""
+    return UUID_PATTERN.sub("{uuid}", endpoint)
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of sorted_values, or None if there are none"""
+    if not sorted_values:
+        return None
+    rank = max(1, int(math.ceil(fraction * len(sorted_values))))
+    return sorted_values[rank - 1]
+
+
+def latency_summary(latencies):
+    """Total and p50/p95/p99 of latencies in milliseconds"""
+    values = sorted(latencies)
+    return dict(
+        total_ms=round(sum(values), 3),
+        p50_ms=percentile(values, 0.50),
+        p95_ms=percentile(values, 0.95),
+        p99_ms=percentile(values, 0.99),
+    )
+
+
+def response_size(response, streamed=False):
+    """
+    Bytes received for response: its Content-Length, which is the compressed size of a
+    gzip-compressed response, or the length of its body. None for a streamed response
+    without Content-Length, whose body is not read here.
+    """
+    length = response.headers.get("Content-Length")
+    if length is not None:
+        try:
+            return int(length)
+        except ValueError:
+            pass
+    if streamed:
+        return None
+    return len(response.content)
+
+
+class Tracer:
+    """
+    Records request and phase spans in memory, and appends them to path if given.
+    Safe to use from many threads.
+    """
+
+    def __init__(self, path=None):
+        self.path = os.path.abspath(os.path.expanduser(path)) if path else None
+        self.spans = []
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+        self.started = time.time()
+        self.closed = False
+
+    @classmethod
+    def from_env(cls, enabled=False):
+        """
+        A Tracer writing to the file in UPCLOUD_TRACE if it is set, an in-memory
+        Tracer if enabled==True, and None otherwise.
+        """
+        path = os.getenv(TRACE_ENV)
+        if path or enabled:
+            return cls(path)
+        return None
+
+    def record(self, span):
+        span = dict(span, pid=self.pid)
+        with self.lock:
+            self.spans.append(span)
+        self.write(span)
+
+    def record_request(
+        self,
+        method,
+        endpoint,
+        started,
+        latency,
+        status=None,
+        bytes_sent=0,
+        bytes_received=None,
+        retries=0,
+        error=None,
+    ):
+        """Records a request that started at the epoch time started and took latency seconds"""
+        self.record(
+            dict(
+                type="request",
+                method=method,
+                endpoint=endpoint,
+                status=status,
+                start=round(started, 6),
+                latency_ms=round(latency * 1000, 3),
+                bytes_sent=bytes_sent,
+                bytes_received=bytes_received,
+                retries=retries,
+                error=error,
+            )
+        )
+
+    @contextmanager
+    def phase(self, name):
+        """Records the time spent in the with-block as a phase span called name"""
+        started = time.time()
+        clock = time.monotonic()
+        try:
+            yield
+        finally:
+            self.record(
+                dict(
+                    type="phase",
+                    name=name,
+                    start=round(started, 6),
+                    latency_ms=round((time.monotonic() - clock) * 1000, 3),
+                )
+            )
+
+    def write(self, data):
+        if not self.path:
+            return
+        line = (json.dumps(data, sort_keys=True) + "\n").encode("utf-8")
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+
+    def summary(self):
+        """Counts, totals and latency percentiles of the spans recorded so far"""
+        with self.lock:
+            spans = list(self.spans)
+
+        requests = [span for span in spans if span["type"] == "request"]
+        endpoints = {}
+        for span in requests:
+            key = span["method"] + " " + endpoint_name(span["endpoint"])
+            endpoints.setdefault(key, []).append(span)
+        phases = {}
+        for span in spans:
+            if span["type"] == "phase":
+                phases.setdefault(span["name"], []).append(span)
+
+        def request_totals(spans):
+            totals = dict(
+                calls=len(spans),
+                errors=sum(
+                    1 for span in spans if span["error"] or (span["status"] or 0) >= 400
+                ),
+                retries=sum(span["retries"] for span in spans),
+                bytes_sent=sum(span["bytes_sent"] for span in spans),
+                bytes_received=sum(span["bytes_received"] or 0 for span in spans),
+            )
+            totals.update(latency_summary(span["latency_ms"] for span in spans))
+            return totals
+
+        summary = request_totals(requests)
+        summary.update(
+            duration_ms=round((time.time() - self.started) * 1000, 3),
+            endpoints=dict(
+                (key, request_totals(spans)) for key, spans in endpoints.items()
+            ),
+            phases=dict(
+                (
+                    name,
+                    dict(
+                        count=len(spans),
+                        **latency_summary(span["latency_ms"] for span in spans)
+                    ),
+                )
+                for name, spans in phases.items()
+            ),
+        )
+        return summary
+
+    def close(self):
+        """Appends the summary of the run to the trace file, once"""
+        if self.closed:
+            return
+        self.closed = True
+        self.write(dict(self.summary(), type="summary", pid=self.pid))
+
+
+@contextmanager
+def untraced():
+    # contextlib.nullcontext needs Python 3.7
+    yield
+
+
+def trace_phase(manager, name):
+    """The phase() of the tracer of manager's API, or a no-op if its requests are not traced"""
+    tracer = getattr(getattr(manager, "api", None), "tracer", None)
+    if tracer is None:
+        return untraced()
+    return tracer.phase(name)
+
+
+def trace_module(module):
+    """
+    The Tracer of a module run, or None if tracing is off (see Tracer.from_env).
+
+    The module's exit_json and fail_json are wrapped to close the tracer, and to add
+    the summary to the result as profile if the module's profile option is set.
+    """
+    profile = module.params.get("profile")
+    tracer = Tracer.from_env(profile)
+    if tracer is None:
+        return None
+
+    def traced(exit):
+        def traced_exit(**kwargs):
+            tracer.close()
+            if profile:
+                kwargs["profile"] = tracer.summary()
+            return exit(**kwargs)
+
+        return traced_exit
+
+    module.exit_json = traced(module.exit_json)
+    module.fail_json = traced(module.fail_json)
+    return tracer
@@ -0,0 +1,258 @@
+"""
+Waiting for UpCloud servers to change state.
+
+Creating and stopping a server happen in the background: the server is in maintenance
+until it reaches its new state. StateWatcher polls server states with exponential backoff
+and jitter, within a budget of seconds and polls. While only one server is waited for, its
+state is read from its details; while more are, the states of every server are read from one
+server listing per poll. Threads that wait for different servers at the same time share the
+listings, so a bulk task makes one request per poll instead of one per server.
+
+ensure_started() and stop_and_destroy() replace the upcloud_api.Server methods of the
+same names, which fetch the details of their one server every 10 seconds.
+"""
+
+import time
+import random
+import threading
+
+from upcloud_api.errors import UpCloudAPIError, UpCloudClientError
+
+DEFAULT_POLL_INTERVAL = 2.0
+DEFAULT_MAX_POLL_INTERVAL = 15.0
+DEFAULT_WAIT_TIMEOUT = 300
+
+
+class WaitTimeout(Exception):
+    """The servers did not reach their states within the poll budget"""
+
+
+class Backoff:
+    """
+    Delays of initial * multiplier^attempt seconds, capped at maximum, with equal jitter:
+    a delay is between half of that and all of it, so that waiters spread out but still back off.
+    """
+
+    def __init__(
+        self,
+        initial=DEFAULT_POLL_INTERVAL,
+        maximum=DEFAULT_MAX_POLL_INTERVAL,
+        multiplier=2.0,
+        jitter=random.random,
+    ):
+        self.initial = initial
+        self.maximum = max(initial, maximum)
+        self.multiplier = multiplier
+        self.jitter = jitter
+
+    def delay(self, attempt):
+        base = min(self.maximum, self.initial * self.multiplier ** attempt)
+        return base / 2 + self.jitter() * base / 2
+
+
+class StateWatcher:
+    """
+    Waits for servers to reach states (see the module docstring). Every wait() and retry()
+    gets timeout seconds and, if max_polls is given, at most max_polls polls.
+    """
+
+    def __init__(
+        self,
+        manager,
+        backoff=None,
+        timeout=DEFAULT_WAIT_TIMEOUT,
+        max_polls=None,
+        clock=time.monotonic,
+        sleep=time.sleep,
+    ):
+        self.manager = manager
+        self.backoff = backoff or Backoff()
+        self.timeout = timeout
+        self.max_polls = max_polls
+        self.clock = clock
+        self.sleep = sleep
+
+        self.lock = threading.Lock()
+        self.states = {}
+        self.listed = None
+        self.listings = 0
+        # servers pending in the waits in progress, of every thread
+        self.waiting = 0
+
+    @classmethod
+    def from_params(cls, manager, params):
+        """The watcher of a module with the poll_interval, max_poll_interval, wait_timeout and max_polls options"""
+        return cls(
+            manager,
+            Backoff(
+                params.get("poll_interval") or DEFAULT_POLL_INTERVAL,
+                params.get("max_poll_interval") or DEFAULT_MAX_POLL_INTERVAL,
+            ),
+            params.get("wait_timeout") or DEFAULT_WAIT_TIMEOUT,
+            params.get("max_polls"),
+        )
+
+    def current_states(self, since, uuids):
+        """
+        The states of servers by uuid, read at or after since (a clock time). If uuids is the
+        only server waited for, its state is fetched by itself. Otherwise lists the servers
+        unless another thread already has; threads that call this while a listing is in
+        progress wait for it and share it.
+        """
+        with self.lock:
+            alone = self.waiting == 1 and len(uuids) == 1
+        if alone:
+            return self.server_state(uuids[0])
+
+        with self.lock:
+            if self.listed is None or self.listed < since:
+                listed = self.clock()
+                servers = self.manager.api.get_request("/server")["servers"]["server"]
+                self.states = dict(
+                    (server["uuid"], server["state"]) for server in servers
+                )
+                self.listed = listed
+                self.listings += 1
+            return self.states
+
+    def server_state(self, uuid):
+        """The state of one server by uuid from its details, or {} if it no longer exists"""
+        try:
+            server = self.manager.api.get_request("/server/" + uuid)["server"]
+        except UpCloudAPIError as e:
+            if e.error_code != "SERVER_NOT_FOUND":
+                raise
+            return {}
+        return {uuid: server["state"]}
+
+    def track(self, count):
+        with self.lock:
+            self.waiting += count
+
+    def out_of_budget(self, deadline, attempt):
+        return self.clock() >= deadline or (
+            self.max_polls is not None and attempt >= self.max_polls
+        )
+
+    def wait(self, uuids, target_states):
+        """
+        Waits until every server of uuids is in one of target_states and returns a dict of
+        uuid to state. Raises if a server is in error state or no longer exists, and
+        WaitTimeout if the budget runs out first.
+        """
+        uuids = list(uuids)
+        deadline = self.clock() + self.timeout
+        attempt = 0
+        self.track(len(uuids))
+        try:
+            while True:
+                if self.out_of_budget(deadline, attempt):
+                    raise WaitTimeout(
+                        "Servers did not reach state {} within {} seconds and {} polls: {}".format(
+                            " or ".join(target_states),
+                            self.timeout,
+                            attempt,
+                            ", ".join(uuids),
+                        )
+                    )
+
+                slept = self.clock()
+                self.sleep(min(self.backoff.delay(attempt), max(0.0, deadline - slept)))
+                states = self.current_states(slept, uuids)
+                attempt += 1
+
+                pending = []
+                for uuid in uuids:
+                    state = states.get(uuid)
+                    if state is None:
+                        raise Exception("server no longer exists: " + uuid)
+                    if state in target_states:
+                        continue
+                    if state == "error":
+                        raise Exception("server is in error state")
+                    pending.append(uuid)
+
+                if not pending:
+                    return dict((uuid, states[uuid]) for uuid in uuids)
+                self.track(len(pending) - len(uuids))
+                uuids = pending
+        finally:
+            self.track(-len(uuids))
+
+    def retry(self, operation, expected_error_codes, custom_error="operation failed"):
+        """
+        Calls operation until it does not fail with one of expected_error_codes, backing off
+        between the attempts. Raises UpCloudClientError(custom_error) if the budget runs out.
+        """
+        deadline = self.clock() + self.timeout
+        attempt = 0
+        while True:
+            try:
+                return operation()
+            except UpCloudAPIError as e:
+                if e.error_code not in expected_error_codes:
+                    raise
+            attempt += 1
+            if self.out_of_budget(deadline, attempt):
+                raise UpCloudClientError(custom_error)
+            self.sleep(self.backoff.delay(attempt - 1))
+
+
+def set_state(server, state):
+    # upcloud_api.Server forbids setting attributes that are not updateable
+    object.__setattr__(server, "state", state)
+
+
+def ensure_started(server, watcher):
+    """Starts a server and waits until it is started, like upcloud_api's Server.ensure_started()"""
+    state = server.state
+    if state == "error":
+        raise Exception("server is in error state")
+
+    # server is either starting or stopping
+    if state == "maintenance":
+        state = watcher.wait([server.uuid], ("stopped", "started"))[server.uuid]
+        set_state(server, state)
+
+    if state == "stopped":
+        # the API responds once the server has started
+        server.start()
+        state = server.state
+
+    if state != "started":
+        # something went wrong, fail explicitly
+        raise Exception("unknown server state: " + state)
+    return True
+
+
+def stop_and_destroy(server, watcher, sync=True):
+    """
+    Stops a server and destroys it and its storages, like upcloud_api's
+    Server.stop_and_destroy(). Syncs the server from the API, unless sync==False.
+    """
+    if sync:
+        server.populate()
+
+    state = server.state
+    if state == "error":
+        raise Exception("server is in error state")
+
+    # server is either starting or stopping
+    if state == "maintenance":
+        state = watcher.wait([server.uuid], ("stopped", "started"))[server.uuid]
+
+    if state == "started":
+        watcher.retry(server.stop, ["SERVER_STATE_ILLEGAL"], "stopping server failed")
+        state = watcher.wait([server.uuid], ("stopped",))[server.uuid]
+    set_state(server, state)
+
+    if state != "stopped":
+        raise Exception("unknown server state: " + state)
+
+    watcher.retry(server.destroy, ["SERVER_STATE_ILLEGAL"], "destroying server failed")
+
+    # storages may be deleted right after the server
+    for storage in server.storage_devices:
+        watcher.retry(
+            storage.destroy, ["STORAGE_STATE_ILLEGAL"], "destroying storage failed"
+        )
@@ -19,7 +19,8 @@
 from six.moves import configparser
 import os
 import sys
-from ansible.module_utils.basic import AnsibleModule
+from concurrent.futures import ThreadPoolExecutor
+from ansible.module_utils.basic import AnsibleModule, env_fallback
 from distutils.version import LooseVersion
 
 DOCUMENTATION = """
@@ -29,6 +30,8 @@ module: upcloud
 short_description: Create/delete a server in UpCloud
 description:
     - Create/delete a server in UpCloud or ensure that an existing server is started
+    - Many servers can be managed in one task with C(servers) or C(count); they are
+      created, started or destroyed concurrently and the task returns a result per server
 author: "Elias Nygren (@elnygren)"
 options:
     state:
@@ -110,6 +113,59 @@ options:
         description:
         - Optional list of strings. SSH keys that should be added to the given user.
         - When user and ssh_keys are being used, no password is delivered in API response.
+    servers:
+        description:
+        - Optional array of server dicts for managing many servers in one task.
+        - Every dict takes the same options as the module (hostname, uuid, title, plan, ...);
+          options given to the task itself are used as defaults for every server.
+    count:
+        description:
+        - Optional integer. Number of servers to manage in one task.
+        - hostname (and title, if given) are templates where {index} is replaced with
+          the index of the server, e.g. C(web{index}.example.com).
+    start_index:
+        description:
+        - Integer. First {index} used with count.
+        default: 1
+    workers:
+        description:
+        - Integer. Maximum number of servers created, started or destroyed concurrently
+          when using servers or count.
+        default: 10
+    server_cache:
+        description:
+        - Path of a file where the hostnames, IP-addresses and uuids of the servers are cached,
+          so that the forks of a play list the servers once instead of once per host.
+        - Can be set with the UPCLOUD_SERVER_CACHE environment variable.
+    server_cache_max_age:
+        description:
+        - Seconds the cached servers are used. Modules that create or destroy servers clear the cache.
+        default: 60
+    poll_interval:
+        description:
+        - Seconds before the first poll of a server's state while waiting for it to start or stop.
+          The interval doubles, with jitter, after every poll up to max_poll_interval.
+        default: 2
+    max_poll_interval:
+        description:
+        - Maximum seconds between polls of servers' states.
+        default: 15
+    wait_timeout:
+        description:
+        - Seconds to wait for a server to start or stop before failing.
+        default: 300
+    max_polls:
+        description:
+        - Optional integer. Maximum number of polls of one wait for a server to start or stop;
+          the task fails if the server has not reached its state by then.
+        - Bulk tasks read the states of all the servers they wait for from one server listing per poll.
+    profile:
+        description:
+        - Bool. Add a summary of the task's API requests to the result as C(profile) - call counts,
+          bytes, retries and latency percentiles, overall, per endpoint and per phase of the task.
+        - Set the UPCLOUD_TRACE environment variable to a file path to also append every request
+          to that file as NDJSON.
+        default: no
 notes:
     - UPCLOUD_API_USER and UPCLOUD_API_PASSWD environment variables may be used instead of api_user and api_passwd
     - Better description of UpCloud's API available at U(www.upcloud.com/api/)
@@ -152,14 +208,78 @@ EXAMPLES = """
     state: absent
     uuid: "{{ upcloud_server.server.uuid }}"
 
+# Create web1.example.com ... web20.example.com, 10 at a time.
+# upcloud_cluster.servers contains a result (uuid, public_ip, server, ...) per server.
+- name: Create a cluster
+  upcloud:
+    state: present
+    count: 20
+    hostname: "web{index}.example.com"
+    title: "web{index}.example.com"
+    zone: uk-lon1
+    plan: 1xCPU-1GB
+    storage_devices:
+        - { size: 30, os: Ubuntu 14.04 }
+    workers: 10
+  register: upcloud_cluster
+
+# Servers of a bulk task may differ from each other
+- name: Create database servers
+  upcloud:
+    state: present
+    zone: uk-lon1
+    storage_devices:
+        - { size: 30, os: Ubuntu 14.04 }
+    servers:
+        - { hostname: db1.example.com, title: db1.example.com, plan: 2xCPU-4GB }
+        - { hostname: db2.example.com, title: db2.example.com, plan: 2xCPU-4GB, zone: de-fra1 }
+
 """
 
 
+# parameters of bulk tasks that are not server attributes
+BULK_KEYS = set(["servers", "count", "start_index", "workers"])
+
+# parameters of the server lookup that are not server attributes
+RESOLVER_KEYS = set(["server_cache", "server_cache_max_age"])
+
+# parameters of the waits for server state changes that are not server attributes
+WAIT_KEYS = set(["poll_interval", "max_poll_interval", "wait_timeout", "max_polls"])
+
 # make sure that upcloud-api is installed
 HAS_UPCLOUD = True
 try:
     import upcloud_api
-    from upcloud_api import CloudManager
+
+    try:
+        from ansible.module_utils.upcloud_client import (
+            create_cloud_manager,
+            DEFAULT_POOL_SIZE,
+        )
+        from ansible.module_utils.upcloud_resolver import (
+            DUPLICATE_HOSTNAME,
+            ResolveError,
+            ServerResolver,
+        )
+        from ansible.module_utils.upcloud_trace import trace_module, trace_phase
+        from ansible.module_utils.upcloud_wait import (
+            StateWatcher,
+            ensure_started,
+            stop_and_destroy,
+        )
+    except ImportError:
+        from module_utils.upcloud_client import create_cloud_manager, DEFAULT_POOL_SIZE
+        from module_utils.upcloud_resolver import (
+            DUPLICATE_HOSTNAME,
+            ResolveError,
+            ServerResolver,
+        )
+        from module_utils.upcloud_trace import trace_module, trace_phase
+        from module_utils.upcloud_wait import (
+            StateWatcher,
+            ensure_started,
+            stop_and_destroy,
+        )
 
 except ImportError:
     HAS_UPCLOUD = False
@@ -169,8 +289,18 @@ class ServerManager:
     """Helpers for managing upcloud.Server instance"""
 
     def __init__(self, api_user, api_passwd, default_timeout, module):
-        self.manager = CloudManager(api_user, api_passwd, default_timeout)
+        self.manager = create_cloud_manager(
+            api_user,
+            api_passwd,
+            default_timeout,
+            pool_size=max(DEFAULT_POOL_SIZE, module.params.get("workers") or 0),
+            tracer=trace_module(module),
+        )
         self.module = module
+        self.resolver = ServerResolver.from_params(
+            self.manager, module.params, api_user
+        )
+        self.watcher = StateWatcher.from_params(self.manager, module.params)
 
     def find_server(self, uuid, hostname):
         """
@@ -189,22 +319,64 @@ class ServerManager:
 
         # try with hostname, if given and nothing was found with uuid
         if hostname:
-            servers = self.manager.get_servers()
+            try:
+                found_server = self.resolver.server_by_hostname(hostname)
+            except ResolveError as e:
+                self.module.fail_json(msg=str(e))
+
+            if found_server:
+                try:
+                    return self.manager.get_server(found_server.uuid)
+                except Exception:
+                    if self.resolver.fresh:
+                        raise
+
+                # destroyed after the servers were cached
+                self.resolver.invalidate()
+                found_server = self.resolver.server_by_hostname(hostname)
+                if found_server:
+                    return self.manager.get_server(found_server.uuid)
 
-            found_servers = []
-            for server in servers:
-                if server.hostname == hostname:
-                    found_servers.append(server)
+        return None
 
-            if len(found_servers) > 1:
-                self.module.fail_json(
-                    msg="More than one server matched the given hostname. Please use unique hostnames."
-                )
+    def index_servers_by_hostname(self, hostnames):
+        """
+        The resolver's servers by hostname, listed once and shared through its cache.
+        A cached index that misses one of hostnames is listed again, since the server
+        may have been created after the cache was written.
+        """
 
-            if len(found_servers) == 1:
-                return found_servers[0]
+        def has_hostnames(index):
+            if all(hostname in index.hostnames for hostname in hostnames):
+                return index
+            return None
 
-        return None
+        self.resolver.lookup(has_hostnames)
+        return self.resolver.index.hostnames
+
+    def find_bulk_server(self, uuid, hostname, servers_by_hostname):
+        """
+        find_server() for bulk tasks: hostnames are looked up in servers_by_hostname,
+        and duplicates raise an exception that fails only this server.
+        """
+        if uuid:
+            try:
+                return self.manager.get_server(uuid)
+            except Exception:
+                pass  # no server found
+
+        found_servers = servers_by_hostname.get(hostname, []) if hostname else []
+        if len(found_servers) > 1:
+            raise ResolveError(DUPLICATE_HOSTNAME)
+        if not found_servers:
+            return None
+
+        try:
+            return self.manager.get_server(found_servers[0].uuid)
+        except Exception:
+            if self.resolver.fresh:
+                raise
+            return None  # destroyed after the servers were cached
 
     def create_server(self, module_params):
         """Create a server from module parameters. Filters out unwanted attributes."""
@@ -212,7 +384,12 @@ class ServerManager:
         # filter out 'filter_keys' and those who equal None from items to get
         # server's attributes for POST request
         items = module_params.items()
-        filter_keys = set(["state", "api_user", "api_passwd", "user", "ssh_keys"])
+        filter_keys = (
+            set(["state", "api_user", "api_passwd", "user", "ssh_keys", "profile"])
+            | BULK_KEYS
+            | RESOLVER_KEYS
+            | WAIT_KEYS
+        )
         server_dict = dict(
             (key, value)
             for key, value in items
@@ -238,6 +415,118 @@ def return_error_msg_due_to_faulty_ini_file(missing_variable):
     sys.exit(-1)
 
 
+def expand_bulk_servers(params):
+    """
+    Returns the server parameters of a bulk task: every item of servers, or count servers
+    whose hostname and title templates are formatted with their index. The task's own
+    parameters are the defaults of every server.
+    """
+    defaults = dict(
+        (key, value)
+        for key, value in params.items()
+        if key not in BULK_KEYS and key != "uuid" and value is not None
+    )
+
+    if params.get("servers"):
+        return [dict(defaults, **server) for server in params["servers"]]
+
+    servers = []
+    for index in range(params["start_index"], params["start_index"] + params["count"]):
+        server = dict(defaults)
+        for key in ("hostname", "title"):
+            if server.get(key):
+                server[key] = server[key].format(index=index)
+        servers.append(server)
+    return servers
+
+
+def run_bulk(module, server_manager, default_ipv_version):
+    """create/destroy/start many servers concurrently and exit with a result per server"""
+
+    state = module.params["state"]
+
+    try:
+        servers = expand_bulk_servers(module.params)
+        # the hostname template only applies to servers created with count
+        count = 0 if module.params.get("servers") else module.params.get("count") or 0
+        hostname = module.params.get("hostname") or ""
+        same_hostname = count > 1 and hostname.format(index=1) == hostname.format(
+            index=2
+        )
+    except (KeyError, IndexError, ValueError) as e:
+        module.fail_json(msg="Invalid hostname or title template: " + str(e))
+
+    if same_hostname:
+        module.fail_json(
+            msg="hostname must contain {index} when count is greater than 1"
+        )
+
+    hostnames = [server.get("hostname") for server in servers if server.get("hostname")]
+    duplicates = sorted(set(h for h in hostnames if hostnames.count(h) > 1))
+    if duplicates:
+        module.fail_json(msg="Duplicate hostnames in servers: " + ", ".join(duplicates))
+
+    for server in servers:
+        if not server.get("uuid") and not server.get("hostname"):
+            module.fail_json(msg="Every server needs a uuid or a hostname.")
+
+    # one listing for every hostname lookup instead of one per server
+    servers_by_hostname = server_manager.index_servers_by_hostname(hostnames)
+
+    def ensure_state(params):
+        result = dict(
+            hostname=params.get("hostname"), uuid=params.get("uuid"), changed=False
+        )
+        try:
+            server = server_manager.find_bulk_server(
+                params.get("uuid"), params.get("hostname"), servers_by_hostname
+            )
+
+            if state == "present":
+                if not server:
+                    server = server_manager.create_server(params)
+                    result["changed"] = True
+                elif server.state != "started":
+                    result["changed"] = True
+
+                with trace_phase(server_manager.manager, "ensure_started"):
+                    ensure_started(server, server_manager.watcher)
+                result.update(
+                    hostname=server.hostname,
+                    uuid=server.uuid,
+                    server=server.to_dict(),
+                    public_ip=server.get_public_ip(addr_family=default_ipv_version),
+                )
+
+            elif server:
+                with trace_phase(server_manager.manager, "stop_and_destroy"):
+                    stop_and_destroy(server, server_manager.watcher)
+                result.update(hostname=server.hostname, uuid=server.uuid, changed=True)
+
+        except Exception as e:
+            result.update(failed=True, msg=str(e))
+
+        return result
+
+    # every worker waits for its own server, so the task takes as long as the slowest server;
+    # the workers share one server listing per poll
+    with ThreadPoolExecutor(max_workers=max(1, module.params["workers"])) as executor:
+        results = list(executor.map(ensure_state, servers))
+
+    changed = any(result["changed"] for result in results)
+    if changed:
+        server_manager.resolver.invalidate()
+    failed = [result for result in results if result.get("failed")]
+    if failed:
+        module.fail_json(
+            msg="{} of {} servers failed".format(len(failed), len(results)),
+            changed=changed,
+            servers=results,
+        )
+
+    module.exit_json(changed=changed, servers=results)
+
+
 def run(module, server_manager):
     """create/destroy/start server based on its current state and desired state"""
 
@@ -249,6 +538,9 @@ def run(module, server_manager):
     else:
         return_error_msg_due_to_faulty_ini_file("default_ipv_version")
 
+    if module.params.get("servers") or module.params.get("count") is not None:
+        run_bulk(module, server_manager, default_ipv_version)
+
     state = module.params["state"]
     uuid = module.params.get("uuid")
     hostname = module.params.get("hostname")
@@ -261,11 +553,13 @@ def run(module, server_manager):
         if not server:
             # create server, if one was not found
             server = server_manager.create_server(module.params)
+            server_manager.resolver.invalidate()
         else:
             if server.state == "started":
                 changed = False
 
-        server.ensure_started()
+        with trace_phase(server_manager.manager, "ensure_started"):
+            ensure_started(server, server_manager.watcher)
 
         module.exit_json(
             changed=changed,
@@ -277,7 +571,9 @@ def run(module, server_manager):
         server = server_manager.find_server(uuid, hostname)
 
         if server:
-            server.stop_and_destroy()
+            with trace_phase(server_manager.manager, "stop_and_destroy"):
+                stop_and_destroy(server, server_manager.watcher)
+            server_manager.resolver.invalidate()
             module.exit_json(changed=True, msg="destroyed" + server.hostname)
 
         module.exit_json(
@@ -317,13 +613,34 @@ def main():
             nic_model=dict(type="str"),
             boot_order=dict(type="str"),
             avoid_host=dict(type="str"),
+            # bulk mode
+            servers=dict(type="list", elements="dict"),
+            count=dict(type="int"),
+            start_index=dict(type="int", default=1),
+            workers=dict(type="int", default=10),
+            server_cache=dict(
+                type="path", fallback=(env_fallback, ["UPCLOUD_SERVER_CACHE"])
+            ),
+            server_cache_max_age=dict(type="int", default=60),
+            poll_interval=dict(type="float", default=2.0),
+            max_poll_interval=dict(type="float", default=15.0),
+            wait_timeout=dict(type="int", default=300),
+            max_polls=dict(type="int"),
+            profile=dict(type="bool", default=False),
         ),
         required_together=(
             ["core_number", "memory_amount"],
             ["api_user", "api_passwd"],
         ),
-        mutually_exclusive=(["plan", "core_number"], ["plan", "memory_amount"]),
-        required_one_of=(["uuid", "hostname"],),
+        mutually_exclusive=(
+            ["plan", "core_number"],
+            ["plan", "memory_amount"],
+            ["servers", "count"],
+            ["servers", "uuid"],
+            ["count", "uuid"],
+        ),
+        required_one_of=(["uuid", "hostname", "servers"],),
+        required_by={"count": "hostname"},
     )
 
     # ensure dependencies and API credentials are in place
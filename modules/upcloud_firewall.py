@@ -17,8 +17,15 @@
 # along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
-from upcloud_api.errors import UpCloudAPIError
-from ansible.module_utils.basic import AnsibleModule
+import json
+import time
+import fcntl
+import hashlib
+import tempfile
+import threading
+import ipaddress
+from concurrent.futures import ThreadPoolExecutor
+from ansible.module_utils.basic import AnsibleModule, env_fallback
 from distutils.version import LooseVersion
 
 DOCUMENTATION = """
@@ -31,9 +38,15 @@ description:
 author: "Elias Nygren (@elnygren)"
 options:
     state:
-        description: Desired state of the tags.
+        description:
+        - Desired state of the firewall rules.
+        - present creates the given rules that do not match an existing rule.
+        - absent deletes every existing rule that matches a given rule.
+        - exact makes the given rules, in the given order, the only firewall rules of the server.
+          Missing fields are empty, not wildcards. If the rules differ, all of them are
+          replaced in a single request.
         default: 'present'
-        choices: ['present', 'absent']
+        choices: ['present', 'absent', 'exact']
     api_user:
         description:
         - UpCloud API username. Can be set as environment variable.
@@ -49,10 +62,73 @@ options:
     uuid:
         description:
         - UUID of the target server to be (un)tagged. Hostname, IP-address or uuid is needed.
+    uuids:
+        description:
+        - List of UUIDs of target servers. Selects many servers instead of one; a UUID that matches no server fails.
+    tags:
+        description:
+        - List of tags. Selects every server that has all of the given tags.
+    zone:
+        description:
+        - Zone. Selects every server in the given zone.
+        - When uuids, tags and zone are combined, a server must match all of them.
+    targets:
+        description:
+        - List of hostnames, IP-addresses or uuids of target servers. Selects many servers
+          instead of one, and the result of every server has the target it was given as.
+        - Can not be combined with uuids, tags or zone.
+    workers:
+        description:
+        - Maximum number of selected servers reconciled concurrently.
+        default: 10
+    compact:
+        description:
+        - Bool. Merge the given rules into fewer rules before applying them, with state present or exact.
+        - Only consecutive rules with the same direction, action, family, protocol and icmp_type
+          are merged, so rules are still evaluated in the same order with the same outcome.
+        - Duplicate rules (that may differ in comment) become one rule, and rules that differ only
+          in one address or port range are merged if their ranges overlap or are adjacent.
+        - A merged rule keeps the comment of its first rule.
+        default: no
+    fingerprint_file:
+        description:
+        - Optional path of a local JSON file that records, per server, a fingerprint of the
+          firewall_rules and state last applied to it successfully.
+        - A server whose recorded fingerprint equals the fingerprint of this task and is newer
+          than fingerprint_max_age is skipped without fetching its rules.
+        - Changes made to the rules outside of this module are not noticed until the
+          recorded fingerprint expires.
+    fingerprint_max_age:
+        description:
+        - Seconds a recorded fingerprint is trusted.
+        default: 86400
+    server_cache:
+        description:
+        - Path of a file where the hostnames, IP-addresses and uuids of the servers are cached,
+          so that the forks of a play list the servers once instead of once per host.
+        - Can be set with the UPCLOUD_SERVER_CACHE environment variable.
+    server_cache_max_age:
+        description:
+        - Seconds the cached servers are used. Modules that create or destroy servers clear the cache.
+        default: 60
+    profile:
+        description:
+        - Bool. Add a summary of the task's API requests to the result as C(profile) - call counts,
+          bytes, retries and latency percentiles, overall, per endpoint and per phase of the task.
+        - Set the UPCLOUD_TRACE environment variable to a file path to also append every request
+          to that file as NDJSON.
+        default: no
     firewall_rules:
         description:
         - List of firewall rules (strings)
 notes:
+    - With the action plugin in action_plugins/, C(batch: true) runs the task of every host in the
+      play batch as one bulk task.
+    - With uuids, tags or zone the task returns C(servers), a result (uuid, hostname, changed,
+      compliant, failed, msg) per selected server, and C(summary) with the numbers of selected,
+      changed, compliant and failed servers. The task fails if any server failed.
+    - Servers skipped because of fingerprint_file are reported as compliant.
+    - fingerprint_file is read and written on the host that runs the module.
     - UPCLOUD_API_USER and UPCLOUD_API_PASSWD environment variables may be used instead of api_user and api_passwd
     - Better description of UpCloud's API available at U(www.upcloud.com/api/)
 requirements:
@@ -126,13 +202,458 @@ EXAMPLES = """
     hostname: www13.example.com
     firewall_rules:
       - direction: in
+
+# Roll out a policy to every web server in uk-lon1, 20 servers at a time
+
+- name: open https on web servers
+  upcloud_firewall:
+    state: present
+    tags: [webservers]
+    zone: uk-lon1
+    workers: 20
+    firewall_rules:
+      - direction: in
+        family: IPv4
+        protocol: tcp
+        destination_port_start: 443
+        destination_port_end: 443
+        action: accept
+  register: rollout
+
+# Nightly compliance run: servers that got this exact policy from an earlier run
+# in the last 24 hours are not queried again
+
+- name: enforce the firewall policy on all servers
+  upcloud_firewall:
+    state: exact
+    zone: uk-lon1
+    fingerprint_file: ~/.ansible/upcloud-firewall-fingerprints.json
+    fingerprint_max_age: 86400
+    firewall_rules: "{{ firewall_policy }}"
+
+# Generated policies are compacted before they are applied: these two rules
+# are applied as one rule for ports 8000-8100
+
+- name: open the application ports
+  upcloud_firewall:
+    state: present
+    hostname: www13.example.com
+    compact: yes
+    firewall_rules:
+      - { direction: in, family: IPv4, protocol: tcp, destination_port_start: 8000, destination_port_end: 8050, action: accept }
+      - { direction: in, family: IPv4, protocol: tcp, destination_port_start: 8051, destination_port_end: 8100, action: accept }
+
+# Make these rules, in this order, the whole rule set of the server.
+# If anything differs, the rule set is replaced in one request.
+
+- name: enforce the firewall policy
+  upcloud_firewall:
+    state: exact
+    hostname: www13.example.com
+    firewall_rules:
+      - direction: in
+        family: IPv4
+        protocol: tcp
+        destination_port_start: 22
+        destination_port_end: 22
+        action: accept
+
+      - direction: in
+        action: drop
 """
 
 
+# parameters that select many servers instead of one
+SELECTORS = ["uuids", "tags", "zone", "targets"]
+
+# the fields of a firewall rule, in the order of canonical rule keys
+FIREWALL_RULE_FIELDS = [
+    "position",
+    "direction",
+    "action",
+    "family",
+    "protocol",
+    "icmp_type",
+    "source_address_start",
+    "source_address_end",
+    "source_port_start",
+    "source_port_end",
+    "destination_address_start",
+    "destination_address_end",
+    "destination_port_start",
+    "destination_port_end",
+    "comment",
+]
+
+CASE_INSENSITIVE_FIELDS = set(["direction", "action", "family", "protocol"])
+NUMERIC_FIELDS = set(
+    [
+        "position",
+        "icmp_type",
+        "source_port_start",
+        "source_port_end",
+        "destination_port_start",
+        "destination_port_end",
+    ]
+)
+ADDRESS_FIELDS = set(
+    [
+        "source_address_start",
+        "source_address_end",
+        "destination_address_start",
+        "destination_address_end",
+    ]
+)
+
+
+def canonical_value(field, value):
+    """
+    Returns the canonical string form of a firewall rule field, so that equivalent values
+    compare equal: None, "" and a missing field are all "", numbers lose leading zeros,
+    addresses are compressed and direction/action/family/protocol are lowercase.
+    """
+    if value is None:
+        return ""
+
+    value = str(value).strip()
+    if field in CASE_INSENSITIVE_FIELDS:
+        return value.lower()
+    if field in NUMERIC_FIELDS and value.isdigit():
+        return str(int(value))
+    if field in ADDRESS_FIELDS and value:
+        try:
+            return str(ipaddress.ip_address(value))
+        except ValueError:
+            return value.lower()
+    return value
+
+
+def rule_value(rule, field):
+    """Value of field in a rule given as a dict or as an upcloud_api.FirewallRule"""
+    if isinstance(rule, dict):
+        return rule.get(field)
+    return getattr(rule, field, None)
+
+
+def canonical_rule(rule, fields):
+    """Canonical key of rule for the given fields"""
+    return tuple(canonical_value(field, rule_value(rule, field)) for field in fields)
+
+
+def rule_fields(given_rule):
+    """The fields a given rule constrains, in canonical order"""
+    return tuple(
+        [field for field in FIREWALL_RULE_FIELDS if field in given_rule]
+        + sorted(field for field in given_rule if field not in FIREWALL_RULE_FIELDS)
+    )
+
+
+# the fields compared by state: exact, where the position follows from the order of the rules
+EXACT_RULE_FIELDS = [field for field in FIREWALL_RULE_FIELDS if field != "position"]
+
+
+def rules_differ(given_rules, host_rules):
+    """True if the ordered given_rules are not exactly the host_rules"""
+    if len(given_rules) != len(host_rules):
+        return True
+    return any(
+        canonical_rule(given_rule, EXACT_RULE_FIELDS)
+        != canonical_rule(host_rule, EXACT_RULE_FIELDS)
+        for given_rule, host_rule in zip(given_rules, host_rules)
+    )
+
+
+# the fields that must be equal for consecutive rules to be merged
+COMPACT_RUN_FIELDS = ["direction", "action", "family", "protocol", "icmp_type"]
+
+# the address and port ranges of a rule, which compaction coalesces
+RANGE_FIELDS = [
+    ("source_address_start", "source_address_end"),
+    ("source_port_start", "source_port_end"),
+    ("destination_address_start", "destination_address_end"),
+    ("destination_port_start", "destination_port_end"),
+]
+
+
+def rule_range(rule, fields):
+    """
+    The (first, last) integer range of one address or port range of a rule,
+    or None if the rule does not limit it. A range with only a start is a single value.
+    Raises ValueError for values that cannot be compared as integers.
+    """
+    start_field, end_field = fields
+    start = canonical_value(start_field, rule_value(rule, start_field))
+    end = canonical_value(end_field, rule_value(rule, end_field)) or start
+    if not start:
+        if end:
+            raise ValueError("range without a start")
+        return None
+
+    if start_field in ADDRESS_FIELDS:
+        # addresses are only comparable within the rule's family
+        version = {"ipv4": 4, "ipv6": 6}.get(
+            canonical_value("family", rule_value(rule, "family"))
+        )
+        first, last = ipaddress.ip_address(start), ipaddress.ip_address(end)
+        if first.version != version or last.version != version:
+            raise ValueError("address does not match the family of the rule")
+        return int(first), int(last)
+    return int(start), int(end)
+
+
+def merge_ranges(ranges):
+    """Coalesces overlapping and adjacent (first, last) ranges into the fewest ranges"""
+    merged = []
+    for first, last in sorted(ranges):
+        if merged and first <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], last))
+        else:
+            merged.append((first, last))
+    return merged
+
+
+def compact_run(rules):
+    """
+    Merges the rules of one run of consecutive rules with equal COMPACT_RUN_FIELDS.
+    Rules are merged while some of them are equal in all but one range and the union
+    of that range is contiguous. The rules of a run share one action, so their order
+    within the run does not change which packets they accept or drop.
+    """
+    # items are [order, ranges, rule]; order is the position of the first merged rule
+    items = []
+    for order, rule in enumerate(rules):
+        try:
+            ranges = tuple(rule_range(rule, fields) for fields in RANGE_FIELDS)
+        except ValueError:
+            ranges = None
+        items.append([order, ranges, rule])
+
+    mergeable = [item for item in items if item[1] is not None]
+    kept = [item for item in items if item[1] is None]
+
+    merged_any = True
+    while merged_any:
+        merged_any = False
+        for dimension in range(len(RANGE_FIELDS)):
+            groups = {}
+            for item in mergeable:
+                others = item[1][:dimension] + item[1][dimension + 1 :]
+                groups.setdefault(others, []).append(item)
+
+            mergeable = []
+            for group in groups.values():
+                group.sort(key=lambda item: item[0])
+                values = [item[1][dimension] for item in group]
+
+                if all(value is None for value in values):
+                    merged_ranges = [None]
+                elif any(value is None for value in values):
+                    mergeable.extend(group)
+                    continue
+                else:
+                    merged_ranges = merge_ranges(values)
+
+                if len(merged_ranges) == len(group):
+                    mergeable.extend(group)
+                    continue
+
+                merged_any = True
+                for merged_range in merged_ranges:
+                    members = [
+                        item
+                        for item in group
+                        if merged_range is None
+                        or merged_range[0] <= item[1][dimension][0] <= merged_range[1]
+                    ]
+                    first = members[0]
+                    ranges = (
+                        first[1][:dimension]
+                        + (merged_range,)
+                        + first[1][dimension + 1 :]
+                    )
+                    mergeable.append([first[0], ranges, first[2]])
+
+    compacted = []
+    for order, ranges, rule in sorted(kept + mergeable, key=lambda item: item[0]):
+        if ranges is not None:
+            rule = range_rule(rule, ranges)
+        compacted.append(rule)
+    return compacted
+
+
+def range_rule(rule, ranges):
+    """A copy of rule (without position) with the given address and port ranges"""
+    rule = dict((field, value) for field, value in rule.items() if field != "position")
+    ipv6 = canonical_value("family", rule_value(rule, "family")) == "ipv6"
+
+    for fields, field_range in zip(RANGE_FIELDS, ranges):
+        if field_range is None:
+            continue
+        for field, value in zip(fields, field_range):
+            if field in ADDRESS_FIELDS:
+                address = (
+                    ipaddress.IPv6Address(value)
+                    if ipv6
+                    else ipaddress.IPv4Address(value)
+                )
+                rule[field] = str(address)
+            else:
+                rule[field] = str(value)
+    return rule
+
+
+def compact_firewall_rules(firewall_rules):
+    """
+    Returns an equivalent, shorter list of firewall rules. Only runs of consecutive rules
+    with equal direction, action, family, protocol and icmp_type are merged, so the
+    evaluation order of the rules is preserved.
+    """
+    compacted = []
+    run = []
+    run_key = None
+    for rule in firewall_rules:
+        key = canonical_rule(rule, COMPACT_RUN_FIELDS)
+        if run and key != run_key:
+            compacted.extend(compact_run(run))
+            run = []
+        run.append(rule)
+        run_key = key
+
+    if run:
+        compacted.extend(compact_run(run))
+    return compacted
+
+
+def rules_fingerprint(state, firewall_rules):
+    """
+    Stable fingerprint of the desired state and firewall_rules. Equivalent rule sets
+    get the same fingerprint; the order of the rules only counts for state: exact.
+    """
+    if state == "exact":
+        rules = [canonical_rule(rule, EXACT_RULE_FIELDS) for rule in firewall_rules]
+    else:
+        rules = sorted(
+            [rule_fields(rule), canonical_rule(rule, rule_fields(rule))]
+            for rule in firewall_rules
+        )
+    payload = json.dumps([state, rules], sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class FingerprintStore:
+    """
+    Local JSON file of the rule set fingerprints last applied to servers.
+
+    The file is read once per task. Fingerprints recorded during the task are merged into
+    the file in one update under an exclusive lock, so concurrent tasks and forks
+    writing the same file do not lose each other's records.
+    """
+
+    def __init__(self, path, max_age):
+        self.path = os.path.abspath(os.path.expanduser(path))
+        self.max_age = max_age
+        self.servers = self.read()
+        self.recorded = {}
+        self.lock = threading.Lock()
+
+    def read(self):
+        try:
+            with open(self.path, "r") as fingerprint_file:
+                servers = json.load(fingerprint_file).get("servers", {})
+        except (IOError, OSError, ValueError, AttributeError):
+            return {}
+        return servers if isinstance(servers, dict) else {}
+
+    def is_current(self, uuid, fingerprint):
+        """True if fingerprint was applied to the server less than max_age seconds ago"""
+        record = self.servers.get(uuid) or {}
+        return (
+            record.get("fingerprint") == fingerprint
+            and time.time() - record.get("time", 0) <= self.max_age
+        )
+
+    def record(self, uuid, fingerprint):
+        with self.lock:
+            self.recorded[uuid] = {"fingerprint": fingerprint, "time": time.time()}
+
+    def save(self):
+        """Merges the recorded fingerprints into the file atomically."""
+        if not self.recorded:
+            return
+
+        directory = os.path.dirname(self.path)
+        try:
+            os.makedirs(directory)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+
+        with open(self.path + ".lock", "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            servers = self.read()
+            servers.update(self.recorded)
+
+            fd, tmp_path = tempfile.mkstemp(
+                dir=directory, prefix=".upcloud-firewall-", suffix=".tmp"
+            )
+            try:
+                with os.fdopen(fd, "w") as tmp_file:
+                    json.dump({"servers": servers}, tmp_file)
+                os.replace(tmp_path, self.path)
+            except Exception:
+                os.unlink(tmp_path)
+                raise
+
+
+class FirewallRuleIndex:
+    """
+    Hash index of host rules by their canonical keys.
+
+    A given rule matches every host rule that has equal canonical values in the fields
+    the given rule specifies, so one index is built lazily per distinct set of fields.
+    Checking m given rules against n host rules is O(n + m) instead of O(n * m).
+    """
+
+    def __init__(self, host_rules):
+        self.host_rules = list(host_rules)
+        self.indexes = {}
+
+    def index(self, fields):
+        if fields not in self.indexes:
+            index = {}
+            for host_rule in self.host_rules:
+                index.setdefault(canonical_rule(host_rule, fields), []).append(
+                    host_rule
+                )
+            self.indexes[fields] = index
+        return self.indexes[fields]
+
+    def matches(self, given_rule):
+        """Every host rule that matches given_rule, in the order of host_rules"""
+        fields = rule_fields(given_rule)
+        return self.index(fields).get(canonical_rule(given_rule, fields), [])
+
+    def add(self, host_rule):
+        """Adds a rule created on the host, so that an identical given rule matches it"""
+        self.host_rules.append(host_rule)
+        for fields, index in self.indexes.items():
+            index.setdefault(canonical_rule(host_rule, fields), []).append(host_rule)
+
+
 # make sure that upcloud-api is installed
 HAS_UPCLOUD = True
 try:
-    import upcloud_api
+    try:
+        from ansible.module_utils.upcloud_client import (
+            create_cloud_manager,
+            DEFAULT_POOL_SIZE,
+        )
+        from ansible.module_utils.upcloud_resolver import ServerResolver, ResolveError
+        from ansible.module_utils.upcloud_trace import trace_module, trace_phase
+    except ImportError:
+        from module_utils.upcloud_client import create_cloud_manager, DEFAULT_POOL_SIZE
+        from module_utils.upcloud_resolver import ServerResolver, ResolveError
+        from module_utils.upcloud_trace import trace_module, trace_phase
 
 except ImportError:
     HAS_UPCLOUD = False
@@ -142,30 +663,26 @@ class FirewallManager:
     """Helpers for managing upcloud_api.FirewallRule (and upcloud_api.Server) instance"""
 
     def __init__(self, username, password, module):
-        self.manager = upcloud_api.CloudManager(username, password)
+        self.manager = create_cloud_manager(
+            username,
+            password,
+            pool_size=max(DEFAULT_POOL_SIZE, module.params.get("workers") or 0),
+            tracer=trace_module(module),
+        )
         self.module = module
+        self.resolver = ServerResolver.from_params(
+            self.manager, module.params, username
+        )
 
     def determine_server_uuid_by_hostname(self, hostname):
         """
         Return uuid based on hostname.
         Fail if there are duplicates of the given hostname.
         """
-        servers = self.manager.get_servers()
-
-        found_servers = []
-        for server in servers:
-            if server.hostname == hostname:
-                found_servers.append(server)
-
-        if len(found_servers) > 1:
-            self.module.fail_json(
-                msg="More than one server matched the given hostname. Please use unique hostnames."
-            )
-
-        if len(found_servers) == 1:
-            return found_servers[0].uuid
-        else:
-            self.module.fail_json(msg="No server was found with hostname: " + hostname)
+        try:
+            return self.resolver.uuid_by_hostname(hostname)
+        except ResolveError as e:
+            self.module.fail_json(msg=str(e))
 
     def determine_server_uuid_by_ip(self, ip_address):
         """
@@ -173,36 +690,123 @@ class FirewallManager:
         Fail if Upcloud doesn't know the IP-address
         """
         try:
-            machine = self.manager.get_server_by_ip(ip_address)
-            return machine.uuid
-        except UpCloudAPIError as e:
-            if e.error_code == "IP_ADDRESS_NOT_FOUND":
-                self.module.fail_json(
-                    msg="No server was found with IP-address: " + ip_address
-                )
-            else:
-                raise
+            return self.resolver.uuid_by_ip(ip_address)
+        except ResolveError as e:
+            self.module.fail_json(msg=str(e))
+
+    @staticmethod
+    def match_firewall_rule(given_rule, host_rule):
+        """Match given_rule against one host_rule"""
+        fields = rule_fields(given_rule)
+        return canonical_rule(given_rule, fields) == canonical_rule(host_rule, fields)
 
     def match_firewall_rules(self, given_rule, host_rules):
         """
         Checks given_rule against every host_rule.
         False if no matches were found, True if a match was found.
-        """
-
-        def match_firewall_rule(given_rule, host_rule):
-            """Match given_rule against one host_rule"""
-            for field in given_rule:
-                if str(given_rule[field]) != str(getattr(host_rule, field)):
-                    return False
-            return True
 
-        # Theoretically O(n^2) worst case, but in practice it is much closer to O(n)
+        To check many rules, use a FirewallRuleIndex of host_rules instead.
+        """
         for host_rule in host_rules:
-            if match_firewall_rule(given_rule, host_rule):
+            if self.match_firewall_rule(given_rule, host_rule):
                 return True, host_rule.position
 
         return False, -1
 
+    def replace_firewall_rules(self, uuid, firewall_rules):
+        """
+        Replaces all firewall rules of the server with firewall_rules in one request
+        (PUT /server/uuid/firewall_rule). The rules get positions in the given order.
+        """
+        body = {
+            "firewall_rules": {
+                "firewall_rule": [
+                    dict(
+                        (field, value)
+                        for field, value in rule.items()
+                        if field != "position" and value is not None
+                    )
+                    for rule in firewall_rules
+                ]
+            }
+        }
+        return self.manager.api.put_request(
+            "/server/{}/firewall_rule".format(uuid), body
+        )
+
+    def select_servers(self, uuids, tags, zone):
+        """
+        Lists servers once and returns those that match every given selector:
+        uuid in uuids, all of tags, and zone, and the uuids that match no server.
+        """
+        with trace_phase(self.manager, "select_servers"):
+            servers = self.manager.get_servers()
+        missing = []
+        if uuids:
+            known = set(server.uuid for server in servers)
+            missing = [uuid for uuid in uuids if uuid not in known]
+            uuids = set(uuids)
+            servers = [server for server in servers if server.uuid in uuids]
+        if tags:
+            servers = [
+                server
+                for server in servers
+                if set(tags) <= set(str(tag) for tag in getattr(server, "tags", []))
+            ]
+        if zone:
+            servers = [server for server in servers if server.zone == zone]
+        return servers, missing
+
+    def reconcile(self, uuid, state, firewall_rules):
+        """
+        Brings the firewall rules of one server to the desired state.
+        Returns True if any rule was changed.
+        """
+        changed = False
+        host_rules = self.manager.get_firewall_rules(uuid)
+
+        # match every rule against host_rules
+        if state == "present":
+            index = FirewallRuleIndex(host_rules)
+            for rule in firewall_rules:
+
+                # create any given rule that didn't match existing rules
+                if not index.matches(rule):
+                    index.add(self.manager.create_firewall_rule(uuid, rule))
+                    changed = True
+
+        # delete every host rule that matches any given rule
+        if state == "absent":
+            positions = self.find_matching_positions(firewall_rules, host_rules)
+
+            # a delete renumbers only the rules after the deleted one,
+            # so deleting the highest position first keeps the remaining positions valid
+            for position in reversed(positions):
+                self.manager.delete_firewall_rule(uuid, position)
+                changed = True
+
+        # replace the whole rule set at once, so it is never partially applied
+        if state == "exact":
+            if rules_differ(firewall_rules, host_rules):
+                self.replace_firewall_rules(uuid, firewall_rules)
+                changed = True
+
+        return changed
+
+    def find_matching_positions(self, given_rules, host_rules):
+        """
+        Returns the positions (as integers) of every host_rule that matches any of
+        given_rules, using one FirewallRuleIndex of host_rules.
+        """
+        index = FirewallRuleIndex(host_rules)
+        return sorted(
+            set(
+                int(host_rule.position)
+                for rule in given_rules
+                for host_rule in index.matches(rule)
+            )
+        )
+
 
 def run(module, firewall_manager):
     """
@@ -211,15 +815,18 @@ def run(module, firewall_manager):
         create any given rule that doesn't match existing rules
     - absent:
         delete any given rule that matches an existing one
+    - exact:
+        replace all rules with the given ones if they differ
     """
 
     state = module.params["state"]
-    firewall_rules = module.params["firewall_rules"]
+    firewall_rules = desired_firewall_rules(module)
     uuid = module.params.get("uuid")
     hostname = module.params.get("hostname")
     ip_address = module.params.get("ip_address")
 
-    changed = False
+    if any(module.params.get(selector) for selector in SELECTORS):
+        run_selected(module, firewall_manager, firewall_rules)
 
     if not uuid:
         if hostname:
@@ -227,52 +834,185 @@ def run(module, firewall_manager):
         elif ip_address:
             uuid = firewall_manager.determine_server_uuid_by_ip(ip_address)
 
-    host_rules = firewall_manager.manager.get_firewall_rules(uuid)
+    fingerprints = open_fingerprint_store(module)
+    result = reconcile_server(
+        firewall_manager, fingerprints, uuid, state, firewall_rules
+    )
+    if fingerprints:
+        fingerprints.save()
+
+    module.exit_json(
+        changed=result["changed"],
+        compliant=result["compliant"],
+        **compact_result(module, firewall_rules)
+    )
 
-    # match every rule against host_rules
-    if state == "present":
-        for rule in firewall_rules:
-            matched, position = firewall_manager.match_firewall_rules(rule, host_rules)
 
-            # create any given rule that didn't match existing rules
-            if not matched:
-                firewall_manager.manager.create_firewall_rule(uuid, rule)
-                changed = True
+def compacting(module):
+    """compact only applies to state present and exact; absent matches rules partially"""
+    return module.params.get("compact") and module.params["state"] in (
+        "present",
+        "exact",
+    )
+
+
+def desired_firewall_rules(module):
+    """firewall_rules, compacted if compacting"""
+    if compacting(module):
+        return compact_firewall_rules(module.params["firewall_rules"])
+    return module.params["firewall_rules"]
 
-    # delete any given rule that matches an existing one
-    if state == "absent":
-        for rule in firewall_rules:
 
-            # each given rule can match multiple times
-            while True:
-                matched, position = firewall_manager.match_firewall_rules(
-                    rule, host_rules
+def compact_result(module, firewall_rules):
+    """The compacted rules for the task result, if compacting"""
+    return dict(compacted_rules=firewall_rules) if compacting(module) else {}
+
+
+def open_fingerprint_store(module):
+    """The FingerprintStore of fingerprint_file, or None if it was not given"""
+    if not module.params.get("fingerprint_file"):
+        return None
+    return FingerprintStore(
+        module.params["fingerprint_file"], module.params["fingerprint_max_age"]
+    )
+
+
+def reconcile_server(firewall_manager, fingerprints, uuid, state, firewall_rules):
+    """
+    Reconciles one server, unless fingerprints shows that the same rules were applied
+    to it recently. Returns dict(changed, compliant).
+    """
+    fingerprint = rules_fingerprint(state, firewall_rules) if fingerprints else None
+    if fingerprints and fingerprints.is_current(uuid, fingerprint):
+        return dict(changed=False, compliant=True)
+
+    with trace_phase(firewall_manager.manager, "reconcile"):
+        changed = firewall_manager.reconcile(uuid, state, firewall_rules)
+    if fingerprints:
+        fingerprints.record(uuid, fingerprint)
+    return dict(changed=changed, compliant=not changed)
+
+
+def run_selected(module, firewall_manager, firewall_rules):
+    """
+    Reconcile the firewall rules of every server selected by uuids, tags and zone,
+    or given as targets, with firewall_rules concurrently and exit with a result per server.
+    """
+    state = module.params["state"]
+
+    targets = module.params.get("targets")
+    if targets:
+        resolved = firewall_manager.resolver.resolve(targets)
+        servers = dict(
+            (server.uuid, server)
+            for server in resolved.values()
+            if hasattr(server, "uuid")
+        ).values()
+        missing = []
+    else:
+        servers, missing = firewall_manager.select_servers(
+            module.params.get("uuids"),
+            module.params.get("tags"),
+            module.params.get("zone"),
+        )
+    fingerprints = open_fingerprint_store(module)
+
+    def reconcile(server):
+        result = dict(uuid=server.uuid, hostname=server.hostname, changed=False)
+        try:
+            result.update(
+                reconcile_server(
+                    firewall_manager, fingerprints, server.uuid, state, firewall_rules
                 )
-                if matched:
-                    firewall_manager.manager.delete_firewall_rule(uuid, position)
-                    changed = True
+            )
+        except Exception as e:
+            result.update(failed=True, msg=str(e))
+        return result
 
-                    # update host_rules from API to get new positions
-                    host_rules = firewall_manager.manager.get_firewall_rules(uuid)
-                else:
-                    break
+    with ThreadPoolExecutor(max_workers=max(1, module.params["workers"])) as executor:
+        results = list(executor.map(reconcile, servers))
+
+    # uuids are explicit targets, one that matches no server fails like a missing target
+    results.extend(
+        dict(
+            uuid=uuid,
+            changed=False,
+            failed=True,
+            msg="No server was found with uuid: " + uuid,
+        )
+        for uuid in missing
+    )
+
+    if fingerprints:
+        fingerprints.save()
+
+    if targets:
+        # one result per target, whether or not targets share a server
+        by_uuid = dict((result["uuid"], result) for result in results)
+        results = [
+            dict(by_uuid[resolved[target].uuid], target=target)
+            if hasattr(resolved[target], "uuid")
+            else dict(target=target, changed=False, failed=True, msg=resolved[target])
+            for target in targets
+        ]
 
-    module.exit_json(changed=changed)
+    changed = any(result["changed"] for result in results)
+    failed = [result for result in results if result.get("failed")]
+    summary = dict(
+        selected=len(results),
+        changed=len([result for result in results if result["changed"]]),
+        compliant=len([result for result in results if result.get("compliant")]),
+        failed=len(failed),
+    )
+
+    if failed:
+        module.fail_json(
+            msg="{} of {} servers failed".format(len(failed), len(results)),
+            changed=changed,
+            servers=results,
+            summary=summary,
+        )
+
+    module.exit_json(
+        changed=changed,
+        servers=results,
+        summary=summary,
+        **compact_result(module, firewall_rules)
+    )
 
 
 def main():
     """main execution path"""
     module = AnsibleModule(
         argument_spec=dict(
-            state=dict(choices=["present", "absent"], default="present"),
+            state=dict(choices=["present", "absent", "exact"], default="present"),
             api_user=dict(aliases=["UPCLOUD_API_USER"], no_log=True),
             api_passwd=dict(aliases=["UPCLOUD_API_PASSWD"], no_log=True),
             hostname=dict(type="str"),
             ip_address=dict(type="str"),
             uuid=dict(aliases=["id"], type="str"),
+            uuids=dict(type="list", elements="str"),
+            tags=dict(type="list", elements="str"),
+            zone=dict(type="str"),
+            targets=dict(type="list", elements="str"),
+            workers=dict(type="int", default=10),
+            compact=dict(type="bool", default=False),
+            fingerprint_file=dict(type="path"),
+            fingerprint_max_age=dict(type="int", default=86400),
+            server_cache=dict(
+                type="path", fallback=(env_fallback, ["UPCLOUD_SERVER_CACHE"])
+            ),
+            server_cache_max_age=dict(type="int", default=60),
+            profile=dict(type="bool", default=False),
             firewall_rules=dict(type="list", required=True),
         ),
-        required_one_of=(["uuid", "hostname", "ip_address"],),
+        required_one_of=(["uuid", "hostname", "ip_address"] + SELECTORS,),
+        mutually_exclusive=[
+            [target, selector]
+            for target in ["uuid", "hostname", "ip_address"]
+            for selector in SELECTORS
+        ]
+        + [["targets", selector] for selector in ["uuids", "tags", "zone"]],
     )
 
     # ensure dependencies and API credentials are in place
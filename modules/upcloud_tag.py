@@ -17,9 +17,10 @@
 # along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
-from upcloud_api.errors import UpCloudAPIError
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from distutils.version import LooseVersion
-from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils.basic import AnsibleModule, env_fallback
 
 DOCUMENTATION = """
 ---
@@ -31,9 +32,12 @@ description:
 author: "Elias Nygren (@elnygren)"
 options:
     state:
-        description: Desired state of the tags.
+        description:
+        - Desired state of the tags.
+        - exact makes the tags of every server in server_tags exactly the given tags, or the servers
+          of every tag in tag_servers exactly the given servers, with the fewest API calls.
         default: 'present'
-        choices: ['present', 'absent']
+        choices: ['present', 'absent', 'exact']
     api_user:
         description:
         - UpCloud API username. Can be set as environment variable.
@@ -52,7 +56,52 @@ options:
     tags:
         description:
         - List of tags (strings)
+    targets:
+        description:
+        - List of hostnames, IP-addresses or uuids of target servers. Tags many servers in one task.
+    server_tags:
+        description:
+        - Dict of hostname, IP-address or uuid of a target server to its list of tags.
+          Tags many servers in one task, each with its own tags.
+    tag_servers:
+        description:
+        - With state exact, dict of tag to the list of hostnames, IP-addresses or uuids of
+          the servers that should have it. Other servers lose the tag.
+    delete_unused_tags:
+        description:
+        - With state exact, delete the tags that lost their last server in this task.
+        - Tags that had no servers to begin with are never deleted.
+        default: no
+    workers:
+        description:
+        - Maximum number of servers (un)tagged concurrently with targets, server_tags or tag_servers.
+        default: 10
+    server_cache:
+        description:
+        - Path of a file where the hostnames, IP-addresses and uuids of the servers are cached,
+          so that the forks of a play list the servers once instead of once per host.
+        - Can be set with the UPCLOUD_SERVER_CACHE environment variable.
+    server_cache_max_age:
+        description:
+        - Seconds the cached servers are used. Modules that create or destroy servers clear the cache.
+        default: 60
+    profile:
+        description:
+        - Bool. Add a summary of the task's API requests to the result as C(profile) - call counts,
+          bytes, retries and latency percentiles, overall, per endpoint and per phase of the task.
+        - Set the UPCLOUD_TRACE environment variable to a file path to also append every request
+          to that file as NDJSON.
+        default: no
 notes:
+    - With the action plugin in action_plugins/, C(batch: true) runs the task of every host in the
+      play batch as one bulk task.
+    - With targets or server_tags, the tags, servers and (if needed) IP-addresses are listed once and the
+      targets are resolved from those listings. The task returns C(servers), a result (target, uuid,
+      hostname, added, removed, changed, failed, msg) per target, and C(summary) with the numbers of
+      targets, changed and failed servers. The task fails if any target failed.
+    - With state exact, a missing tag is created with its new servers in one request, every other
+      server gets at most one assign and one remove request, and nothing is requested for servers
+      that already have the desired tags. The result also lists C(created) and C(deleted) tags.
     - This module will create missing tags (tags have to be created before assigning), but will not remove tags
       as this could lead into tags being removed from other than the target server.
     - UPCLOUD_API_USER and UPCLOUD_API_PASSWD environment variables may be used instead of api_user and api_passwd
@@ -67,7 +116,7 @@ EXAMPLES = """
 # Adding and removing tags.
 # Any tags not existing in API /tags will be created if need be.
 # Notice that either server.uuid or server.hostname can be used.
-# uuid is slightly faster due to GET /server/uuid.
+# uuid is slightly faster as no server listing is needed.
 
 - name: add tags
   upcloud_tag:
@@ -81,61 +130,179 @@ EXAMPLES = """
     uuid: xxxxxxxx-xxxx-Mxxx-Nxxx-xxxxxxxxxxxx
     tags: ['test1', 'test2']
 
+# Tagging many servers in one task
+
+- name: tag all web servers
+  upcloud_tag:
+    state: present
+    targets: "{{ groups['web'] }}"
+    tags: ['web', 'production']
+
+- name: make the tags of these servers exactly the following
+  upcloud_tag:
+    state: exact
+    server_tags:
+      web1.example.com: ['web', 'london']
+      web2.example.com: ['web', 'frankfurt']
+
+- name: make these the only servers with these tags, delete tags left without servers
+  upcloud_tag:
+    state: exact
+    tag_servers:
+      web: ['web1.example.com', 'web2.example.com']
+      canary: ['web1.example.com']
+      old-release: []
+    delete_unused_tags: yes
+
+- name: tag servers with their own tags
+  upcloud_tag:
+    state: present
+    server_tags:
+      web1.example.com: ['web', 'london']
+      10.1.0.101: ['db']
+      xxxxxxxx-xxxx-Mxxx-Nxxx-xxxxxxxxxxxx: ['cache']
+    workers: 20
+
 """
 
 
 # make sure that upcloud-api is installed
 HAS_UPCLOUD = True
 try:
-    import upcloud_api
+    try:
+        from ansible.module_utils.upcloud_client import (
+            create_cloud_manager,
+            DEFAULT_POOL_SIZE,
+        )
+        from ansible.module_utils.upcloud_resolver import ServerResolver, ResolveError
+        from ansible.module_utils.upcloud_trace import trace_module, trace_phase
+    except ImportError:
+        from module_utils.upcloud_client import create_cloud_manager, DEFAULT_POOL_SIZE
+        from module_utils.upcloud_resolver import ServerResolver, ResolveError
+        from module_utils.upcloud_trace import trace_module, trace_phase
 
 except ImportError:
     HAS_UPCLOUD = False
 
 
+class TagIndex:
+    """
+    The tag catalog of one get_tags() response with a reverse index of
+    server uuid to tag names, built from the servers listed in every tag.
+
+    Kept up to date with the tags created, assigned and removed by the module.
+    """
+
+    def __init__(self, tags):
+        self.lock = threading.Lock()
+        self.tags = set()
+        self.server_tags = {}
+        for tag in tags:
+            self.tags.add(str(tag))
+            for server in tag.servers:
+                self.server_tags.setdefault(str(server), []).append(str(tag))
+
+    def __contains__(self, tag):
+        return tag in self.tags
+
+    def tags_of(self, uuid):
+        """Names of the tags of the server"""
+        with self.lock:
+            return list(self.server_tags.get(uuid, []))
+
+    def add_tag(self, tag):
+        with self.lock:
+            self.tags.add(tag)
+
+    def assign(self, uuid, tags):
+        with self.lock:
+            server_tags = self.server_tags.setdefault(uuid, [])
+            server_tags.extend(tag for tag in tags if tag not in server_tags)
+
+    def remove(self, uuid, tags):
+        with self.lock:
+            self.server_tags[uuid] = [
+                tag for tag in self.server_tags.get(uuid, []) if tag not in tags
+            ]
+
+
+def plan_exact(current, desired):
+    """
+    Computes the changes that make the tags of the servers in desired exactly as given.
+
+    current and desired are dicts of server uuid to tags; only the (server, tag) pairs
+    in scope are compared, so desired maps every server in scope to its full set of
+    in-scope tags. Returns dicts of server uuid to the tags to add and to remove.
+    """
+    to_add = {}
+    to_remove = {}
+    for uuid, tags in desired.items():
+        host_tags = current.get(uuid, [])
+        added = [tag for tag in tags if tag not in host_tags]
+        removed = [tag for tag in host_tags if tag not in tags]
+        if added:
+            to_add[uuid] = added
+        if removed:
+            to_remove[uuid] = removed
+    return to_add, to_remove
+
+
 class TagManager:
     """Helpers for managing upcloud_api.Tag (and upcloud_api.Server) instance"""
 
     def __init__(self, username, password, module):
-        self.manager = upcloud_api.CloudManager(username, password)
+        self.manager = create_cloud_manager(
+            username,
+            password,
+            pool_size=max(DEFAULT_POOL_SIZE, module.params.get("workers") or 0),
+            tracer=trace_module(module),
+        )
         self.module = module
+        self.resolver = ServerResolver.from_params(
+            self.manager, module.params, username
+        )
+        self.tag_index = None
+
+    def load_tag_index(self):
+        """Lists the tags (one request) and indexes them; see TagIndex."""
+        with trace_phase(self.manager, "load_tag_index"):
+            self.tag_index = TagIndex(self.manager.get_tags())
+        return self.tag_index
+
+    def get_tag_index(self):
+        return self.tag_index or self.load_tag_index()
 
     def create_missing_tags(self, given_tags):
         """
         Create any tags that are present in given_tags but missing from UpCloud.
         """
-
-        found_upcloud_tags = self.manager.get_tags()
-        found_upcloud_tags = [str(uc_tag) for uc_tag in found_upcloud_tags]
+        tag_index = self.get_tag_index()
         new_upcloud_tags = []
 
         for given_tag in given_tags:
-            if given_tag not in found_upcloud_tags:
+            if given_tag not in tag_index:
                 new_upcloud_tags.append(self.manager.create_tag(given_tag))
+                tag_index.add_tag(given_tag)
 
         return new_upcloud_tags
 
+    def assign_tags(self, uuid, tags):
+        self.manager.assign_tags(uuid, tags)
+        self.get_tag_index().assign(uuid, tags)
+
+    def remove_tags(self, uuid, tags):
+        self.manager.remove_tags(uuid, tags)
+        self.get_tag_index().remove(uuid, tags)
+
     def determine_server_uuid_by_hostname(self, hostname):
         """
         Return uuid based on hostname.
         Fail if there are duplicates of the given hostname.
         """
-        servers = self.manager.get_servers()
-
-        found_servers = []
-        for server in servers:
-            if server.hostname == hostname:
-                found_servers.append(server)
-
-        if len(found_servers) > 1:
-            self.module.fail_json(
-                msg="More than one server matched the given hostname. Please use unique hostnames."
-            )
-
-        if len(found_servers) == 1:
-            return found_servers[0].uuid
-        else:
-            self.module.fail_json(msg="No server was found with hostname: " + hostname)
+        try:
+            return self.resolver.uuid_by_hostname(hostname)
+        except ResolveError as e:
+            self.module.fail_json(msg=str(e))
 
     def determine_server_uuid_by_ip(self, ip_address):
         """
@@ -143,19 +310,22 @@ class TagManager:
         Fail if Upcloud doesn't know the IP-address
         """
         try:
-            machine = self.manager.get_server_by_ip(ip_address)
-            return machine.uuid
-        except UpCloudAPIError as e:
-            if e.error_code == "IP_ADDRESS_NOT_FOUND":
-                self.module.fail_json(
-                    msg="No server was found with IP-address: " + ip_address
-                )
-            else:
-                raise
+            return self.resolver.uuid_by_ip(ip_address)
+        except ResolveError as e:
+            self.module.fail_json(msg=str(e))
+
+    def resolve_targets(self, targets):
+        """
+        Resolves hostnames, IP-addresses and uuids to servers with one server listing,
+        plus IP-address lookups for targets that are not uuids or hostnames.
+        Returns a dict of target to server, or to an error message.
+        """
+        with trace_phase(self.manager, "resolve_targets"):
+            return self.resolver.resolve(targets)
 
     def get_host_tags(self, uuid):
-        host_tags = self.manager.get_server(uuid).tags
-        return [str(host_tag) for host_tag in host_tags]
+        """Tags of the server from the tag listing, without fetching the server's details"""
+        return self.get_tag_index().tags_of(uuid)
 
 
 def run(module, tag_manager):
@@ -177,6 +347,15 @@ def run(module, tag_manager):
 
     changed = False
 
+    # one tag listing tells which tags every server has
+    tag_manager.load_tag_index()
+
+    if state == "exact":
+        run_exact(module, tag_manager)
+
+    if module.params.get("targets") or module.params.get("server_tags"):
+        run_bulk(module, tag_manager)
+
     if not uuid:
         if hostname:
             uuid = tag_manager.determine_server_uuid_by_hostname(hostname)
@@ -195,7 +374,7 @@ def run(module, tag_manager):
         tags_to_add = [tag for tag in tags if tag not in host_tags]
 
         if tags_to_add:
-            tag_manager.manager.assign_tags(uuid, tags)
+            tag_manager.assign_tags(uuid, tags_to_add)
             changed = True
 
         module.exit_json(changed=changed)
@@ -210,27 +389,298 @@ def run(module, tag_manager):
 
         if len(tags_to_remove) > 0:
             changed = True
-            tag_manager.manager.remove_tags(uuid, tags_to_remove)
+            tag_manager.remove_tags(uuid, tags_to_remove)
 
         module.exit_json(changed=changed)
 
 
+def run_bulk(module, tag_manager):
+    """
+    (Un)tag many servers, given as targets with tags or as server_tags,
+    concurrently and exit with a result per target.
+    """
+    state = module.params["state"]
+    if module.params.get("server_tags"):
+        target_tags = dict(
+            (str(target), [str(tag) for tag in tags])
+            for target, tags in module.params["server_tags"].items()
+        )
+    else:
+        tags = module.params.get("tags") or []
+        target_tags = dict((str(target), tags) for target in module.params["targets"])
+
+    resolved = tag_manager.resolve_targets(list(target_tags))
+
+    # tags must exist in UpCloud before they can be assigned
+    if state == "present":
+        all_tags = []
+        for tags in target_tags.values():
+            all_tags.extend(tag for tag in tags if tag not in all_tags)
+        tag_manager.create_missing_tags(all_tags)
+
+    def apply(target):
+        server = resolved[target]
+        result = dict(target=target, changed=False)
+        if not hasattr(server, "uuid"):
+            result.update(failed=True, msg=server)
+            return result
+
+        result.update(uuid=server.uuid, hostname=server.hostname)
+        host_tags = tag_manager.get_host_tags(server.uuid)
+        try:
+            if state == "present":
+                tags_to_add = [
+                    tag for tag in target_tags[target] if tag not in host_tags
+                ]
+                if tags_to_add:
+                    tag_manager.assign_tags(server.uuid, tags_to_add)
+                result.update(added=tags_to_add, changed=bool(tags_to_add))
+            else:
+                tags_to_remove = [
+                    tag for tag in target_tags[target] if tag in host_tags
+                ]
+                if tags_to_remove:
+                    tag_manager.remove_tags(server.uuid, tags_to_remove)
+                result.update(removed=tags_to_remove, changed=bool(tags_to_remove))
+        except Exception as e:
+            result.update(failed=True, msg=str(e))
+        return result
+
+    with ThreadPoolExecutor(max_workers=max(1, module.params["workers"])) as executor:
+        results = list(executor.map(apply, target_tags))
+
+    changed = any(result["changed"] for result in results)
+    failed = [result for result in results if result.get("failed")]
+    summary = dict(
+        targets=len(results),
+        changed=len([result for result in results if result["changed"]]),
+        failed=len(failed),
+    )
+
+    if failed:
+        module.fail_json(
+            msg="{} of {} targets failed".format(len(failed), len(results)),
+            changed=changed,
+            servers=results,
+            summary=summary,
+        )
+
+    module.exit_json(changed=changed, servers=results, summary=summary)
+
+
+def run_exact(module, tag_manager):
+    """
+    Make the tag assignments of the given servers (server_tags) or tags (tag_servers)
+    exactly as given with the fewest requests, and exit with a result per server.
+    """
+    tag_index = tag_manager.get_tag_index()
+    results = []
+
+    # resolve every server once, whichever mapping it is given in
+    if module.params.get("server_tags"):
+        target_tags = dict(
+            (str(target), [str(tag) for tag in tags])
+            for target, tags in module.params["server_tags"].items()
+        )
+        targets = list(target_tags)
+    else:
+        tag_targets = dict(
+            (str(tag), [str(target) for target in targets])
+            for tag, targets in module.params["tag_servers"].items()
+        )
+        targets = []
+        for tag_target_list in tag_targets.values():
+            targets.extend(
+                target for target in tag_target_list if target not in targets
+            )
+
+    resolved = tag_manager.resolve_targets(targets)
+    uuids = {}
+    for target in targets:
+        server = resolved[target]
+        if hasattr(server, "uuid"):
+            uuids[target] = server.uuid
+        else:
+            results.append(dict(target=target, changed=False, failed=True, msg=server))
+
+    # the assignments are exact only if every server is known, nothing is changed otherwise
+    if results:
+        module.fail_json(
+            msg="{} of {} targets could not be resolved".format(
+                len(results), len(targets)
+            ),
+            changed=False,
+            servers=results,
+            created=[],
+            deleted=[],
+            summary=dict(servers=len(targets), changed=0, failed=len(results)),
+        )
+
+    # desired and current tags of the servers, limited to the tags in scope
+    if module.params.get("server_tags"):
+        desired = {}
+        for target, tags in target_tags.items():
+            if target in uuids:
+                desired.setdefault(uuids[target], [])
+                desired[uuids[target]].extend(
+                    tag for tag in tags if tag not in desired[uuids[target]]
+                )
+        current = dict((uuid, tag_index.tags_of(uuid)) for uuid in desired)
+    else:
+        scope = set(tag_targets)
+        desired = {}
+        for tag, tag_target_list in tag_targets.items():
+            for target in tag_target_list:
+                if target in uuids:
+                    desired.setdefault(uuids[target], [])
+                    if tag not in desired[uuids[target]]:
+                        desired[uuids[target]].append(tag)
+        current = {}
+        for uuid, tags in tag_index.server_tags.items():
+            in_scope = [tag for tag in tags if tag in scope]
+            if in_scope:
+                current[uuid] = in_scope
+                desired.setdefault(uuid, [])
+        for uuid in desired:
+            current.setdefault(uuid, [])
+
+    to_add, to_remove = plan_exact(current, desired)
+    changed_uuids = sorted(set(to_add) | set(to_remove))
+
+    # a missing tag is created with its new servers in one request
+    created = {}
+    for uuid in changed_uuids:
+        for tag in to_add.get(uuid, []):
+            if tag not in tag_index:
+                created.setdefault(tag, []).append(uuid)
+    for tag, tag_uuids in created.items():
+        tag_manager.manager.create_tag(tag, servers=tag_uuids)
+        tag_index.add_tag(tag)
+        for uuid in tag_uuids:
+            tag_index.assign(uuid, [tag])
+
+    hostnames = dict(
+        (server.uuid, server.hostname)
+        for server in resolved.values()
+        if hasattr(server, "uuid")
+    )
+
+    def apply(uuid):
+        result = dict(
+            uuid=uuid,
+            hostname=hostnames.get(uuid),
+            added=to_add.get(uuid, []),
+            removed=to_remove.get(uuid, []),
+            changed=True,
+        )
+        assign = [tag for tag in result["added"] if tag not in created]
+        try:
+            if assign:
+                tag_manager.assign_tags(uuid, assign)
+            if result["removed"]:
+                tag_manager.remove_tags(uuid, result["removed"])
+        except Exception as e:
+            result.update(failed=True, msg=str(e))
+        return result
+
+    with ThreadPoolExecutor(max_workers=max(1, module.params["workers"])) as executor:
+        results.extend(executor.map(apply, changed_uuids))
+
+    # only tags that lost their last server in this task are deleted
+    deleted = []
+    if module.params.get("delete_unused_tags"):
+        had_servers = set(tag for tags in current.values() for tag in tags)
+        now_used = set(tag for tags in tag_index.server_tags.values() for tag in tags)
+        deleted = sorted(had_servers - now_used)
+        for tag in deleted:
+            tag_manager.manager.delete_tag(tag)
+
+    changed = bool(changed_uuids or deleted)
+    failed = [result for result in results if result.get("failed")]
+    summary = dict(
+        servers=len(desired),
+        changed=len(changed_uuids),
+        failed=len(failed),
+    )
+
+    if failed:
+        module.fail_json(
+            msg="{} of {} servers failed".format(len(failed), summary["servers"]),
+            changed=changed,
+            servers=results,
+            created=sorted(created),
+            deleted=deleted,
+            summary=summary,
+        )
+
+    module.exit_json(
+        changed=changed,
+        servers=results,
+        created=sorted(created),
+        deleted=deleted,
+        summary=summary,
+    )
+
+
 def main():
     """main execution path"""
 
     module = AnsibleModule(
         argument_spec=dict(
-            state=dict(choices=["present", "absent"], default="present"),
+            state=dict(choices=["present", "absent", "exact"], default="present"),
             api_user=dict(aliases=["UPCLOUD_API_USER"], no_log=True),
             api_passwd=dict(aliases=["UPCLOUD_API_PASSWD"], no_log=True),
             hostname=dict(type="str"),
             ip_address=dict(type="str"),
             uuid=dict(aliases=["id"], type="str"),
-            tags=dict(type="list", required=True),
+            tags=dict(type="list"),
+            targets=dict(type="list", elements="str"),
+            server_tags=dict(type="dict"),
+            tag_servers=dict(type="dict"),
+            delete_unused_tags=dict(type="bool", default=False),
+            workers=dict(type="int", default=10),
+            server_cache=dict(
+                type="path", fallback=(env_fallback, ["UPCLOUD_SERVER_CACHE"])
+            ),
+            server_cache_max_age=dict(type="int", default=60),
+            profile=dict(type="bool", default=False),
+        ),
+        required_one_of=(
+            ["uuid", "hostname", "ip_address", "targets", "server_tags", "tag_servers"],
         ),
-        required_one_of=(["uuid", "hostname", "ip_address"],),
+        mutually_exclusive=[
+            [bulk, target]
+            for bulk in ["targets", "server_tags", "tag_servers"]
+            for target in ["uuid", "hostname", "ip_address", "tags"]
+            if [bulk, target] != ["targets", "tags"]
+        ]
+        + [
+            ["targets", "server_tags"],
+            ["targets", "tag_servers"],
+            ["server_tags", "tag_servers"],
+        ],
+        required_by={"targets": "tags"},
+        required_if=[
+            ["state", "exact", ["server_tags", "tag_servers"], True],
+            [
+                "state",
+                "present",
+                ["uuid", "hostname", "ip_address", "targets", "server_tags"],
+                True,
+            ],
+            [
+                "state",
+                "absent",
+                ["uuid", "hostname", "ip_address", "targets", "server_tags"],
+                True,
+            ],
+        ],
     )
 
+    if not module.params.get("server_tags") and not module.params.get("tag_servers"):
+        if module.params.get("tags") is None:
+            module.fail_json(msg="tags is required unless server_tags is given")
+
     # ensure dependencies and API credentials are in place
     #
 
@@ -0,0 +1,782 @@
+"""
+Local HTTP stand-in for the parts of UpCloud's API used by the inventory and modules.
+
+Serves /1.3/server, /1.3/ip_address, /1.3/tag and /1.3/server/{uuid}/firewall_rule
+(plus the server start/stop/delete, tag assignment and bulk firewall rule replacement
+endpoints the modules call)
+from an in-memory state store, so that code can be tested end to end over real
+HTTP connections without network access:
+
+    state = StandInState.from_json_data("test/json_data")
+    with APIStandIn(state, latency=0.01, rate_limit=100) as standin:
+        manager = standin.cloud_manager()
+        manager.get_servers()
+
+Every request is recorded in APIStandIn.requests and every accepted TCP connection
+is counted in APIStandIn.connections, which shows whether a client reuses connections.
+Responses are gzip-compressed if the client accepts it, and APIStandIn.bytes_sent counts
+the response body bytes as sent.
+
+List endpoints accept the `limit` and `offset` query parameters. max_page_size caps
+the number of items returned by one request, as if the API had a page size limit.
+"""
+
+import os
+import gzip
+import json
+import math
+import time
+import uuid as uuidlib
+import threading
+import pytest
+from socketserver import ThreadingMixIn
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs, unquote
+
+from upcloud_api import CloudManager
+
+API_PREFIX = "/1.3"
+
+# the API returns every field of a firewall rule, empty if not set
+FIREWALL_RULE_FIELDS = [
+    "action",
+    "comment",
+    "destination_address_end",
+    "destination_address_start",
+    "destination_port_end",
+    "destination_port_start",
+    "direction",
+    "family",
+    "icmp_type",
+    "protocol",
+    "source_address_end",
+    "source_address_start",
+    "source_port_end",
+    "source_port_start",
+]
+
+
+class ModuleExit(Exception):
+    def __init__(self, result):
+        super().__init__(result)
+        self.result = result
+
+
+class StandInModule:
+    """Stand-in for AnsibleModule that raises the results of exit_json and fail_json"""
+
+    def __init__(self, **params):
+        self.params = params
+
+    def exit_json(self, **kwargs):
+        raise ModuleExit(kwargs)
+
+    def fail_json(self, **kwargs):
+        kwargs["failed"] = True
+        raise ModuleExit(kwargs)
+
+
+def run_module(run, module, manager, failed=False):
+    """Runs a module's run(module, manager) and returns the result it exited with."""
+    with pytest.raises(ModuleExit) as exit_info:
+        run(module, manager)
+    result = exit_info.value.result
+    assert result.get("failed", False) == failed, result
+    return result
+
+
+class StandInError(Exception):
+    """An API error response: HTTP status, error_code and error_message"""
+
+    def __init__(self, status, error_code, error_message):
+        super().__init__(error_message)
+        self.status = status
+        self.error_code = error_code
+        self.error_message = error_message
+
+
+def not_found(error_code, what):
+    return StandInError(404, error_code, "{} does not exist.".format(what))
+
+
+class StandInState:
+    """
+    Thread-safe store of the servers, IP addresses, tags and firewall rules the stand-in serves.
+
+    All arguments use the shapes of UpCloud's API responses: lists of server, ip_address
+    and tag dicts, and a dict of server uuid to a list of firewall_rule dicts.
+    Tag membership is kept in the tag catalog; a server's "tags" are derived from it.
+
+    With transition_reads set, created and stopped servers are in maintenance until
+    their state has been read (listed or fetched) transition_reads times, like the
+    API's asynchronous server operations. Starting a server is synchronous, as in the API.
+    """
+
+    def __init__(self, servers=(), ip_addresses=(), tags=(), firewall_rules=None):
+        self.lock = threading.RLock()
+        self.servers = {}
+        self.ip_addresses = []
+        self.tags = {}
+        self.firewall_rules = {}
+        self.storages = set()
+        self.address_counter = 0
+        self.transition_reads = 0
+        # uuid -> [state after the transition, reads left]
+        self.transitions = {}
+
+        for tag in tags:
+            self.tags[tag["name"]] = {
+                "name": tag["name"],
+                "description": tag.get("description") or "",
+                "servers": list(tag.get("servers", {}).get("server", [])),
+            }
+
+        known_addresses = set()
+        for ip_address in ip_addresses:
+            self.ip_addresses.append(dict(ip_address))
+            known_addresses.add(ip_address["address"])
+
+        for server in servers:
+            server = json.loads(json.dumps(server))
+            uuid = server["uuid"]
+
+            for tag_name in server.pop("tags", {}).get("tag", []):
+                tag = self.tags.setdefault(
+                    tag_name, {"name": tag_name, "description": "", "servers": []}
+                )
+                if uuid not in tag["servers"]:
+                    tag["servers"].append(uuid)
+
+            for ip_address in server.pop("ip_addresses", {}).get("ip_address", []):
+                if ip_address["address"] not in known_addresses:
+                    known_addresses.add(ip_address["address"])
+                    self.ip_addresses.append(dict(ip_address, server=uuid))
+
+            server.setdefault("storage_devices", {"storage_device": []})
+            for storage in server["storage_devices"]["storage_device"]:
+                self.storages.add(storage["storage"])
+
+            self.servers[uuid] = server
+            self.firewall_rules[uuid] = []
+
+        for uuid, rules in (firewall_rules or {}).items():
+            self.firewall_rules[uuid] = [dict(rule) for rule in rules]
+            self._renumber(uuid)
+
+    @classmethod
+    def from_json_data(cls, directory, firewall_rules_for_all=True):
+        """
+        Builds the state from the JSON fixtures in directory (see test/json_data).
+        The rules of firewall.json are given to every server if firewall_rules_for_all is set.
+        """
+
+        def read(name):
+            with open(os.path.join(directory, name + ".json"), "r") as json_file:
+                return json.load(json_file)
+
+        servers = read("server_populated")["servers"]["server"]
+        rules = read("firewall")["firewall_rules"]["firewall_rule"]
+        return cls(
+            servers=servers,
+            ip_addresses=read("ip_address")["ip_addresses"]["ip_address"],
+            tags=read("tag")["tags"]["tag"],
+            firewall_rules=dict(
+                (server["uuid"], rules) for server in servers if firewall_rules_for_all
+            ),
+        )
+
+    # servers
+
+    def _server(self, uuid):
+        server = self.servers.get(uuid)
+        if server is None:
+            raise not_found("SERVER_NOT_FOUND", "The server " + uuid)
+        return server
+
+    def _server_tags(self, uuid):
+        return [tag["name"] for tag in self.tags.values() if uuid in tag["servers"]]
+
+    def _server_listing(self, server):
+        listing = dict(server, tags={"tag": self._server_tags(server["uuid"])})
+        listing.pop("storage_devices", None)
+        return listing
+
+    def _transition(self, uuid, state):
+        """Puts the server in maintenance until it reaches state, or sets state right away"""
+        if self.transition_reads:
+            self.servers[uuid]["state"] = "maintenance"
+            self.transitions[uuid] = [state, self.transition_reads]
+        else:
+            self.servers[uuid]["state"] = state
+
+    def _read(self, uuids):
+        """Counts a read of the servers' states towards their transitions"""
+        for uuid in uuids:
+            transition = self.transitions.get(uuid)
+            if transition is None:
+                continue
+            transition[1] -= 1
+            if transition[1] <= 0:
+                self.servers[uuid]["state"] = transition[0]
+                del self.transitions[uuid]
+
+    def list_servers(self):
+        with self.lock:
+            self._read(list(self.servers))
+            return [self._server_listing(server) for server in self.servers.values()]
+
+    def server_details(self, uuid, read=True):
+        with self.lock:
+            server = self._server(uuid)
+            if read:
+                self._read([uuid])
+            details = dict(server, tags={"tag": self._server_tags(uuid)})
+            details["ip_addresses"] = {
+                "ip_address": [
+                    dict(
+                        (key, ip_address[key])
+                        for key in ("access", "address", "family")
+                        if key in ip_address
+                    )
+                    for ip_address in self.ip_addresses
+                    if ip_address.get("server") == uuid
+                ]
+            }
+            return details
+
+    def _next_address(self, access, family):
+        self.address_counter += 1
+        high, low = divmod(self.address_counter, 250)
+        if family == "IPv6":
+            return "2a04:3540:1000:310::{:x}".format(self.address_counter)
+        prefix = "94.237" if access == "public" else "10.3"
+        return "{}.{}.{}".format(prefix, high % 250, low + 1)
+
+    def create_server(self, body):
+        with self.lock:
+            uuid = str(uuidlib.uuid4())
+            server = dict(
+                (key, value)
+                for key, value in body.items()
+                if key not in ("ip_addresses", "storage_devices", "login_user")
+            )
+            server["uuid"] = uuid
+
+            requested = body.get("ip_addresses", {}).get("ip_address") or [
+                {"access": "public", "family": "IPv4"},
+                {"access": "private", "family": "IPv4"},
+            ]
+            for ip_address in requested:
+                family = ip_address.get("family", "IPv4")
+                self.ip_addresses.append(
+                    {
+                        "access": ip_address.get("access", "public"),
+                        "address": self._next_address(ip_address.get("access"), family),
+                        "family": family,
+                        "ptr_record": "",
+                        "server": uuid,
+                    }
+                )
+
+            storage_devices = []
+            for index, storage in enumerate(
+                body.get("storage_devices", {}).get("storage_device", [])
+            ):
+                storage_uuid = str(uuidlib.uuid4())
+                self.storages.add(storage_uuid)
+                storage_devices.append(
+                    {
+                        "address": "virtio:{}".format(index),
+                        "storage": storage_uuid,
+                        "storage_size": int(storage.get("size", 10)),
+                        "storage_title": storage.get("title", ""),
+                        "type": "disk",
+                    }
+                )
+            server["storage_devices"] = {"storage_device": storage_devices}
+
+            self.servers[uuid] = server
+            self.firewall_rules[uuid] = []
+            self._transition(uuid, "started")
+            return self.server_details(uuid, read=False)
+
+    def set_server_state(self, uuid, state):
+        with self.lock:
+            self._server(uuid)["state"] = state
+            self.transitions.pop(uuid, None)
+            return self.server_details(uuid, read=False)
+
+    def stop_server(self, uuid):
+        with self.lock:
+            if self._server(uuid)["state"] != "started":
+                raise StandInError(
+                    400, "SERVER_STATE_ILLEGAL", "The server is not in started state."
+                )
+            self._transition(uuid, "stopped")
+            return self.server_details(uuid, read=False)
+
+    def delete_server(self, uuid):
+        with self.lock:
+            if self._server(uuid)["state"] != "stopped":
+                raise StandInError(
+                    400, "SERVER_STATE_ILLEGAL", "The server is not in stopped state."
+                )
+            del self.servers[uuid]
+            del self.firewall_rules[uuid]
+            for tag in self.tags.values():
+                if uuid in tag["servers"]:
+                    tag["servers"].remove(uuid)
+            self.ip_addresses = [
+                ip_address
+                for ip_address in self.ip_addresses
+                if ip_address.get("server") != uuid
+            ]
+
+    def delete_storage(self, storage_uuid):
+        with self.lock:
+            if storage_uuid not in self.storages:
+                raise not_found("STORAGE_NOT_FOUND", "The storage " + storage_uuid)
+            self.storages.discard(storage_uuid)
+
+    # IP addresses
+
+    def list_ip_addresses(self):
+        with self.lock:
+            return [dict(ip_address) for ip_address in self.ip_addresses]
+
+    def ip_address(self, address):
+        with self.lock:
+            for ip_address in self.ip_addresses:
+                if ip_address["address"] == address:
+                    return dict(ip_address)
+            raise not_found("IP_ADDRESS_NOT_FOUND", "The IP address " + address)
+
+    # tags
+
+    def _tag_body(self, tag):
+        return {
+            "name": tag["name"],
+            "description": tag["description"],
+            "servers": {"server": list(tag["servers"])},
+        }
+
+    def _tag(self, name):
+        tag = self.tags.get(name)
+        if tag is None:
+            raise not_found("TAG_NOT_FOUND", "The tag " + name)
+        return tag
+
+    def list_tags(self):
+        with self.lock:
+            return [self._tag_body(tag) for tag in self.tags.values()]
+
+    def tag(self, name):
+        with self.lock:
+            return self._tag_body(self._tag(name))
+
+    def create_tag(self, body):
+        with self.lock:
+            name = body.get("name")
+            if name in self.tags:
+                raise StandInError(
+                    409, "TAG_EXISTS", "The tag {} already exists.".format(name)
+                )
+            self.tags[name] = {"name": name, "description": "", "servers": []}
+            return self.modify_tag(name, body)
+
+    def modify_tag(self, name, body):
+        with self.lock:
+            tag = self._tag(name)
+            servers = (body.get("servers") or {}).get("server")
+            if servers is not None:
+                for uuid in servers:
+                    self._server(uuid)
+                tag["servers"] = list(servers)
+            if body.get("description") is not None:
+                tag["description"] = body["description"]
+            new_name = body.get("name") or name
+            if new_name != name:
+                tag["name"] = new_name
+                self.tags[new_name] = self.tags.pop(name)
+            return self._tag_body(tag)
+
+    def delete_tag(self, name):
+        with self.lock:
+            self._tag(name)
+            del self.tags[name]
+
+    def assign_tags(self, uuid, names):
+        with self.lock:
+            self._server(uuid)
+            tags = [self._tag(name) for name in names]
+            for tag in tags:
+                if uuid not in tag["servers"]:
+                    tag["servers"].append(uuid)
+            return self.server_details(uuid)
+
+    def remove_tags(self, uuid, names):
+        with self.lock:
+            self._server(uuid)
+            tags = [self._tag(name) for name in names]
+            for tag in tags:
+                if uuid in tag["servers"]:
+                    tag["servers"].remove(uuid)
+            return self.server_details(uuid)
+
+    # firewall rules
+
+    def _renumber(self, uuid):
+        for position, rule in enumerate(self.firewall_rules[uuid], start=1):
+            rule["position"] = str(position)
+
+    def _rules(self, uuid):
+        self._server(uuid)
+        return self.firewall_rules[uuid]
+
+    def list_firewall_rules(self, uuid):
+        with self.lock:
+            return [dict(rule) for rule in self._rules(uuid)]
+
+    def firewall_rule(self, uuid, position):
+        with self.lock:
+            rules = self._rules(uuid)
+            if not position.isdigit() or not 1 <= int(position) <= len(rules):
+                raise not_found(
+                    "FIREWALL_RULE_NOT_FOUND", "The firewall rule " + position
+                )
+            return dict(rules[int(position) - 1])
+
+    def create_firewall_rule(self, uuid, body):
+        with self.lock:
+            rules = self._rules(uuid)
+            rule = dict.fromkeys(FIREWALL_RULE_FIELDS, "")
+            rule.update(
+                (key, "" if value is None else str(value))
+                for key, value in body.items()
+            )
+            position = int(rule.pop("position", 0) or 0)
+            if 1 <= position <= len(rules):
+                rules.insert(position - 1, rule)
+            else:
+                rules.append(rule)
+            self._renumber(uuid)
+            return dict(rule)
+
+    def replace_firewall_rules(self, uuid, rules):
+        with self.lock:
+            self._rules(uuid)
+            self.firewall_rules[uuid] = []
+            for rule in rules:
+                self.create_firewall_rule(uuid, dict(rule, position=None))
+            return self.list_firewall_rules(uuid)
+
+    def delete_firewall_rule(self, uuid, position):
+        with self.lock:
+            self.firewall_rule(uuid, position)
+            del self.firewall_rules[uuid][int(position) - 1]
+            self._renumber(uuid)
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """Routes requests to the StandInState of the server (APIStandIn) that owns the handler."""
+
+    protocol_version = "HTTP/1.1"
+
+    # headers and body are written separately; without this, Nagle's algorithm and
+    # delayed ACKs add 40ms to every request on a keep-alive connection
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        self.server.standin.connection_opened()
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.handle_api_request("GET")
+
+    def do_POST(self):
+        self.handle_api_request("POST")
+
+    def do_PUT(self):
+        self.handle_api_request("PUT")
+
+    def do_DELETE(self):
+        self.handle_api_request("DELETE")
+
+    def read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        if not length:
+            return {}
+        return json.loads(self.rfile.read(length).decode("utf-8"))
+
+    def send_json(self, status, payload=None, headers=None):
+        body = json.dumps(payload).encode("utf-8") if payload is not None else b""
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        if body:
+            self.send_header("Content-Type", "application/json; charset=UTF-8")
+            if "gzip" in self.headers.get("Accept-Encoding", ""):
+                body = gzip.compress(body)
+                self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.standin.sent(len(body))
+
+    def handle_api_request(self, method):
+        standin = self.server.standin
+        url = urlsplit(self.path)
+        path = unquote(url.path)
+        body = self.read_body()
+
+        delay = (
+            standin.latency(method, path)
+            if callable(standin.latency)
+            else standin.latency
+        )
+        if delay:
+            time.sleep(delay)
+
+        retry_after = standin.throttle()
+        if retry_after is not None:
+            standin.record(method, path, 429)
+            return self.send_json(
+                429,
+                {
+                    "error": {
+                        "error_code": "TOO_MANY_REQUESTS",
+                        "error_message": "Too many requests, try again later.",
+                    }
+                },
+                headers={"Retry-After": str(retry_after)},
+            )
+
+        try:
+            if not self.headers.get("Authorization"):
+                raise StandInError(
+                    401, "AUTHENTICATION_FAILED", "Authentication failed."
+                )
+            if not path.startswith(API_PREFIX + "/"):
+                raise StandInError(404, "NOT_FOUND", "Unknown API version.")
+            status, payload = standin.route(
+                method, path[len(API_PREFIX) :], parse_qs(url.query), body
+            )
+        except StandInError as error:
+            status = error.status
+            payload = {
+                "error": {
+                    "error_code": error.error_code,
+                    "error_message": error.error_message,
+                }
+            }
+
+        standin.record(method, path, status)
+        self.send_json(status, payload)
+
+
+class StandInHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class APIStandIn:
+    """
+    Runs a StandInState behind a local threaded HTTP server.
+
+    - latency: seconds added to every request, or a function of (method, path) returning them
+    - rate_limit: number of requests allowed per rate_window seconds; the rest get
+      429 Too Many Requests with a Retry-After header
+    - max_page_size: maximum number of items in one list response
+    """
+
+    def __init__(
+        self, state, latency=0.0, rate_limit=None, rate_window=1.0, max_page_size=None
+    ):
+        self.state = state
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.rate_window = rate_window
+        self.max_page_size = max_page_size
+
+        self.requests = []
+        self.connections = 0
+        self.bytes_sent = 0
+        self.stats_lock = threading.Lock()
+        self.window_start = time.time()
+        self.window_count = 0
+
+        self.httpd = None
+        self.thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def start(self):
+        self.httpd = StandInHTTPServer(("127.0.0.1", 0), StandInHandler)
+        self.httpd.standin = self
+        self.thread = threading.Thread(
+            target=self.httpd.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True
+        )
+        self.thread.start()
+        return self
+
+    def stop(self):
+        if self.httpd:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+            self.httpd = None
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{}{}".format(self.httpd.server_address[1], API_PREFIX)
+
+    def cloud_manager(self, username="standin", password="standin", timeout=10):
+        """Returns an upcloud_api.CloudManager that talks to this stand-in."""
+        manager = CloudManager(username, password, timeout)
+        self.connect(manager)
+        return manager
+
+    def connect(self, manager):
+        """Points an existing CloudManager (such as the one of a module's manager class) here."""
+        manager.api.api_root = self.url
+        return manager
+
+    # bookkeeping
+
+    def connection_opened(self):
+        with self.stats_lock:
+            self.connections += 1
+
+    def record(self, method, path, status):
+        with self.stats_lock:
+            self.requests.append((method, path, status))
+
+    def count(self, method=None, path=None, status=None):
+        """Number of recorded requests, optionally filtered by method, path prefix and status."""
+        with self.stats_lock:
+            return sum(
+                1
+                for request_method, request_path, request_status in self.requests
+                if (method is None or request_method == method)
+                and (path is None or request_path.startswith(API_PREFIX + path))
+                and (status is None or request_status == status)
+            )
+
+    def sent(self, size):
+        with self.stats_lock:
+            self.bytes_sent += size
+
+    def reset_stats(self):
+        with self.stats_lock:
+            self.requests = []
+            self.connections = 0
+            self.bytes_sent = 0
+
+    def throttle(self):
+        """Returns the Retry-After seconds if the request is over the rate limit, else None."""
+        if self.rate_limit is None:
+            return None
+        with self.stats_lock:
+            now = time.time()
+            if now - self.window_start >= self.rate_window:
+                self.window_start = now
+                self.window_count = 0
+            self.window_count += 1
+            if self.window_count <= self.rate_limit:
+                return None
+            return max(1, int(math.ceil(self.window_start + self.rate_window - now)))
+
+    # routing
+
+    def page(self, items, query):
+        offset = int(query.get("offset", ["0"])[0])
+        limit = query.get("limit")
+        limit = int(limit[0]) if limit else None
+        if self.max_page_size is not None:
+            limit = min(limit or self.max_page_size, self.max_page_size)
+        return items[offset : offset + limit] if limit is not None else items[offset:]
+
+    def route(self, method, path, query, body):
+        """Returns (status, payload) for an API request; raises StandInError on errors."""
+        state = self.state
+        parts = [part for part in path.split("/") if part]
+
+        if parts == ["server"]:
+            if method == "GET":
+                servers = self.page(state.list_servers(), query)
+                return 200, {"servers": {"server": servers}}
+            if method == "POST":
+                return 202, {"server": state.create_server(body.get("server", {}))}
+
+        elif parts[:1] == ["server"] and len(parts) == 2:
+            if method == "GET":
+                return 200, {"server": state.server_details(parts[1])}
+            if method == "DELETE":
+                state.delete_server(parts[1])
+                return 204, None
+
+        elif parts[:1] == ["server"] and len(parts) == 3 and method == "POST":
+            if parts[2] == "start":
+                return 200, {"server": state.set_server_state(parts[1], "started")}
+            if parts[2] == "stop":
+                return 200, {"server": state.stop_server(parts[1])}
+
+        elif parts[:1] == ["server"] and len(parts) == 4 and method == "POST":
+            if parts[2] == "tag":
+                return 200, {"server": state.assign_tags(parts[1], parts[3].split(","))}
+            if parts[2] == "untag":
+                return 200, {"server": state.remove_tags(parts[1], parts[3].split(","))}
+
+        if parts[:1] == ["server"] and parts[2:3] == ["firewall_rule"]:
+            if len(parts) == 3 and method == "GET":
+                rules = self.page(state.list_firewall_rules(parts[1]), query)
+                return 200, {"firewall_rules": {"firewall_rule": rules}}
+            if len(parts) == 3 and method == "POST":
+                rule = state.create_firewall_rule(
+                    parts[1], body.get("firewall_rule", {})
+                )
+                return 201, {"firewall_rule": rule}
+            if len(parts) == 3 and method == "PUT":
+                rules = body.get("firewall_rules", {}).get("firewall_rule", [])
+                rules = state.replace_firewall_rules(parts[1], rules)
+                return 200, {"firewall_rules": {"firewall_rule": rules}}
+            if len(parts) == 4 and method == "GET":
+                return 200, {"firewall_rule": state.firewall_rule(parts[1], parts[3])}
+            if len(parts) == 4 and method == "DELETE":
+                state.delete_firewall_rule(parts[1], parts[3])
+                return 204, None
+
+        if parts == ["ip_address"] and method == "GET":
+            addresses = self.page(state.list_ip_addresses(), query)
+            return 200, {"ip_addresses": {"ip_address": addresses}}
+
+        if parts[:1] == ["ip_address"] and len(parts) == 2 and method == "GET":
+            return 200, {"ip_address": state.ip_address(parts[1])}
+
+        if parts == ["tag"]:
+            if method == "GET":
+                return 200, {"tags": {"tag": self.page(state.list_tags(), query)}}
+            if method == "POST":
+                return 201, {"tag": state.create_tag(body.get("tag", {}))}
+
+        if parts[:1] == ["tag"] and len(parts) == 2:
+            if method == "GET":
+                return 200, {"tag": state.tag(parts[1])}
+            if method == "PUT":
+                return 200, {"tag": state.modify_tag(parts[1], body.get("tag", {}))}
+            if method == "DELETE":
+                state.delete_tag(parts[1])
+                return 204, None
+
+        if parts[:1] == ["storage"] and len(parts) == 2 and method == "DELETE":
+            state.delete_storage(parts[1])
+            return 204, None
+
+        raise StandInError(
+            404, "NOT_FOUND", "The stand-in does not serve {} {}".format(method, path)
+        )
@@ -2,12 +2,51 @@ import os
 import json
 import pytest
 from upcloud_api import Server, IPAddress, Storage, Tag, FirewallRule
+from upcloud_api.errors import UpCloudAPIError
 from modules.upcloud_tag import TagManager
 from modules.upcloud_firewall import FirewallManager
 from modules.upcloud import ServerManager
+from module_utils.upcloud_resolver import ServerResolver
+from module_utils.upcloud_wait import StateWatcher
+from test.api_standin import StandInState, APIStandIn
+
+
+class MockedAPI:
+    def __init__(self, manager):
+        self.manager = manager
+
+    def get_request(self, endpoint, params=None, timeout=-1):
+        if endpoint == "/server":
+            return self.manager.read_json_data("server_populated")
+
+        if endpoint == "/ip_address":
+            return self.manager.read_json_data("ip_address")
+
+        if endpoint.startswith("/ip_address/"):
+            address = endpoint.split("/")[2]
+            data = self.manager.read_json_data("ip_address")
+            for ip_address in data["ip_addresses"]["ip_address"]:
+                if ip_address["address"] == address:
+                    return {"ip_address": ip_address}
+            raise UpCloudAPIError(
+                "IP_ADDRESS_NOT_FOUND", "IP address not found in test data"
+            )
+
+        if endpoint.startswith("/server/"):
+            uuid = endpoint.split("/")[2]
+            data = self.manager.read_json_data("server_populated")
+            for server in data["servers"]["server"]:
+                if server["uuid"] == uuid:
+                    return {"server": server}
+            raise UpCloudAPIError("SERVER_NOT_FOUND", "Server not found in test data")
+
+        raise Exception("No test data for endpoint: {}".format(endpoint))
 
 
 class MockedManager:
+    def __init__(self):
+        self.api = MockedAPI(self)
+
     def get_servers(self, populate=False):
         servers = (
             self.read_json_data("server").get("servers").get("server")
@@ -45,11 +84,11 @@ class MockedManager:
             if server.get("uuid") == uuid:
                 server_data = server
         IPAddresses = IPAddress._create_ip_address_objs(
-            server.pop("ip_addresses"), cloud_manager=self
+            server_data.pop("ip_addresses"), cloud_manager=self
         )
 
         storages = Storage._create_storage_objs(
-            server.pop("storage_devices"), cloud_manager=self
+            server_data.pop("storage_devices"), cloud_manager=self
         )
         return server_data, IPAddresses, storages
 
@@ -89,16 +128,21 @@ class MockedManager:
 class MockedServerManager(ServerManager):
     def __init__(self, manager):
         self.manager = manager
+        self.resolver = ServerResolver(manager)
+        self.watcher = StateWatcher(manager)
 
 
 class MockedTagManager(TagManager):
     def __init__(self, manager):
         self.manager = manager
+        self.resolver = ServerResolver(manager)
+        self.tag_index = None
 
 
 class MockedFirewallManager(FirewallManager):
     def __init__(self, manager):
         self.manager = manager
+        self.resolver = ServerResolver(manager)
 
 
 @pytest.fixture(scope="module")
@@ -122,3 +166,13 @@ def tag_manager():
 def firewall_manager():
     manager = MockedManager()
     return MockedFirewallManager(manager)
+
+
+@pytest.fixture
+def api_standin():
+    """A local HTTP stand-in for UpCloud's API serving the json_data fixtures"""
+    state = StandInState.from_json_data(
+        os.path.join(os.path.dirname(__file__), "json_data")
+    )
+    with APIStandIn(state) as standin:
+        yield standin
@@ -0,0 +1,236 @@
+import os
+import stat
+import threading
+import pytest
+from ansible.errors import AnsibleError
+from ansible.parsing.dataloader import DataLoader
+from ansible.plugins.loader import module_loader
+from ansible.template import Templar
+from action_plugins import upcloud_tag, upcloud_firewall
+from action_plugins.upcloud_batch import batch_directory, group_hosts, split_results
+
+try:
+    from ansible.template import trust_as_template
+except ImportError:
+    # before ansible-core 2.19, templates need no trust and the task evaluates its when:
+    trust_as_template = None
+
+# ModuleArgsParser resolves the task's action among the modules
+module_loader.add_directory(
+    os.path.join(os.path.dirname(os.path.dirname(__file__)), "modules")
+)
+
+
+class FakeTask(object):
+    _uuid = "task-uuid"
+    action = "upcloud_tag"
+    loop = None
+    until = []
+    async_val = 0
+    check_mode = False
+
+    def __init__(self, ds=None, when=(), args=None, **attributes):
+        self.ds = ds
+        self.when = list(when)
+        self.args = args or {}
+        self.__dict__.update(attributes)
+
+    def get_ds(self):
+        return self.ds
+
+
+class FakeShell(object):
+    tmpdir = "/tmp/ansible-tmp-task"
+
+
+class FakeConnection(object):
+    _shell = FakeShell()
+
+
+def action(action_class, task=None):
+    plugin = action_class.__new__(action_class)
+    plugin._task = task or FakeTask()
+    return plugin
+
+
+def run_action(task, task_vars=None):
+    """Runs the upcloud_tag action plugin with task, recording its module runs and tmp removals"""
+    plugin = action(upcloud_tag.ActionModule, task)
+    plugin._connection = FakeConnection()
+    modules = []
+    removed = []
+
+    def execute_module(**kwargs):
+        modules.append(kwargs)
+        return dict(changed=True)
+
+    plugin._execute_module = execute_module
+    plugin._remove_tmp_path = removed.append
+    return plugin.run(task_vars=task_vars or {}), modules, removed
+
+
+class TestActionPlugins(object):
+    def test_group_hosts(self):
+        rule = {"direction": "in", "action": "drop"}
+        host_args = {
+            "a": dict(hostname="a.example.com", firewall_rules=[rule]),
+            "b": dict(uuid="b-uuid", firewall_rules=[rule]),
+            "c": dict(hostname="c.example.com", firewall_rules=[]),
+            "d": dict(firewall_rules=[rule]),
+            "e": dict(zone="fi-hel1", firewall_rules=[rule]),
+        }
+        plugin = action(upcloud_firewall.ActionModule)
+        groups = group_hosts(host_args, plugin.batchable)
+        assert [sorted(hosts) for _, hosts in groups] == [["a", "b"], ["c"]]
+
+        shared, hosts_args = groups[0]
+        assert plugin.bulk_args(shared, hosts_args) == dict(
+            firewall_rules=[rule], targets=["a.example.com", "b-uuid"]
+        )
+
+    def test_tag_bulk_args(self):
+        host_args = {
+            "a": dict(hostname="a.example.com", tags=["web", "fi"]),
+            "b": dict(ip_address="10.0.0.2", tags=["web", "uk"]),
+            "c": dict(hostname="c.example.com", tags=["web"], state="absent"),
+            "d": dict(server_tags={"d.example.com": ["web"]}),
+        }
+        plugin = action(upcloud_tag.ActionModule)
+        groups = group_hosts(host_args, plugin.batchable, plugin.HOST_KEYS)
+        assert len(groups) == 2
+
+        shared, hosts_args = groups[0]
+        assert plugin.bulk_args(shared, hosts_args) == dict(
+            server_tags={"a.example.com": ["web", "fi"], "10.0.0.2": ["web", "uk"]}
+        )
+        shared, hosts_args = groups[1]
+        assert plugin.bulk_args(shared, hosts_args) == dict(
+            state="absent", server_tags={"c.example.com": ["web"]}
+        )
+
+    def test_split_results(self):
+        module_result = dict(
+            changed=True,
+            failed=True,
+            compacted_rules=[],
+            servers=[
+                dict(target="a.example.com", uuid="1", changed=True),
+                dict(target="b-uuid", changed=False, failed=True, msg="broken"),
+            ],
+        )
+        host_results = split_results(
+            module_result,
+            {"a": "a.example.com", "b": "b-uuid", "c": "c.example.com"},
+            ["compacted_rules"],
+        )
+        assert host_results["a"] == dict(
+            target="a.example.com", uuid="1", changed=True, compacted_rules=[]
+        )
+        assert host_results["b"]["failed"] and host_results["b"]["msg"] == "broken"
+        assert host_results["c"]["failed"]
+
+        # a module that failed as a whole fails every host
+        host_results = split_results(
+            dict(failed=True, msg="auth"), {"a": "a.example.com"}, []
+        )
+        assert host_results["a"] == dict(changed=False, failed=True, msg="auth")
+
+    def test_one_fork_runs_the_batch(self, monkeypatch, tmpdir):
+        monkeypatch.setattr("ansible.constants.DEFAULT_LOCAL_TMP", str(tmpdir))
+        hosts = ["host{}".format(i) for i in range(8)]
+        batches = []
+
+        class CountingAction(upcloud_tag.ActionModule):
+            def run_batch(self, hosts, task_vars):
+                batches.append(hosts)
+                return dict((host, dict(changed=True, host=host)) for host in hosts)
+
+        results = {}
+
+        def fork(host):
+            plugin = action(CountingAction)
+            results[host] = plugin.batch_result(host, hosts, {})
+
+        threads = [threading.Thread(target=fork, args=(host,)) for host in hosts]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert len(batches) == 1
+        assert all(results[host]["host"] == host for host in hosts)
+
+    @pytest.mark.skipif(
+        trust_as_template is None,
+        reason="the templar evaluates when: since ansible-core 2.19",
+    )
+    def test_when_skips_hosts(self):
+        task = FakeTask(
+            {
+                "upcloud_tag": {
+                    "hostname": trust_as_template(
+                        "{{ inventory_hostname }}.example.com"
+                    ),
+                    "tags": ["web"],
+                    "batch": True,
+                }
+            },
+            when=[trust_as_template("'web' in group_names")],
+        )
+        plugin = action(upcloud_tag.ActionModule, task)
+        plugin._templar = Templar(loader=DataLoader())
+        hostvars = dict(
+            (host, dict(inventory_hostname=host, group_names=groups))
+            for host, groups in [("a", ["web"]), ("b", []), ("c", ["web", "db"])]
+        )
+
+        host_args = plugin.host_args(["a", "b", "c"], dict(hostvars=hostvars))
+        assert sorted(host_args) == ["a", "c"]
+        assert host_args["a"] == dict(hostname="a.example.com", tags=["web"])
+
+    def test_batch_directory_is_private(self, monkeypatch, tmpdir):
+        monkeypatch.setattr("ansible.constants.DEFAULT_LOCAL_TMP", str(tmpdir))
+        directory = batch_directory()
+        assert stat.S_IMODE(os.stat(directory).st_mode) == 0o700
+
+        # the lock file is not opened through a symlink
+        plugin = action(upcloud_tag.ActionModule)
+        path = plugin.batch_path(["a", "b"])
+        os.symlink(str(tmpdir.join("elsewhere")), path + ".lock")
+        with pytest.raises(OSError):
+            plugin.batch_result("a", ["a", "b"], {})
+        assert not tmpdir.join("elsewhere").exists()
+
+        os.chmod(directory, 0o755)
+        with pytest.raises(AnsibleError):
+            batch_directory()
+
+    def test_run_like_normal_action(self):
+        args = dict(hostname="a.example.com", tags=["web"])
+        result, modules, removed = run_action(FakeTask(args=args))
+        assert result == dict(changed=True)
+        assert modules[0]["module_args"] == args
+        assert removed == ["/tmp/ansible-tmp-task"]
+
+        # an async task keeps its tmp path for the async wrapper
+        result, modules, removed = run_action(FakeTask(args=args, async_val=60))
+        assert modules[0]["wrap_async"] == 60
+        assert removed == []
+
+        # a retried task runs its module every time instead of reading the batch
+        task_vars = dict(inventory_hostname="a", ansible_play_batch=["a", "b"])
+        result, modules, removed = run_action(
+            FakeTask(args=dict(args, batch=True), until=["result is success"]),
+            task_vars,
+        )
+        assert [module["module_args"] for module in modules] == [args]
+
+    def test_batch_module_is_loaded_by_path(self):
+        batch = upcloud_tag.upcloud_batch
+        assert batch is upcloud_firewall.upcloud_batch
+        assert batch.__name__ == "upcloud_ansible_batch"
+        assert batch.__file__ == os.path.join(
+            os.path.dirname(os.path.dirname(os.path.realpath(__file__))),
+            "action_plugins",
+            "upcloud_batch.py",
+        )
@@ -0,0 +1,168 @@
+import io
+import json
+import pytest
+import requests
+from upcloud_api.errors import UpCloudAPIError
+from inventory.upcloud import build_inventory, stream_servers
+from modules import upcloud, upcloud_tag, upcloud_firewall
+from test.api_standin import StandInState, APIStandIn, StandInModule, run_module
+
+SERVER_UUID = "008c365d-d307-4501-8efc-cd6d3bb0e494"
+
+
+def api_get(standin, endpoint, **kwargs):
+    return requests.get(
+        standin.url + endpoint, headers={"Authorization": "Basic dGVzdA=="}, **kwargs
+    )
+
+
+class TestAPIStandIn(object):
+    def test_inventory(self, api_standin, manager):
+        inventory = build_inventory(api_standin.cloud_manager(), True, False, "IPv4")
+        expected = build_inventory(manager, True, False, "IPv4")
+        hostvars = inventory.pop("_meta")["hostvars"]
+        assert hostvars.keys() == expected.pop("_meta")["hostvars"].keys()
+        assert inventory == expected
+        assert api_standin.count("GET", "/server") == 1
+        assert api_standin.count("GET", "/ip_address") == 1
+
+    def test_stream_servers(self, api_standin):
+        out = io.StringIO()
+        stream_servers(api_standin.cloud_manager(), out, True, False, "IPv4")
+        inventory = json.loads(out.getvalue())
+        assert inventory == build_inventory(
+            api_standin.cloud_manager(), True, False, "IPv4"
+        )
+
+    def test_tag_module(self, api_standin):
+        params = dict(state="present", uuid=SERVER_UUID, tags=["web1", "london"])
+        tag_manager = upcloud_tag.TagManager("user", "passwd", StandInModule(**params))
+        api_standin.connect(tag_manager.manager)
+
+        result = run_module(upcloud_tag.run, StandInModule(**params), tag_manager)
+        assert result["changed"]
+        assert sorted(tag_manager.get_host_tags(SERVER_UUID)) == ["london", "web1"]
+
+        result = run_module(upcloud_tag.run, StandInModule(**params), tag_manager)
+        assert not result["changed"]
+
+        params["state"] = "absent"
+        result = run_module(upcloud_tag.run, StandInModule(**params), tag_manager)
+        assert result["changed"]
+        assert tag_manager.get_host_tags(SERVER_UUID) == []
+
+    def test_firewall_module(self, api_standin):
+        rule = {
+            "direction": "in",
+            "family": "IPv4",
+            "protocol": "tcp",
+            "destination_port_start": "443",
+            "destination_port_end": "443",
+            "action": "accept",
+        }
+        params = dict(state="present", hostname="fi.example.com", firewall_rules=[rule])
+        firewall_manager = upcloud_firewall.FirewallManager(
+            "user", "passwd", StandInModule(**params)
+        )
+        manager = api_standin.connect(firewall_manager.manager)
+        rule_count = len(manager.get_firewall_rules(SERVER_UUID))
+
+        result = run_module(
+            upcloud_firewall.run, StandInModule(**params), firewall_manager
+        )
+        assert result["changed"]
+        assert len(manager.get_firewall_rules(SERVER_UUID)) == rule_count + 1
+
+        params["state"] = "absent"
+        result = run_module(
+            upcloud_firewall.run, StandInModule(**params), firewall_manager
+        )
+        assert result["changed"]
+        assert len(manager.get_firewall_rules(SERVER_UUID)) == rule_count
+
+    def test_upcloud_module(self, api_standin):
+        params = dict(
+            state="present",
+            uuid=None,
+            hostname="new.example.com",
+            title="new.example.com",
+            zone="fi-hel1",
+            plan="1xCPU-1GB",
+            storage_devices=[
+                {"size": 10, "os": "01000000-0000-4000-8000-000030200200"}
+            ],
+            api_user="user",
+            api_passwd="passwd",
+            user=None,
+            ssh_keys=None,
+        )
+        server_manager = upcloud.ServerManager(
+            "user", "passwd", 10, StandInModule(**params)
+        )
+        api_standin.connect(server_manager.manager)
+
+        result = run_module(upcloud.run, StandInModule(**params), server_manager)
+        assert result["changed"]
+        assert result["public_ip"]
+        uuid = result["server"]["uuid"]
+
+        result = run_module(upcloud.run, StandInModule(**params), server_manager)
+        assert not result["changed"]
+
+        # a stopped server is destroyed without polling for the state change
+        api_standin.state.set_server_state(uuid, "stopped")
+        params.update(state="absent", uuid=uuid)
+        result = run_module(upcloud.run, StandInModule(**params), server_manager)
+        assert result["changed"]
+        with pytest.raises(UpCloudAPIError):
+            server_manager.manager.get_server(uuid)
+
+    def test_errors(self, api_standin):
+        manager = api_standin.cloud_manager()
+        with pytest.raises(UpCloudAPIError) as error_info:
+            manager.get_server("00000000-0000-0000-0000-000000000000")
+        assert error_info.value.error_code == "SERVER_NOT_FOUND"
+
+        assert requests.get(api_standin.url + "/server").status_code == 401
+
+    def test_pagination(self, api_standin):
+        servers = api_get(api_standin, "/server").json()["servers"]["server"]
+        page = api_get(api_standin, "/server", params={"limit": 1, "offset": 1}).json()
+        assert page["servers"]["server"] == servers[1:2]
+
+        api_standin.max_page_size = 1
+        page = api_get(api_standin, "/server").json()
+        assert page["servers"]["server"] == servers[:1]
+
+    def test_rate_limit(self, api_standin):
+        api_standin.rate_limit = 2
+        api_standin.rate_window = 60
+
+        statuses = [api_get(api_standin, "/tag").status_code for _ in range(3)]
+        assert statuses == [200, 200, 429]
+
+        response = api_get(api_standin, "/tag")
+        assert response.json()["error"]["error_code"] == "TOO_MANY_REQUESTS"
+        assert 0 < int(response.headers["Retry-After"]) <= 60
+        assert api_standin.count(status=429) == 2
+
+    def test_latency_and_connections(self):
+        delays = []
+        state = StandInState(
+            servers=[
+                {"uuid": "1", "hostname": "a.example.com", "state": "started"},
+            ]
+        )
+
+        def latency(method, path):
+            delays.append((method, path))
+            return 0.01
+
+        with APIStandIn(state, latency=latency) as standin:
+            with requests.Session() as session:
+                for _ in range(3):
+                    session.get(standin.url + "/server", headers={"Authorization": "x"})
+
+            assert delays == [("GET", "/1.3/server")] * 3
+            # the session reuses a single keep-alive connection
+            assert standin.connections == 1
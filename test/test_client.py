@@ -0,0 +1,80 @@
+import io
+import json
+import pytest
+import requests
+from upcloud_api.errors import UpCloudAPIError
+from inventory.upcloud import build_inventory, stream_servers
+from module_utils.upcloud_client import SessionAPI, create_cloud_manager
+from modules import upcloud_tag
+from test.api_standin import StandInModule, run_module
+
+SERVER_UUID = "008c365d-d307-4501-8efc-cd6d3bb0e494"
+
+
+def session_manager(standin, **kwargs):
+    return standin.connect(create_cloud_manager("user", "passwd", 10, **kwargs))
+
+
+class TestClient(object):
+    def test_session_reuses_connections(self, api_standin):
+        manager = session_manager(api_standin)
+        manager.get_servers()
+        manager.get_tags()
+        manager.get_ips()
+        assert api_standin.count() == 3
+        assert api_standin.connections == 1
+
+    def test_compressed_responses(self, api_standin):
+        manager = session_manager(api_standin)
+        servers = manager.api.get_request("/server")
+        compressed = api_standin.bytes_sent
+
+        api_standin.reset_stats()
+        plain = requests.get(
+            api_standin.url + "/server",
+            headers={"Authorization": "x", "Accept-Encoding": "identity"},
+        )
+        assert plain.json() == servers
+        assert compressed < api_standin.bytes_sent
+
+    def test_errors(self, api_standin):
+        manager = session_manager(api_standin)
+        with pytest.raises(UpCloudAPIError) as error_info:
+            manager.get_server("00000000-0000-0000-0000-000000000000")
+        assert error_info.value.error_code == "SERVER_NOT_FOUND"
+
+    def test_timeouts(self):
+        api = SessionAPI("token", timeout=30, connect_timeout=5)
+        assert api.request_timeout() == (5, 30)
+        assert api.request_timeout(60) == (5, 60)
+        assert (
+            SessionAPI("token", timeout=30, connect_timeout=None).request_timeout()
+            == 30
+        )
+
+    def test_pool_size(self):
+        api = SessionAPI("token", pool_size=25)
+        assert api.session.get_adapter("https://api.upcloud.com")._pool_maxsize == 25
+
+    def test_inventory(self, api_standin):
+        manager = session_manager(api_standin, pool_size=4)
+        build_inventory(manager, True, False, "IPv4", populate=True, detail_workers=4)
+
+        out = io.StringIO()
+        stream_servers(manager, out, True, False, "IPv4")
+        assert "uc_all" in json.loads(out.getvalue())
+
+        # the listings and concurrent detail requests share the pool
+        assert api_standin.connections <= 4
+
+    def test_module_session(self, api_standin):
+        params = dict(state="present", uuid=SERVER_UUID, tags=["db"], workers=10)
+        tag_manager = upcloud_tag.TagManager("user", "passwd", StandInModule(**params))
+        assert isinstance(tag_manager.manager.api, SessionAPI)
+        api_standin.connect(tag_manager.manager)
+
+        result = run_module(upcloud_tag.run, StandInModule(**params), tag_manager)
+        assert result["changed"]
+        # tag listing, tag creation and assignment over one connection
+        assert api_standin.count() == 3
+        assert api_standin.connections == 1
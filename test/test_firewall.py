@@ -1,3 +1,60 @@
+from upcloud_api import FirewallRule
+from modules import upcloud_firewall
+from modules.upcloud_firewall import (
+    canonical_value,
+    compact_firewall_rules,
+    rules_differ,
+    rules_fingerprint,
+    FirewallRuleIndex,
+    FingerprintStore,
+)
+from test.api_standin import StandInState, APIStandIn, StandInModule, run_module
+
+SERVER_UUID = "008c365d-d307-4501-8efc-cd6d3bb0e494"
+
+
+def port_rule(port, action="accept"):
+    return {
+        "direction": "in",
+        "family": "IPv4",
+        "protocol": "tcp",
+        "destination_port_start": str(port),
+        "destination_port_end": str(port),
+        "action": action,
+    }
+
+
+def port_range_rule(start, end, action="accept", **fields):
+    return dict(
+        port_rule(start, action),
+        destination_port_start=str(start),
+        destination_port_end=str(end),
+        **fields
+    )
+
+
+def run_firewall(standin, failed=False, manager_class=None, **params):
+    if not any(params.get(selector) for selector in upcloud_firewall.SELECTORS):
+        params.setdefault("uuid", SERVER_UUID)
+    params.setdefault("state", "present")
+    params.setdefault("workers", 10)
+    module = StandInModule(**params)
+    manager_class = manager_class or upcloud_firewall.FirewallManager
+    firewall_manager = manager_class("user", "passwd", module)
+    standin.connect(firewall_manager.manager)
+    return run_module(upcloud_firewall.run, module, firewall_manager, failed=failed)
+
+
+def firewall_standin(rules):
+    state = StandInState(
+        servers=[
+            {"uuid": SERVER_UUID, "hostname": "fi.example.com", "state": "started"}
+        ],
+        firewall_rules={SERVER_UUID: rules},
+    )
+    return APIStandIn(state)
+
+
 class TestFirewall(object):
     def test_match_firewall_rules(self, firewall_manager):
         firewall_rules = firewall_manager.manager.get_firewall_rules()
@@ -15,3 +72,422 @@ class TestFirewall(object):
                 str(matched_rule_count),
             )
             matched_rule_count += 1
+
+    def test_find_matching_positions(self, firewall_manager):
+        firewall_rules = firewall_manager.manager.get_firewall_rules()
+        assert firewall_manager.find_matching_positions(
+            [{"direction": "in"}], firewall_rules
+        ) == list(range(1, len(firewall_rules) + 1))
+        assert firewall_manager.find_matching_positions(
+            [{"position": "2"}, {"destination_port_start": "80"}], firewall_rules
+        ) == [1, 2]
+        assert (
+            firewall_manager.find_matching_positions([{"action": "x"}], firewall_rules)
+            == []
+        )
+
+    def test_absent_single_pass(self):
+        # every sixth of 300 rules is a reject rule, removing 50 of them
+        rules = [
+            port_rule(port, "reject" if port % 6 == 0 else "accept")
+            for port in range(300)
+        ]
+        with firewall_standin(rules) as standin:
+            result = run_firewall(
+                standin, state="absent", firewall_rules=[{"action": "reject"}]
+            )
+            assert result["changed"]
+
+            assert standin.count("GET") == 1
+            assert standin.count("DELETE") == 50
+            remaining = standin.state.list_firewall_rules(SERVER_UUID)
+            assert [rule["destination_port_start"] for rule in remaining] == [
+                str(port) for port in range(300) if port % 6
+            ]
+
+    def test_absent_position(self):
+        with firewall_standin([port_rule(port) for port in range(3)]) as standin:
+            run_firewall(standin, state="absent", firewall_rules=[{"position": 1}])
+            remaining = standin.state.list_firewall_rules(SERVER_UUID)
+            assert [rule["destination_port_start"] for rule in remaining] == ["1", "2"]
+
+    def test_canonical_value(self):
+        assert canonical_value("destination_port_end", None) == ""
+        assert canonical_value("destination_port_end", "") == ""
+        assert canonical_value("destination_port_end", 22) == "22"
+        assert canonical_value("destination_port_end", "022") == "22"
+        assert canonical_value("protocol", "TCP") == "tcp"
+        assert canonical_value("family", "ipv4") == canonical_value("family", "IPv4")
+        assert (
+            canonical_value("source_address_start", "2A04:3540::0001") == "2a04:3540::1"
+        )
+        assert canonical_value("comment", "Keep Case") == "Keep Case"
+
+    def test_equivalent_rules_match(self, firewall_manager):
+        host_rule = FirewallRule(
+            position="1",
+            direction="in",
+            family="IPv4",
+            protocol="tcp",
+            destination_port_start="22",
+            destination_port_end="22",
+            source_address_start="",
+            action="accept",
+        )
+        given_rule = {
+            "direction": "IN",
+            "family": "ipv4",
+            "protocol": "TCP",
+            "destination_port_start": 22,
+            "destination_port_end": "22",
+            "source_address_start": None,
+            "source_address_end": "",
+            "action": "accept",
+        }
+        assert firewall_manager.match_firewall_rules(given_rule, [host_rule]) == (
+            True,
+            "1",
+        )
+        assert FirewallRuleIndex([host_rule]).matches(given_rule) == [host_rule]
+
+        given_rule["destination_port_end"] = "23"
+        assert firewall_manager.match_firewall_rules(given_rule, [host_rule]) == (
+            False,
+            -1,
+        )
+        assert FirewallRuleIndex([host_rule]).matches(given_rule) == []
+
+    def test_present_equivalent_rules(self):
+        with firewall_standin([port_rule(port) for port in range(300)]) as standin:
+            # the same rules, written differently
+            given_rules = [
+                dict(port_rule(port), protocol="TCP", icmp_type=None)
+                for port in range(300)
+            ]
+            # a new rule given twice is created once
+            given_rules += [port_rule(8080)] * 2
+
+            result = run_firewall(standin, state="present", firewall_rules=given_rules)
+            assert result["changed"]
+            assert standin.count("POST") == 1
+            assert len(standin.state.list_firewall_rules(SERVER_UUID)) == 301
+
+            result = run_firewall(standin, state="present", firewall_rules=given_rules)
+            assert not result["changed"]
+
+    def test_rules_differ(self):
+        host_rules = [
+            FirewallRule(position=str(i + 1), **port_rule(i)) for i in range(3)
+        ]
+        given_rules = [dict(port_rule(i), protocol="TCP") for i in range(3)]
+        assert not rules_differ(given_rules, host_rules)
+        assert rules_differ(given_rules[::-1], host_rules)
+        assert rules_differ(given_rules[:2], host_rules)
+
+        # missing fields are empty in exact mode, not wildcards
+        del given_rules[0]["destination_port_end"]
+        assert rules_differ(given_rules, host_rules)
+
+    def test_exact(self):
+        with firewall_standin([port_rule(port) for port in range(200)]) as standin:
+            given_rules = [port_rule(port) for port in range(100, 300)]
+            result = run_firewall(standin, state="exact", firewall_rules=given_rules)
+            assert result["changed"]
+            assert standin.count("GET") == 1
+            assert standin.count("PUT") == 1
+            assert standin.count("POST") == standin.count("DELETE") == 0
+
+            rules = standin.state.list_firewall_rules(SERVER_UUID)
+            assert [rule["destination_port_start"] for rule in rules] == [
+                str(port) for port in range(100, 300)
+            ]
+            assert rules[0]["position"] == "1"
+
+            result = run_firewall(standin, state="exact", firewall_rules=given_rules)
+            assert not result["changed"]
+            assert standin.count("PUT") == 1
+
+    def test_selectors(self):
+        servers = [
+            {
+                "uuid": "server-{}".format(i),
+                "hostname": "server{}.example.com".format(i),
+                "state": "started",
+                "zone": "fi-hel1" if i % 2 else "de-fra1",
+                "tags": {"tag": ["web", "prod"] if i < 6 else ["db"]},
+            }
+            for i in range(8)
+        ]
+        state = StandInState(servers=servers)
+        with APIStandIn(state) as standin:
+            result = run_firewall(
+                standin,
+                tags=["web", "prod"],
+                zone="fi-hel1",
+                firewall_rules=[port_rule(443)],
+            )
+            assert [server["uuid"] for server in result["servers"]] == [
+                "server-1",
+                "server-3",
+                "server-5",
+            ]
+            assert result["summary"] == dict(
+                selected=3, changed=3, compliant=0, failed=0
+            )
+            # one server listing, then one rule listing and one create per server
+            assert standin.requests.count(("GET", "/1.3/server", 200)) == 1
+            assert standin.count("POST") == 3
+
+            result = run_firewall(
+                standin, uuids=["server-1", "server-2"], firewall_rules=[port_rule(443)]
+            )
+            assert [server["changed"] for server in result["servers"]] == [False, True]
+
+            # a uuid that matches no server fails instead of selecting nothing
+            result = run_firewall(
+                standin,
+                failed=True,
+                uuids=["server-1", "server-x"],
+                firewall_rules=[port_rule(443)],
+            )
+            assert result["summary"] == dict(
+                selected=2, changed=0, compliant=1, failed=1
+            )
+            assert result["servers"][1]["uuid"] == "server-x"
+            assert "server-x" in result["servers"][1]["msg"]
+
+    def test_selector_targets(self, api_standin):
+        result = run_firewall(
+            api_standin,
+            failed=True,
+            targets=["fi.example.com", SERVER_UUID, "missing.example.com"],
+            firewall_rules=[port_rule(443)],
+        )
+        fi_result, uuid_result, missing = result["servers"]
+        assert fi_result["target"] == "fi.example.com" and fi_result["changed"]
+        assert uuid_result["uuid"] == fi_result["uuid"] == SERVER_UUID
+        assert "missing.example.com" in missing["msg"]
+        # both targets are the same server, which gets the rule once
+        assert api_standin.count("POST") == 1
+
+    def test_selectors_failures(self):
+        class FailingFirewallManager(upcloud_firewall.FirewallManager):
+            def reconcile(self, uuid, state, firewall_rules):
+                if uuid == "server-1":
+                    raise Exception("broken")
+                return super().reconcile(uuid, state, firewall_rules)
+
+        state = StandInState(
+            servers=[
+                {
+                    "uuid": "server-{}".format(i),
+                    "hostname": "s{}".format(i),
+                    "zone": "fi-hel1",
+                }
+                for i in range(3)
+            ]
+        )
+        with APIStandIn(state) as standin:
+            result = run_firewall(
+                standin,
+                failed=True,
+                manager_class=FailingFirewallManager,
+                zone="fi-hel1",
+                firewall_rules=[port_rule(443)],
+            )
+            assert result["summary"] == dict(
+                selected=3, changed=2, compliant=0, failed=1
+            )
+            assert result["servers"][1] == dict(
+                uuid="server-1", hostname="s1", changed=False, failed=True, msg="broken"
+            )
+
+    def test_rules_fingerprint(self):
+        rules = [port_rule(22), port_rule(80)]
+        equivalent = [
+            dict(port_rule(80), protocol="TCP"),
+            dict(port_rule(22), family="ipv4"),
+        ]
+        assert rules_fingerprint("present", rules) == rules_fingerprint(
+            "present", equivalent
+        )
+        assert rules_fingerprint("present", rules) != rules_fingerprint("absent", rules)
+        assert rules_fingerprint("exact", rules) != rules_fingerprint(
+            "exact", rules[::-1]
+        )
+        assert rules_fingerprint("present", rules) != rules_fingerprint(
+            "present", rules[:1]
+        )
+
+    def test_fingerprint_store(self, tmpdir):
+        path = str(tmpdir.join("state", "fingerprints.json"))
+        store = FingerprintStore(path, 60)
+        assert not store.is_current("a", "f1")
+        store.record("a", "f1")
+        store.save()
+
+        # another task recorded a server in the meantime
+        other = FingerprintStore(path, 60)
+        other.record("b", "f2")
+        other.save()
+
+        store = FingerprintStore(path, 60)
+        assert store.is_current("a", "f1") and store.is_current("b", "f2")
+        assert not store.is_current("a", "f2")
+        assert not FingerprintStore(path, -1).is_current("a", "f1")
+
+    def test_fingerprint_skips_compliant_servers(self, tmpdir):
+        servers = [
+            {
+                "uuid": "server-{}".format(i),
+                "hostname": "s{}".format(i),
+                "zone": "fi-hel1",
+            }
+            for i in range(4)
+        ]
+        path = str(tmpdir.join("fingerprints.json"))
+        params = dict(
+            state="exact",
+            zone="fi-hel1",
+            fingerprint_file=path,
+            fingerprint_max_age=3600,
+            firewall_rules=[port_rule(22), port_rule(443)],
+        )
+        with APIStandIn(StandInState(servers=servers)) as standin:
+            result = run_firewall(standin, **params)
+            assert result["summary"] == dict(
+                selected=4, changed=4, compliant=0, failed=0
+            )
+
+            standin.reset_stats()
+            result = run_firewall(standin, **params)
+            assert result["summary"] == dict(
+                selected=4, changed=0, compliant=4, failed=0
+            )
+            # only the server listing, no rule listings
+            assert standin.count() == 1
+
+            # a different policy is applied again
+            params["firewall_rules"] = [port_rule(22)]
+            result = run_firewall(standin, **params)
+            assert result["summary"]["changed"] == 4
+
+            # so is the same policy once the fingerprints expire
+            params["fingerprint_max_age"] = -1
+            standin.reset_stats()
+            result = run_firewall(standin, **params)
+            assert result["summary"] == dict(
+                selected=4, changed=0, compliant=4, failed=0
+            )
+            assert standin.count("GET") == 1 + 4
+
+    def test_compact_ranges(self):
+        rules = [
+            port_range_rule(80, 80),
+            port_range_rule(81, 81, comment="duplicate below"),
+            port_range_rule(82, 90),
+            port_range_rule(81, 81),
+            port_range_rule(100, 110),
+            port_range_rule(111, 120),
+        ]
+        compacted = compact_firewall_rules(rules)
+        assert [
+            (rule["destination_port_start"], rule["destination_port_end"])
+            for rule in compacted
+        ] == [("80", "90"), ("100", "120")]
+        assert "comment" not in compacted[0]
+
+        addresses = [
+            dict(
+                port_rule(22),
+                source_address_start="10.0.0.0",
+                source_address_end="10.0.0.127",
+            ),
+            dict(
+                port_rule(22),
+                source_address_start="10.0.0.128",
+                source_address_end="10.0.0.255",
+            ),
+        ]
+        compacted = compact_firewall_rules(addresses)
+        assert len(compacted) == 1
+        assert compacted[0]["source_address_start"] == "10.0.0.0"
+        assert compacted[0]["source_address_end"] == "10.0.0.255"
+
+    def test_compact_preserves_order(self):
+        rules = [
+            port_range_rule(80, 80),
+            port_range_rule(81, 81, "drop"),
+            port_range_rule(82, 82),
+        ]
+        assert len(compact_firewall_rules(rules)) == 3
+
+        # a rule of another protocol ends the run
+        rules = [port_rule(80), dict(port_rule(81), protocol="udp"), port_rule(81)]
+        assert len(compact_firewall_rules(rules)) == 3
+
+        rules = [
+            port_rule(80),
+            port_rule(82),
+            port_rule(81),
+            {"direction": "in", "action": "drop"},
+        ]
+        compacted = compact_firewall_rules(rules)
+        assert len(compacted) == 2
+        assert compacted[1] == {"direction": "in", "action": "drop"}
+
+    def test_compact_only_one_range_differs(self):
+        rules = [
+            dict(
+                port_rule(80),
+                source_address_start="10.0.0.1",
+                source_address_end="10.0.0.1",
+            ),
+            dict(
+                port_rule(81),
+                source_address_start="10.0.0.2",
+                source_address_end="10.0.0.2",
+            ),
+        ]
+        assert len(compact_firewall_rules(rules)) == 2
+
+        # ... but merging one range can make another mergeable
+        rules += [
+            dict(
+                port_rule(81),
+                source_address_start="10.0.0.1",
+                source_address_end="10.0.0.1",
+            ),
+            dict(
+                port_rule(80),
+                source_address_start="10.0.0.2",
+                source_address_end="10.0.0.2",
+            ),
+        ]
+        compacted = compact_firewall_rules(rules)
+        assert len(compacted) == 1
+        assert compacted[0]["destination_port_end"] == "81"
+        assert compacted[0]["source_address_end"] == "10.0.0.2"
+
+        # unlimited ranges only merge with unlimited ranges
+        assert len(compact_firewall_rules([port_rule(80), {"direction": "in"}])) == 2
+
+    def test_compact_exact(self):
+        rules = [port_range_rule(port, port) for port in range(8000, 8200)]
+        rules.append({"direction": "in", "action": "drop"})
+        with firewall_standin([]) as standin:
+            result = run_firewall(
+                standin, state="exact", compact=True, firewall_rules=rules
+            )
+            assert len(result["compacted_rules"]) == 2
+
+            applied = standin.state.list_firewall_rules(SERVER_UUID)
+            assert len(applied) == 2
+            assert applied[0]["destination_port_start"] == "8000"
+            assert applied[0]["destination_port_end"] == "8199"
+            assert applied[1]["action"] == "drop"
+
+            result = run_firewall(
+                standin, state="exact", compact=True, firewall_rules=rules
+            )
+            assert not result["changed"]
@@ -1,5 +1,54 @@
+import os
+import io
+import json
+import pytest
 from itertools import product
-from inventory.upcloud import list_servers, get_server
+from inventory.upcloud import (
+    list_servers,
+    get_server,
+    populate_servers,
+    InventoryCache,
+    ServerIndex,
+    ServerRecord,
+    load_server_index,
+    JSONArrayStream,
+    stream_servers,
+    get_cache_key,
+)
+
+
+class UnreachableAPI:
+    def get_request(self, endpoint, *args, **kwargs):
+        raise AssertionError("the API should not be queried while the cache is fresh")
+
+
+class UnreachableManager:
+    api = UnreachableAPI()
+
+
+def chunked(text, size):
+    return [text[i : i + size] for i in range(0, len(text), size)]
+
+
+def fixture_chunks(manager, endpoint):
+    filenames = {"/server": "server", "/ip_address": "ip_address"}
+    text = json.dumps(manager.read_json_data(filenames[endpoint]), indent=2)
+    return chunked(text, 7)
+
+
+class CountingAPI(object):
+    def __init__(self, api):
+        self.api = api
+        self.calls = []
+
+    def get_request(self, endpoint, *args, **kwargs):
+        self.calls.append(endpoint)
+        return self.api.get_request(endpoint, *args, **kwargs)
+
+
+class CountingManager(object):
+    def __init__(self, manager):
+        self.api = CountingAPI(manager.api)
 
 
 class TestInventory(object):
@@ -17,6 +66,63 @@ class TestInventory(object):
                     assert servers.get("web1") == ["10.1.0.101"]
                     assert servers.get("fi_hel1") == ["10.1.0.101"]
 
+    def test_list_servers_hostvars(self, manager):
+        groups = list_servers(manager, True, False, "IPv4")
+        hostvars = groups["_meta"]["hostvars"]
+        assert list(hostvars) == ["10.1.0.101"]
+        assert (
+            hostvars["10.1.0.101"]["uc_uuid"] == "008c365d-d307-4501-8efc-cd6d3bb0e494"
+        )
+        assert hostvars["10.1.0.101"]["uc_tags"] == ["web1"]
+        assert hostvars["10.1.0.101"]["uc_ip_addresses"] == [
+            {"address": "10.1.0.101", "access": "public", "family": "IPv4"}
+        ]
+        json.dumps(groups)
+
+        groups = list_servers(manager, False, True, "IPv4")
+        hostvars = groups["_meta"]["hostvars"]
+        assert sorted(hostvars) == ["fi", "fi.example.com"]
+        assert hostvars["fi"]["uc_hostname"] == "fi.example.com"
+
+    def test_populate_servers(self, manager):
+        servers = [
+            ServerRecord.from_api(server)
+            for server in manager.read_json_data("server")["servers"]["server"]
+        ]
+        uuids = [server.uuid for server in servers]
+        assert not any("storage_devices" in server.fields for server in servers)
+
+        populated = populate_servers(manager, servers, 4)
+        assert [server.uuid for server in populated] == uuids
+        assert all("storage_devices" in server.fields for server in populated)
+        assert populated[1].public_ip("IPv4") == "10.1.0.103"
+
+    def test_server_record(self, manager):
+        server = manager.read_json_data("server_populated")["servers"]["server"][0]
+        record = ServerRecord.from_api(server)
+        assert not hasattr(record, "__dict__")
+        assert record.tags == ("web1",)
+        assert record.addresses == [("10.1.0.101", "public", "IPv4")]
+        assert record.public_ip("IPv6") == "10.1.0.101"
+
+        fields = record.to_dict()
+        assert fields["tags"] == ["web1"]
+        assert fields["ip_addresses"] == [
+            {"address": "10.1.0.101", "access": "public", "family": "IPv4"}
+        ]
+        assert fields["storage_devices"][0]["storage_size"] == 20
+
+        record.addresses = [("10.0.0.1", "private", "IPv4")]
+        assert record.public_ip("IPv4") is None
+
+    def test_list_servers_populated_hostvars(self, manager):
+        groups = list_servers(
+            manager, True, False, "IPv4", populate=True, detail_workers=4
+        )
+        hostvars = groups["_meta"]["hostvars"]["10.1.0.101"]
+        assert hostvars["uc_storage_devices"][0]["storage_size"] == 20
+        assert groups["uc_all"] == ["10.1.0.101"]
+
     def test_get_server(self, manager):
         search_items = ["008c365d-d307-4501-8efc-cd6d3bb0e494"]
         possible_configs = list(product([True, False], repeat=2))
@@ -27,3 +133,164 @@ class TestInventory(object):
             for config in possible_configs:
                 server = get_server(manager, search_item, config[0], config[1])
                 assert server.get("uc_uuid") == "008c365d-d307-4501-8efc-cd6d3bb0e494"
+
+    def test_list_servers_cache(self, manager, tmpdir):
+        cache_path = str(tmpdir.join("inventory.json"))
+        cache = InventoryCache(
+            cache_path, 300, get_cache_key("user", True, False, "IPv4")
+        )
+
+        groups = list_servers(manager, True, False, "IPv4", cache=cache)
+        assert os.path.exists(cache_path)
+        assert [name for name in os.listdir(str(tmpdir))] == ["inventory.json"]
+
+        cached_groups = list_servers(
+            UnreachableManager(), True, False, "IPv4", cache=cache
+        )
+        assert cached_groups == groups
+
+        refreshed_groups = list_servers(
+            manager, True, False, "IPv4", cache=cache, refresh_cache=True
+        )
+        assert refreshed_groups == groups
+
+    def test_list_servers_cache_invalidation(self, manager, tmpdir):
+        cache_path = str(tmpdir.join("inventory.json"))
+        cache = InventoryCache(
+            cache_path, 300, get_cache_key("user", True, False, "IPv4")
+        )
+        list_servers(manager, True, False, "IPv4", cache=cache)
+
+        other_settings = InventoryCache(
+            cache_path, 300, get_cache_key("user", False, False, "IPv4")
+        )
+        assert other_settings.read() is None
+
+        with open(cache_path, "r") as cache_file:
+            data = json.load(cache_file)
+        data["timestamp"] -= 301
+        with open(cache_path, "w") as cache_file:
+            json.dump(data, cache_file)
+        assert cache.read() is None
+
+        with open(cache_path, "w") as cache_file:
+            cache_file.write('{"key": "trunc')
+        assert cache.read() is None
+
+    def test_server_index(self, manager):
+        index = ServerIndex.build(manager, True)
+        uuid = "008c365d-d307-4501-8efc-cd6d3bb0e494"
+
+        assert index.lookup(uuid, False, False) == uuid
+        assert index.lookup("fi.example.com", False, False) == uuid
+        assert index.lookup("10.1.0.101", True, False) == uuid
+        assert index.lookup("10.1.0.101", False, False) is None
+        assert index.lookup("fi", False, True) == uuid
+        assert index.lookup("fi", False, False) is None
+        assert index.lookup("missing.example.com", True, True) is None
+
+        restored = ServerIndex.from_dict(json.loads(json.dumps(index.to_dict())))
+        assert restored.lookup("10.1.0.101", True, False) == uuid
+
+    def test_get_server_batch(self, manager):
+        counting_manager = CountingManager(manager)
+        index = ServerIndex.build(counting_manager, True)
+        assert counting_manager.api.calls == ["/server", "/ip_address"]
+
+        counting_manager.api.calls = []
+        response = get_server(
+            counting_manager,
+            "10.1.0.101,uk.example.com,missing,fi.example.com",
+            True,
+            index=index,
+            detail_workers=4,
+        )
+        assert sorted(counting_manager.api.calls) == [
+            "/server/008c365d-d307-4501-8efc-cd6d3bb0e494",
+            "/server/009d64ef-31d1-4684-a26b-c86c955cbf46",
+        ]
+        assert sorted(response) == [
+            "10.1.0.101",
+            "fi.example.com",
+            "missing",
+            "uk.example.com",
+        ]
+        assert response["10.1.0.101"] == response["fi.example.com"]
+        assert (
+            response["uk.example.com"]["uc_uuid"]
+            == "009d64ef-31d1-4684-a26b-c86c955cbf46"
+        )
+        assert response["missing"] == {}
+
+    def test_get_destroyed_server(self, manager):
+        # the server was destroyed after the index was cached
+        index = ServerIndex.build(manager, False)
+        index.uuids.add("00000000-0000-0000-0000-000000000000")
+        index.hostnames["gone.example.com"] = "00000000-0000-0000-0000-000000000000"
+
+        assert get_server(manager, "gone.example.com", False, index=index) == {}
+        response = get_server(
+            manager, "gone.example.com,fi.example.com", False, index=index
+        )
+        assert response["gone.example.com"] == {}
+        assert response["fi.example.com"]["uc_hostname"] == "fi.example.com"
+
+    def test_load_server_index_cache(self, manager, tmpdir):
+        cache = InventoryCache(
+            str(tmpdir.join("index.json")), 300, get_cache_key("user", True)
+        )
+        index = load_server_index(manager, True, cache)
+        cached_index = load_server_index(UnreachableManager(), True, cache)
+        assert cached_index.to_dict() == index.to_dict()
+
+    def test_json_array_stream(self):
+        document = json.dumps(
+            {
+                "meta": {"count": 12345, "nested": [1, {"a": "]}"}]},
+                "servers": {"before": 1.5, "server": [{"n": 1}, {"n": 22}, 333]},
+            }
+        )
+        for size in [1, 2, 5, len(document)]:
+            items = list(
+                JSONArrayStream(chunked(document, size), ("servers", "server"))
+            )
+            assert items == [{"n": 1}, {"n": 22}, 333]
+
+        empty = '{"servers": {"server": [ ]}}'
+        assert list(JSONArrayStream(chunked(empty, 3), ("servers", "server"))) == []
+
+        with pytest.raises(ValueError):
+            list(JSONArrayStream(['{"servers": {}}'], ("servers", "server")))
+
+        with pytest.raises(ValueError):
+            list(
+                JSONArrayStream(
+                    ['{"servers": {"server": [{"n": 1}, {"n"'], ("servers", "server")
+                )
+            )
+
+    def test_stream_servers(self, manager):
+        out = io.StringIO()
+        groups = stream_servers(
+            manager, out, True, False, "IPv4", fetch_chunks=fixture_chunks
+        )
+        inventory = json.loads(out.getvalue())
+
+        assert inventory["uc_all"] == ["10.1.0.101"]
+        assert inventory["web1"] == ["10.1.0.101"]
+        assert inventory["fi_hel1"] == ["10.1.0.101"]
+        assert groups["uc_all"] == ["10.1.0.101"]
+
+        hostvars = inventory["_meta"]["hostvars"]["10.1.0.101"]
+        assert hostvars["uc_uuid"] == "008c365d-d307-4501-8efc-cd6d3bb0e494"
+        assert hostvars["uc_tags"] == ["web1"]
+        assert hostvars["uc_title"] == "Helsinki server"
+        assert hostvars["uc_ip_addresses"] == [
+            {"address": "10.1.0.101", "access": "public", "family": "IPv4"}
+        ]
+
+        out = io.StringIO()
+        stream_servers(manager, out, False, True, "IPv4", fetch_chunks=fixture_chunks)
+        inventory = json.loads(out.getvalue())
+        assert inventory["uc_all"] == ["fi.example.com", "fi"]
+        assert sorted(inventory["_meta"]["hostvars"]) == ["fi", "fi.example.com"]
@@ -0,0 +1,82 @@
+import os
+import sys
+import pytest
+from ansible.inventory.data import InventoryData
+from ansible.parsing.dataloader import DataLoader
+from ansible.plugins.loader import inventory_loader
+
+
+class UnreachableAPI:
+    def get_request(self, endpoint, *args, **kwargs):
+        raise AssertionError("the API should not be queried when the cache is used")
+
+
+class UnreachableManager:
+    api = UnreachableAPI()
+
+
+@pytest.fixture
+def plugin():
+    inventory_loader.add_directory(
+        os.path.join(os.path.dirname(os.path.dirname(__file__)), "inventory_plugins")
+    )
+    return inventory_loader.get("upcloud")
+
+
+def write_config(tmpdir, config):
+    path = tmpdir.join("test.upcloud.yml")
+    path.write(config)
+    return str(path)
+
+
+class TestInventoryPlugin(object):
+    def test_verify_file(self, plugin, tmpdir):
+        assert plugin.verify_file(write_config(tmpdir, "plugin: upcloud\n"))
+        other = tmpdir.join("hosts.yml")
+        other.write("plugin: upcloud\n")
+        assert not plugin.verify_file(str(other))
+
+    def test_shared_code_is_loaded_by_path(self, plugin):
+        # a project's own inventory or module_utils package can not shadow them
+        script = sys.modules["upcloud_ansible_inventory"]
+        root = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+        assert script.__file__ == os.path.join(root, "inventory", "upcloud.py")
+        assert script.create_cloud_manager.__module__ == (
+            "upcloud_ansible_module_utils.upcloud_client"
+        )
+
+    def test_parse(self, plugin, manager, tmpdir):
+        path = write_config(
+            tmpdir,
+            "plugin: upcloud\nkeyed_groups:\n  - key: uc_zone\n    prefix: zone\n",
+        )
+        plugin.create_manager = lambda: manager
+        inventory = InventoryData()
+        plugin.parse(inventory, DataLoader(), path, cache=False)
+
+        assert sorted(inventory.hosts) == ["10.1.0.101"]
+        for group in ["uc_all", "web1", "fi_hel1", "zone_fi_hel1"]:
+            assert inventory.groups[group].get_hosts()[0].name == "10.1.0.101"
+
+        host_vars = inventory.get_host("10.1.0.101").vars
+        assert host_vars["uc_uuid"] == "008c365d-d307-4501-8efc-cd6d3bb0e494"
+
+    def test_parse_cache(self, plugin, manager, tmpdir):
+        path = write_config(
+            tmpdir,
+            "plugin: upcloud\ncache: true\ncache_plugin: jsonfile\ncache_connection: {}\n".format(
+                tmpdir.join("cache")
+            ),
+        )
+        plugin.create_manager = lambda: manager
+        plugin.parse(InventoryData(), DataLoader(), path, cache=True)
+        # done by Ansible's InventoryManager after parsing each source
+        plugin.update_cache_if_changed()
+
+        plugin.create_manager = lambda: UnreachableManager()
+        inventory = InventoryData()
+        plugin.parse(inventory, DataLoader(), path, cache=True)
+        assert sorted(inventory.hosts) == ["10.1.0.101"]
+
+        with pytest.raises(AssertionError):
+            plugin.parse(InventoryData(), DataLoader(), path, cache=False)
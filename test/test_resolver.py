@@ -0,0 +1,199 @@
+import os
+import json
+import threading
+from modules import upcloud
+from module_utils.upcloud_resolver import (
+    ServerResolver,
+    ServerLookupIndex,
+    ResolveError,
+)
+from test.api_standin import StandInModule, run_module
+from test.test_upcloud import bulk_params
+
+FI_UUID = "008c365d-d307-4501-8efc-cd6d3bb0e494"
+UK_UUID = "009d64ef-31d1-4684-a26b-c86c955cbf46"
+
+
+def resolver(standin, cache_path=None, account="user"):
+    return ServerResolver(standin.cloud_manager(), cache_path, 60, account)
+
+
+class TestResolver(object):
+    def test_lookup_index(self):
+        index = ServerLookupIndex(
+            [("1", "a.example.com", "fi-hel1"), ("2", "b.example.com", "fi-hel1")],
+        )
+        assert index.by_uuid("1").hostname == "a.example.com"
+        assert index.by_hostname("b.example.com").uuid == "2"
+        assert index.by_hostname("missing") is None
+        assert index.by_ip("10.0.0.1") is None
+
+        index = ServerLookupIndex.from_dict(index.to_dict())
+        assert index.by_uuid("2").zone == "fi-hel1"
+
+        index = ServerLookupIndex(
+            [("1", "a.example.com", None), ("2", "a.example.com", None)]
+        )
+        try:
+            index.by_hostname("a.example.com")
+            assert False, "duplicate hostnames must raise"
+        except ResolveError as e:
+            assert "More than one server" in str(e)
+
+    def test_resolve(self, api_standin):
+        server_resolver = resolver(api_standin)
+        assert server_resolver.uuid_by_hostname("fi.example.com") == FI_UUID
+        assert server_resolver.uuid_by_ip("10.1.0.101") == FI_UUID
+
+        resolved = server_resolver.resolve([UK_UUID, "fi.example.com", "missing"])
+        assert resolved[UK_UUID].hostname == "uk.example.com"
+        assert resolved["fi.example.com"].uuid == FI_UUID
+        assert "missing" in resolved["missing"]
+
+        # one server listing however many lookups, and the one IP-address by itself
+        assert api_standin.count("GET", "/server") == 1
+        assert api_standin.count("GET", "/ip_address") == 1
+        assert api_standin.count("GET", "/ip_address/10.1.0.101") == 1
+
+    def test_resolve_many_ip_addresses(self, api_standin):
+        server_resolver = resolver(api_standin)
+        assert server_resolver.resolve(["10.1.0.101"])["10.1.0.101"].uuid == FI_UUID
+        assert "10.9.9.9" in server_resolver.resolve(["10.9.9.9"])["10.9.9.9"]
+        assert api_standin.count("GET", "/ip_address") == 2
+
+        # more than one IP-address is looked up from one listing of them all
+        api_standin.reset_stats()
+        resolved = server_resolver.resolve(["10.1.0.101", "10.9.9.9", "uk.example.com"])
+        assert resolved["10.1.0.101"].uuid == FI_UUID
+        assert "10.9.9.9" in resolved["10.9.9.9"]
+        assert api_standin.count("GET", "/ip_address") == 1
+        assert api_standin.count("GET", "/ip_address/") == 0
+
+    def test_cache_is_shared(self, api_standin, tmpdir):
+        cache_path = str(tmpdir.join("servers.json"))
+        assert (
+            resolver(api_standin, cache_path).uuid_by_hostname("fi.example.com")
+            == FI_UUID
+        )
+        assert (
+            resolver(api_standin, cache_path).uuid_by_hostname("uk.example.com")
+            == UK_UUID
+        )
+        assert api_standin.count("GET", "/server") == 1
+
+        # the IP-addresses are listed once and added to the cache
+        assert resolver(api_standin, cache_path).uuid_by_ip("10.1.0.101") == FI_UUID
+        assert resolver(api_standin, cache_path).uuid_by_ip("10.1.0.101") == FI_UUID
+        assert api_standin.count("GET", "/server") == 1
+        assert api_standin.count("GET", "/ip_address") == 1
+
+        # another account does not use the cache
+        resolver(api_standin, cache_path, account="other").uuid_by_hostname(
+            "fi.example.com"
+        )
+        assert api_standin.count("GET", "/server") == 2
+
+    def test_concurrent_forks_list_once(self, api_standin, tmpdir):
+        cache_path = str(tmpdir.join("servers.json"))
+        api_standin.latency = 0.05
+        results = []
+
+        def fork():
+            results.append(
+                resolver(api_standin, cache_path).uuid_by_hostname("fi.example.com")
+            )
+
+        threads = [threading.Thread(target=fork) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert results == [FI_UUID] * 8
+        assert api_standin.count("GET", "/server") == 1
+
+    def test_cache_miss_lists_again(self, api_standin, tmpdir):
+        cache_path = str(tmpdir.join("servers.json"))
+        resolver(api_standin, cache_path).get_index()
+
+        api_standin.state.create_server(
+            {"hostname": "new.example.com", "title": "new", "zone": "fi-hel1"}
+        )
+        server_resolver = resolver(api_standin, cache_path)
+        assert server_resolver.server_by_hostname("new.example.com") is not None
+        assert server_resolver.server_by_hostname("missing.example.com") is None
+        assert api_standin.count("GET", "/server") == 2
+
+        server_resolver.invalidate()
+        assert not os.path.exists(cache_path)
+
+    def test_stale_cache(self, api_standin, tmpdir):
+        cache_path = str(tmpdir.join("servers.json"))
+        resolver(api_standin, cache_path).get_index()
+        with open(cache_path) as cache_file:
+            data = json.load(cache_file)
+        data["timestamp"] -= 61
+        with open(cache_path, "w") as cache_file:
+            json.dump(data, cache_file)
+
+        resolver(api_standin, cache_path).get_index()
+        assert api_standin.count("GET", "/server") == 2
+
+    def test_upcloud_module_invalidates_cache(self, api_standin, tmpdir):
+        cache_path = str(tmpdir.join("servers.json"))
+        params = dict(
+            state="present",
+            uuid=None,
+            hostname="new.example.com",
+            title="new.example.com",
+            zone="fi-hel1",
+            plan="1xCPU-1GB",
+            storage_devices=[
+                {"size": 10, "os": "01000000-0000-4000-8000-000030200200"}
+            ],
+            api_user="user",
+            api_passwd="passwd",
+            user=None,
+            ssh_keys=None,
+            server_cache=cache_path,
+            server_cache_max_age=60,
+        )
+        server_manager = upcloud.ServerManager(
+            "user", "passwd", 10, StandInModule(**params)
+        )
+        api_standin.connect(server_manager.manager)
+
+        result = run_module(upcloud.run, StandInModule(**params), server_manager)
+        assert result["changed"]
+        assert "server_cache" not in api_standin.state.server_details(
+            result["server"]["uuid"]
+        )
+        assert not os.path.exists(cache_path)
+
+        # the next task finds the new server through a new cache
+        server_manager.resolver = ServerResolver(
+            server_manager.manager, cache_path, 60, "user"
+        )
+        result = run_module(upcloud.run, StandInModule(**params), server_manager)
+        assert not result["changed"]
+        assert os.path.exists(cache_path)
+
+    def test_bulk_tasks_share_the_cache(self, api_standin, tmpdir):
+        cache_path = str(tmpdir.join("servers.json"))
+        resolver(api_standin, cache_path).get_index()
+        params = bulk_params(
+            servers=[{"hostname": "fi.example.com"}, {"hostname": "uk.example.com"}],
+            server_cache=cache_path,
+            server_cache_max_age=60,
+        )
+        module = StandInModule(**params)
+        server_manager = upcloud.ServerManager("user", "passwd", 10, module)
+        api_standin.connect(server_manager.manager)
+
+        result = run_module(upcloud.run, module, server_manager)
+        assert [server["uuid"] for server in result["servers"]] == [FI_UUID, UK_UUID]
+        # uk.example.com is started, no server is created
+        assert [server["changed"] for server in result["servers"]] == [False, True]
+        assert api_standin.count("POST", "/server") == 1
+        # the hostnames are found in the cached listing
+        assert api_standin.requests.count(("GET", "/1.3/server", 200)) == 1
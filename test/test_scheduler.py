@@ -0,0 +1,159 @@
+import threading
+import pytest
+import requests
+from module_utils.upcloud_client import create_cloud_manager
+from module_utils.upcloud_scheduler import (
+    AIMDLimiter,
+    RequestScheduler,
+    TokenBucket,
+    parse_retry_after,
+)
+
+
+class FakeResponse(object):
+    def __init__(self, status_code, retry_after=None):
+        self.status_code = status_code
+        self.headers = {"Retry-After": retry_after} if retry_after else {}
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def responder(*outcomes):
+    """A send() that returns or raises the given outcomes in order"""
+    outcomes = list(outcomes)
+    calls = []
+
+    def send():
+        calls.append(None)
+        outcome = outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    send.calls = calls
+    return send
+
+
+def scheduler(**kwargs):
+    sleeps = []
+    kwargs.setdefault("jitter", lambda: 1.0)
+    scheduler = RequestScheduler(sleep=sleeps.append, **kwargs)
+    scheduler.sleeps = sleeps
+    return scheduler
+
+
+class TestScheduler(object):
+    def test_parse_retry_after(self):
+        assert parse_retry_after("3") == 3.0
+        assert (
+            parse_retry_after("Wed, 21 Oct 2015 07:28:10 GMT", now=1445412480) == 10.0
+        )
+        assert parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT", now=1445412490) == 0.0
+        assert parse_retry_after("soon") is None
+        assert parse_retry_after(None) is None
+
+    def test_token_bucket(self):
+        clock = FakeClock()
+        bucket = TokenBucket(rate=2, burst=2, clock=clock, sleep=clock.sleep)
+        for _ in range(4):
+            bucket.acquire()
+        # a burst of two, then one request per half second
+        assert clock.now == pytest.approx(1.0)
+
+        bucket.pause(5)
+        bucket.acquire()
+        assert clock.now == pytest.approx(6.5)
+
+        unlimited = TokenBucket(clock=clock, sleep=clock.sleep)
+        for _ in range(100):
+            unlimited.acquire()
+        assert clock.now == pytest.approx(6.5)
+
+    def test_aimd_limiter(self):
+        limiter = AIMDLimiter(initial=4, maximum=8)
+        for _ in range(4):
+            limiter.acquire()
+            limiter.release()
+        assert limiter.limit == pytest.approx(5, abs=0.2)
+
+        limiter.acquire()
+        limiter.release(throttled=True)
+        assert int(limiter.limit) == 2
+
+        limiter.acquire()
+        limiter.release(succeeded=False)
+        assert int(limiter.limit) == 2
+
+    def test_throttled_requests_are_retried(self):
+        requests_scheduler = scheduler()
+        send = responder(FakeResponse(429, "2"), FakeResponse(429), FakeResponse(201))
+        assert requests_scheduler.request("POST", send).status_code == 201
+        assert len(send.calls) == 3
+        assert requests_scheduler.last_retries() == 2
+        # the first wait is the Retry-After, the second the backoff without one
+        assert requests_scheduler.bucket.paused_until > 0
+
+    def test_get_retries(self):
+        requests_scheduler = scheduler(backoff=0.5)
+        send = responder(
+            requests.ConnectionError("reset"), FakeResponse(503), FakeResponse(200)
+        )
+        assert requests_scheduler.request("GET", send).status_code == 200
+        # full jitter of an exponential backoff (jitter is 1.0 here)
+        assert requests_scheduler.sleeps == [0.5, 1.0]
+
+    def test_other_methods_are_not_retried(self):
+        requests_scheduler = scheduler()
+        send = responder(FakeResponse(503))
+        assert requests_scheduler.request("POST", send).status_code == 503
+
+        send = responder(requests.ConnectionError("reset"))
+        with pytest.raises(requests.ConnectionError):
+            requests_scheduler.request("DELETE", send)
+        assert requests_scheduler.sleeps == []
+
+    def test_retries_run_out(self):
+        requests_scheduler = scheduler(max_retries=2)
+        send = responder(*[FakeResponse(503) for _ in range(3)])
+        assert requests_scheduler.request("GET", send).status_code == 503
+        assert len(send.calls) == 3
+
+    def test_rate_limited_standin(self, api_standin):
+        api_standin.rate_limit = 5
+        api_standin.rate_window = 1.0
+        manager = api_standin.connect(
+            create_cloud_manager("user", "passwd", 10, pool_size=8)
+        )
+
+        errors = []
+
+        def worker():
+            try:
+                manager.get_tags()
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=worker) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert errors == []
+        assert api_standin.count(status=200) == 8
+        assert api_standin.count(status=429) >= 1
+        # throttling halved the concurrency
+        assert manager.api.scheduler.limiter.limit < 4
@@ -1,3 +1,21 @@
+from modules import upcloud_tag
+from modules.upcloud_tag import TagIndex
+from test.api_standin import StandInModule, run_module
+
+FI_UUID = "008c365d-d307-4501-8efc-cd6d3bb0e494"
+UK_UUID = "009d64ef-31d1-4684-a26b-c86c955cbf46"
+
+
+def run_tag(standin, failed=False, **params):
+    params.setdefault("state", "present")
+    params.setdefault("tags", None)
+    params.setdefault("workers", 10)
+    module = StandInModule(**params)
+    tag_manager = upcloud_tag.TagManager("user", "passwd", module)
+    standin.connect(tag_manager.manager)
+    return run_module(upcloud_tag.run, module, tag_manager, failed=failed)
+
+
 class TestTag(object):
     def test_create_missing_tags(self, tag_manager):
         tag = tag_manager.create_missing_tags(["test"])[0]
@@ -16,3 +34,156 @@ class TestTag(object):
         tags = tag_manager.get_host_tags("008c365d-d307-4501-8efc-cd6d3bb0e494")
         assert len(tags) == 1
         assert tags[0] == "web1"
+
+    def test_bulk_targets(self, api_standin):
+        result = run_tag(
+            api_standin, targets=["fi.example.com", UK_UUID], tags=["web1", "london"]
+        )
+        assert result["summary"] == dict(targets=2, changed=2, failed=0)
+        fi, uk = result["servers"]
+        assert fi["uuid"] == FI_UUID and fi["added"] == ["london"]
+        assert uk["hostname"] == "uk.example.com" and uk["added"] == ["web1", "london"]
+
+        # the tags and servers are listed once, no IP-addresses are needed
+        assert api_standin.count("GET") == 2
+        assert api_standin.count("POST", "/tag") == 1
+        assert api_standin.count("POST", "/server") == 2
+        assert sorted(api_standin.state.tag("london")["servers"]["server"]) == [
+            FI_UUID,
+            UK_UUID,
+        ]
+
+        result = run_tag(
+            api_standin, targets=["fi.example.com", UK_UUID], tags=["london"]
+        )
+        assert not result["changed"]
+
+        result = run_tag(
+            api_standin, state="absent", targets=[UK_UUID], tags=["london", "x"]
+        )
+        assert result["servers"][0]["removed"] == ["london"]
+
+    def test_bulk_server_tags(self, api_standin):
+        result = run_tag(
+            api_standin,
+            failed=True,
+            server_tags={"10.1.0.101": ["db"], "missing.example.com": ["db"]},
+        )
+        assert result["summary"] == dict(targets=2, changed=1, failed=1)
+        by_ip, missing = result["servers"]
+        assert by_ip["uuid"] == FI_UUID and by_ip["added"] == ["db"]
+        assert "missing.example.com" in missing["msg"]
+        assert api_standin.count("GET", "/ip_address") == 1
+
+    def test_tag_index(self, manager):
+        tag_index = TagIndex(manager.get_tags())
+        assert "TheTestTag1" in tag_index and "missing" not in tag_index
+        assert tag_index.tags_of("0057e20a-6878-43a7-b2b3-530c4a4bdc55") == [
+            "TheTestTag1",
+            "TheTestTag2",
+        ]
+        assert tag_index.tags_of(FI_UUID) == ["web1"]
+
+        tag_index.assign(FI_UUID, ["web1", "db"])
+        tag_index.remove(FI_UUID, ["web1"])
+        assert tag_index.tags_of(FI_UUID) == ["db"]
+
+    def test_single_server_uses_tag_listing(self, api_standin):
+        result = run_tag(api_standin, uuid=FI_UUID, tags=["web1", "db"])
+        assert result["changed"]
+        # one tag listing, no server details
+        assert api_standin.count("GET") == 1
+        assert api_standin.count("GET", "/tag") == 1
+        assert "db" in api_standin.state.server_details(FI_UUID)["tags"]["tag"]
+
+        result = run_tag(api_standin, state="absent", uuid=FI_UUID, tags=["db"])
+        assert result["changed"]
+        assert api_standin.state.server_details(FI_UUID)["tags"]["tag"] == ["web1"]
+
+    def test_plan_exact(self):
+        to_add, to_remove = upcloud_tag.plan_exact(
+            {"a": ["web", "old"], "b": ["web"]},
+            {"a": ["web", "new"], "b": ["web"], "c": []},
+        )
+        assert to_add == {"a": ["new"]}
+        assert to_remove == {"a": ["old"]}
+
+    def test_exact_server_tags(self, api_standin):
+        result = run_tag(
+            api_standin,
+            state="exact",
+            server_tags={"fi.example.com": ["web1", "db"], UK_UUID: ["web2"]},
+        )
+        assert result["changed"]
+        assert result["created"] == ["db"]
+        assert result["summary"] == dict(servers=2, changed=1, failed=0)
+        # the new tag is created with its server, nothing else is requested
+        assert api_standin.count("POST") == 1
+        assert api_standin.count("POST", "/tag") == 1
+        assert sorted(api_standin.state.server_details(FI_UUID)["tags"]["tag"]) == [
+            "db",
+            "web1",
+        ]
+
+        result = run_tag(
+            api_standin,
+            state="exact",
+            server_tags={"fi.example.com": ["db"], UK_UUID: ["web2"]},
+            delete_unused_tags=True,
+        )
+        assert result["changed"]
+        assert result["servers"][0]["removed"] == ["web1"]
+        assert result["deleted"] == ["web1"]
+        assert "web1" not in [tag["name"] for tag in api_standin.state.list_tags()]
+
+        api_standin.reset_stats()
+        result = run_tag(
+            api_standin,
+            state="exact",
+            server_tags={"fi.example.com": ["db"], UK_UUID: ["web2"]},
+        )
+        assert not result["changed"]
+        assert api_standin.count() == api_standin.count("GET") == 2
+
+    def test_exact_tag_servers(self, api_standin):
+        result = run_tag(
+            api_standin,
+            state="exact",
+            tag_servers={"web1": [UK_UUID], "web2": [], "unused": []},
+            delete_unused_tags=True,
+        )
+        assert result["changed"]
+        changes = dict((server["uuid"], server) for server in result["servers"])
+        assert changes[UK_UUID]["added"] == ["web1"]
+        assert changes[UK_UUID]["removed"] == ["web2"]
+        assert changes[FI_UUID]["removed"] == ["web1"]
+        # only web2 lost its last server, web1 moved to another server
+        assert result["deleted"] == ["web2"]
+        assert result["created"] == []
+        # one assign and one remove per changed server
+        assert api_standin.count("POST", "/server/{}/tag".format(UK_UUID)) == 1
+        assert api_standin.count("POST", "/server/{}/untag".format(UK_UUID)) == 1
+        assert api_standin.state.server_details(FI_UUID)["tags"]["tag"] == []
+
+    def test_exact_failures(self, api_standin):
+        result = run_tag(
+            api_standin,
+            failed=True,
+            state="exact",
+            server_tags={"missing.example.com": ["db"], FI_UUID: ["web1"]},
+        )
+        assert not result["changed"]
+        assert result["summary"] == dict(servers=2, changed=0, failed=1)
+
+        # nothing is removed from the servers that resolve either
+        result = run_tag(
+            api_standin,
+            failed=True,
+            state="exact",
+            tag_servers={"web1": ["missing.example.com"]},
+            delete_unused_tags=True,
+        )
+        assert not result["changed"]
+        assert result["servers"][0]["target"] == "missing.example.com"
+        assert api_standin.count("POST") == api_standin.count("DELETE") == 0
+        assert api_standin.state.server_details(FI_UUID)["tags"]["tag"] == ["web1"]
@@ -0,0 +1,124 @@
+import json
+from upcloud_api.errors import UpCloudAPIError
+from inventory.upcloud import build_inventory
+from module_utils.upcloud_client import create_cloud_manager
+from module_utils.upcloud_trace import (
+    Tracer,
+    endpoint_name,
+    latency_summary,
+    trace_module,
+    trace_phase,
+)
+from modules import upcloud
+from test.api_standin import StandInModule, run_module
+
+SERVER_UUID = "008c365d-d307-4501-8efc-cd6d3bb0e494"
+
+
+def traced_manager(standin, tracer):
+    return standin.connect(create_cloud_manager("user", "passwd", 10, tracer=tracer))
+
+
+def read_lines(path):
+    with open(path) as trace_file:
+        return [json.loads(line) for line in trace_file]
+
+
+class TestTrace(object):
+    def test_latency_summary(self):
+        summary = latency_summary(float(latency) for latency in range(1, 101))
+        assert summary == dict(total_ms=5050.0, p50_ms=50.0, p95_ms=95.0, p99_ms=99.0)
+        assert latency_summary([])["p50_ms"] is None
+
+        assert endpoint_name("/server/" + SERVER_UUID + "/firewall_rule") == (
+            "/server/{uuid}/firewall_rule"
+        )
+
+    def test_request_spans(self, api_standin, tmpdir):
+        path = str(tmpdir.join("trace.ndjson"))
+        tracer = Tracer(path)
+        manager = traced_manager(api_standin, tracer)
+
+        manager.get_servers()
+        manager.get_server(SERVER_UUID)
+        try:
+            manager.get_server("00000000-0000-0000-0000-000000000000")
+            assert False, "a missing server must raise"
+        except UpCloudAPIError:
+            pass
+        tracer.close()
+        tracer.close()
+
+        lines = read_lines(path)
+        assert [line["type"] for line in lines] == ["request"] * 3 + ["summary"]
+        span = lines[1]
+        assert span["method"] == "GET"
+        assert span["endpoint"] == "/server/" + SERVER_UUID
+        assert span["status"] == 200
+        assert span["bytes_received"] > 0
+        assert span["retries"] == 0
+        assert span["latency_ms"] >= 0
+
+        summary = lines[-1]
+        assert summary["calls"] == 3
+        assert summary["errors"] == 1
+        assert summary["endpoints"]["GET /server/{uuid}"]["calls"] == 2
+        assert summary["endpoints"]["GET /server"]["p99_ms"] is not None
+
+    def test_inventory_phases(self, api_standin):
+        tracer = Tracer()
+        manager = traced_manager(api_standin, tracer)
+        build_inventory(manager, True, False, "IPv4", populate=True, detail_workers=4)
+
+        summary = tracer.summary()
+        assert sorted(summary["phases"]) == ["get_servers", "populate"]
+        assert summary["phases"]["populate"]["count"] == 1
+        assert summary["endpoints"]["GET /server/{uuid}"]["calls"] == api_standin.count(
+            "GET", "/server/"
+        )
+
+    def test_untraced_phases(self, manager):
+        with trace_phase(manager, "nothing"):
+            pass
+
+    def test_trace_module(self, monkeypatch, tmpdir):
+        monkeypatch.delenv("UPCLOUD_TRACE", raising=False)
+        assert trace_module(StandInModule(profile=False)) is None
+
+        path = str(tmpdir.join("trace.ndjson"))
+        monkeypatch.setenv("UPCLOUD_TRACE", path)
+        module = StandInModule(profile=False)
+        tracer = trace_module(module)
+        assert tracer.path == path
+        assert "profile" not in run_module(
+            lambda module, _: module.exit_json(), module, None
+        )
+        assert read_lines(path)[-1]["type"] == "summary"
+
+    def test_module_profile(self, api_standin):
+        params = dict(
+            state="present",
+            uuid=None,
+            hostname="new.example.com",
+            title="new.example.com",
+            zone="fi-hel1",
+            plan="1xCPU-1GB",
+            storage_devices=[
+                {"size": 10, "os": "01000000-0000-4000-8000-000030200200"}
+            ],
+            user=None,
+            ssh_keys=None,
+            profile=True,
+        )
+        module = StandInModule(**params)
+        server_manager = upcloud.ServerManager("user", "passwd", 10, module)
+        api_standin.connect(server_manager.manager)
+
+        result = run_module(upcloud.run, module, server_manager)
+        profile = result["profile"]
+        assert profile["calls"] == api_standin.count()
+        assert profile["endpoints"]["POST /server"]["calls"] == 1
+        assert profile["phases"]["ensure_started"]["count"] == 1
+        assert "profile" not in api_standin.state.server_details(
+            result["server"]["uuid"]
+        )
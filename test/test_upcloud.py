@@ -1,4 +1,13 @@
+import os
+import sys
+import time
+import threading
+import importlib.util
+import pytest
 from itertools import product
+from modules import upcloud
+from modules.upcloud import expand_bulk_servers
+from test.api_standin import StandInModule, run_module
 
 
 class TestUpcloud(object):
@@ -44,3 +53,178 @@ class TestUpcloud(object):
         assert server.memory_amount == "1024"
         assert type(server.storage_devices[0]).__name__ == "Storage"
         assert type(server.ip_addresses[0]).__name__ == "IPAddress"
+
+    def test_expand_bulk_servers(self):
+        params = dict(
+            state="present",
+            uuid=None,
+            hostname="web{index:02d}.example.com",
+            title="web {index}",
+            zone="fi-hel1",
+            plan=None,
+            servers=None,
+            count=3,
+            start_index=9,
+            workers=10,
+        )
+        servers = expand_bulk_servers(params)
+        assert [server["hostname"] for server in servers] == [
+            "web09.example.com",
+            "web10.example.com",
+            "web11.example.com",
+        ]
+        assert servers[0] == dict(
+            state="present", hostname="web09.example.com", title="web 9", zone="fi-hel1"
+        )
+
+        params.update(
+            count=None,
+            servers=[{"hostname": "db1.example.com"}, {"uuid": "x", "zone": "de-fra1"}],
+        )
+        servers = expand_bulk_servers(params)
+        assert servers[0]["hostname"] == "db1.example.com"
+        assert servers[0]["zone"] == "fi-hel1"
+        assert servers[1]["uuid"] == "x" and servers[1]["zone"] == "de-fra1"
+
+
+class TestWithoutClient(object):
+    @pytest.mark.parametrize("name", ["upcloud", "upcloud_firewall", "upcloud_tag"])
+    def test_has_upcloud(self, monkeypatch, name):
+        for imported in list(sys.modules):
+            if imported.startswith(("module_utils", "upcloud_api.")):
+                monkeypatch.delitem(sys.modules, imported)
+        monkeypatch.setitem(sys.modules, "upcloud_api", None)
+
+        path = os.path.join(os.path.dirname(upcloud.__file__), name + ".py")
+        spec = importlib.util.spec_from_file_location(name + "_without_client", path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        assert not module.HAS_UPCLOUD
+
+
+def bulk_params(**params):
+    defaults = dict(
+        state="present",
+        uuid=None,
+        hostname=None,
+        title=None,
+        zone="fi-hel1",
+        plan="1xCPU-1GB",
+        storage_devices=[{"size": 10, "os": "01000000-0000-4000-8000-000030200200"}],
+        user=None,
+        ssh_keys=None,
+        servers=None,
+        count=None,
+        start_index=1,
+        workers=10,
+    )
+    defaults.update(params)
+    return defaults
+
+
+class TestUpcloudBulk(object):
+    def run_bulk(self, api_standin, failed=False, **params):
+        module = StandInModule(**bulk_params(**params))
+        server_manager = upcloud.ServerManager("user", "passwd", 10, module)
+        api_standin.connect(server_manager.manager)
+        return run_module(upcloud.run, module, server_manager, failed=failed)
+
+    def test_bulk_count(self, api_standin):
+        lock = threading.Lock()
+        creates = dict(in_flight=0, most=0)
+
+        def latency(method, path):
+            # the creation requests in flight at the same time
+            if (method, path) != ("POST", "/1.3/server"):
+                return 0
+            with lock:
+                creates["in_flight"] += 1
+                creates["most"] = max(creates["most"], creates["in_flight"])
+            time.sleep(0.1)
+            with lock:
+                creates["in_flight"] -= 1
+            return 0
+
+        api_standin.latency = latency
+        result = self.run_bulk(
+            api_standin,
+            count=5,
+            hostname="node{index}.example.com",
+            title="node {index}",
+        )
+
+        assert result["changed"]
+        assert [server["hostname"] for server in result["servers"]] == [
+            "node{}.example.com".format(index) for index in range(1, 6)
+        ]
+        assert all(
+            server["changed"] and server["public_ip"] for server in result["servers"]
+        )
+        # the servers are created concurrently, not one after another
+        assert creates["most"] > 1
+        assert api_standin.count("POST", "/server") == 5
+        # one server listing for all hostname lookups
+        assert api_standin.requests.count(("GET", "/1.3/server", 200)) == 1
+
+        api_standin.latency = 0
+        result = self.run_bulk(api_standin, count=5, hostname="node{index}.example.com")
+        assert not result["changed"]
+        assert len(api_standin.state.servers) == 2 + 5
+
+    def test_bulk_servers(self, api_standin):
+        # the task's hostname is not a template without count
+        result = self.run_bulk(
+            api_standin,
+            hostname="{name}.example.com",
+            servers=[
+                {"hostname": "fi.example.com"},
+                {"hostname": "new.example.com", "title": "new", "zone": "de-fra1"},
+            ],
+        )
+        existing, created = result["servers"]
+        assert existing["uuid"] == "008c365d-d307-4501-8efc-cd6d3bb0e494"
+        assert not existing["changed"]
+        assert created["changed"]
+        assert created["server"]["zone"] == "de-fra1"
+
+    def test_bulk_failures(self, api_standin):
+        for _ in range(2):
+            api_standin.state.create_server({"hostname": "dup.example.com"})
+
+        result = self.run_bulk(
+            api_standin,
+            failed=True,
+            servers=[
+                {"hostname": "new.example.com", "title": "new"},
+                {"hostname": "dup.example.com", "title": "dup"},
+            ],
+        )
+        assert result["msg"] == "1 of 2 servers failed"
+        assert result["changed"]
+        assert not result["servers"][0].get("failed")
+        assert "More than one server" in result["servers"][1]["msg"]
+
+        result = self.run_bulk(
+            api_standin, failed=True, count=2, hostname="same.example.com"
+        )
+        assert "{index}" in result["msg"]
+
+        result = self.run_bulk(
+            api_standin, failed=True, count=2, hostname="{name}.example.com"
+        )
+        assert result["msg"].startswith("Invalid hostname or title template")
+
+    def test_bulk_absent(self, api_standin):
+        for uuid in list(api_standin.state.servers):
+            api_standin.state.set_server_state(uuid, "stopped")
+
+        result = self.run_bulk(
+            api_standin,
+            state="absent",
+            servers=[
+                {"hostname": "fi.example.com"},
+                {"hostname": "missing.example.com"},
+            ],
+        )
+        assert [server["changed"] for server in result["servers"]] == [True, False]
+        assert "008c365d-d307-4501-8efc-cd6d3bb0e494" not in api_standin.state.servers
@@ -0,0 +1,154 @@
+import pytest
+from concurrent.futures import ThreadPoolExecutor
+from upcloud_api.errors import UpCloudAPIError, UpCloudClientError
+from modules import upcloud
+from module_utils.upcloud_wait import (
+    Backoff,
+    StateWatcher,
+    WaitTimeout,
+    ensure_started,
+    stop_and_destroy,
+)
+from test.api_standin import StandInModule, run_module
+from test.test_upcloud import bulk_params
+
+FI_UUID = "008c365d-d307-4501-8efc-cd6d3bb0e494"
+
+
+def watcher(standin, **kwargs):
+    """A watcher of the stand-in that does not sleep"""
+    kwargs.setdefault("sleep", lambda seconds: None)
+    return StateWatcher(standin.cloud_manager(), **kwargs)
+
+
+def create_servers(standin, count):
+    return [
+        standin.state.create_server({"hostname": "new{}.example.com".format(index)})[
+            "uuid"
+        ]
+        for index in range(count)
+    ]
+
+
+class TestWait(object):
+    def test_backoff(self):
+        low = Backoff(1, 8, jitter=lambda: 0.0)
+        high = Backoff(1, 8, jitter=lambda: 1.0)
+        assert [low.delay(attempt) for attempt in range(5)] == [0.5, 1, 2, 4, 4]
+        assert [high.delay(attempt) for attempt in range(5)] == [1, 2, 4, 8, 8]
+
+    def test_wait_for_many_servers(self, api_standin):
+        api_standin.state.transition_reads = 3
+        uuids = create_servers(api_standin, 5)
+        state_watcher = watcher(api_standin)
+
+        states = state_watcher.wait(uuids, ("started",))
+        assert states == dict((uuid, "started") for uuid in uuids)
+        # one listing per poll, no server details
+        assert state_watcher.listings == 3
+        assert api_standin.count("GET", "/server/") == 0
+
+    def test_wait_for_one_server(self, api_standin):
+        api_standin.state.transition_reads = 3
+        uuid = create_servers(api_standin, 1)[0]
+        state_watcher = watcher(api_standin)
+
+        assert state_watcher.wait([uuid], ("started",)) == {uuid: "started"}
+        # one server's details per poll, no listings
+        assert state_watcher.listings == 0
+        assert api_standin.count("GET", "/server/" + uuid) == 3
+        assert state_watcher.waiting == 0
+
+        api_standin.state.set_server_state(uuid, "stopped")
+        api_standin.state.delete_server(uuid)
+        with pytest.raises(Exception) as error_info:
+            state_watcher.wait([uuid], ("started",))
+        assert "no longer exists" in str(error_info.value)
+        assert state_watcher.waiting == 0
+
+    def test_concurrent_waits_share_listings(self, api_standin):
+        api_standin.state.transition_reads = 2
+        uuids = create_servers(api_standin, 8)
+        state_watcher = StateWatcher(api_standin.cloud_manager(), Backoff(0.05, 0.05))
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            states = list(
+                executor.map(
+                    lambda uuid: state_watcher.wait([uuid], ("started",)), uuids
+                )
+            )
+
+        assert states == [{uuid: "started"} for uuid in uuids]
+        assert state_watcher.listings < 8
+
+    def test_budget(self, api_standin):
+        api_standin.state.transition_reads = 10
+        uuid = create_servers(api_standin, 1)[0]
+        with pytest.raises(WaitTimeout) as timeout_info:
+            watcher(api_standin, max_polls=3).wait([uuid], ("started",))
+        assert "3 polls" in str(timeout_info.value)
+        assert api_standin.count("GET", "/server") == 3
+
+        api_standin.state.set_server_state(uuid, "error")
+        with pytest.raises(Exception) as error_info:
+            watcher(api_standin).wait([uuid], ("started",))
+        assert "error state" in str(error_info.value)
+
+    def test_retry(self, api_standin):
+        calls = []
+
+        def operation():
+            calls.append(None)
+            if len(calls) < 3:
+                raise UpCloudAPIError("SERVER_STATE_ILLEGAL", "not yet")
+            return "done"
+
+        state_watcher = watcher(api_standin)
+        assert state_watcher.retry(operation, ["SERVER_STATE_ILLEGAL"]) == "done"
+        assert len(calls) == 3
+
+        del calls[:]
+        with pytest.raises(UpCloudClientError):
+            watcher(api_standin, max_polls=2).retry(operation, ["SERVER_STATE_ILLEGAL"])
+        assert len(calls) == 2
+
+    def test_ensure_started_and_stop_and_destroy(self, api_standin):
+        api_standin.state.transition_reads = 2
+        uuid = create_servers(api_standin, 1)[0]
+        state_watcher = watcher(api_standin)
+        manager = state_watcher.manager
+
+        server = manager.get_server(uuid)
+        assert server.state == "maintenance"
+        assert ensure_started(server, state_watcher)
+        assert server.state == "started"
+
+        server = manager.get_server(FI_UUID)
+        stop_and_destroy(server, state_watcher)
+        assert FI_UUID not in api_standin.state.servers
+        assert api_standin.count("POST", "/server/" + FI_UUID + "/stop") == 1
+
+    def test_bulk_module(self, api_standin):
+        api_standin.state.transition_reads = 2
+        module = StandInModule(
+            **bulk_params(
+                count=4,
+                hostname="node{index}.example.com",
+                poll_interval=0.01,
+                max_poll_interval=0.02,
+                wait_timeout=10,
+                max_polls=None,
+            )
+        )
+        server_manager = upcloud.ServerManager("user", "passwd", 10, module)
+        api_standin.connect(server_manager.manager)
+
+        result = run_module(upcloud.run, module, server_manager)
+        assert all(
+            server["server"]["state"] == "started" for server in result["servers"]
+        )
+
+        for key in ["poll_interval", "wait_timeout"]:
+            assert key not in api_standin.state.server_details(
+                result["servers"][0]["uuid"]
+            )